@@ -1,9 +1,14 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory, Response, stream_with_context, abort, g, has_request_context
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
 from flask_socketio import SocketIO, emit, join_room, leave_room
-from flask_migrate import Migrate
-from werkzeug.security import generate_password_hash, check_password_hash
+import socketio as socketio_module
+from flask_migrate import Migrate, upgrade, stamp
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 from Crypto.Cipher import AES
@@ -12,41 +17,245 @@ import base64
 import requests
 import os
 import logging
+import logging.handlers
 import re
 import smtplib
+import socketserver
 import random
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.image import MIMEImage
 from email.mime.base import MIMEBase
-from email import encoders
+from email import encoders, message_from_bytes
 import datetime
-from PIL import Image
+from PIL import Image, ImageOps
 import io
+import json
+import queue
+import hashlib
+import sqlite3
+import threading
+import time
+import atexit
+import heapq
+import itertools
+import html
+import click
+import tempfile
+import mimetypes
+from urllib.parse import quote
+import uuid
+import contextlib
 import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 
 app = Flask(__name__)
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 # Load environment variables from .env
 load_dotenv()
+
+# Set up logging. Handlers only put records on a queue; a background listener thread does the
+# formatting, redaction and writing. LOG_PROFILE=production logs JSON and keeps 1% of DEBUG
+# records; development logs every record as text.
+LOG_PROFILE = os.getenv("LOG_PROFILE", "development")
+LOG_MAX_MESSAGE = int(os.getenv("LOG_MAX_MESSAGE", 2000))  # Longer messages are truncated
+
+REDACT_PATTERNS = [
+    (re.compile(r'(Bearer\s+)[A-Za-z0-9._~+/=-]+'), r'\1[REDACTED]'),
+    (re.compile(r'sk-[A-Za-z0-9_-]{8,}'), '[REDACTED]'),
+    (re.compile(r'((?:password|passwd|secret|api_key|token)["\']?\s*[:=]\s*["\']?)[^\s"\',}]+', re.I), r'\1[REDACTED]'),
+]
+
+def redact(text):
+    for pattern, replacement in REDACT_PATTERNS:
+        text = pattern.sub(replacement, text)
+    if len(text) > LOG_MAX_MESSAGE:
+        text = f"{text[:LOG_MAX_MESSAGE]}... [{len(text) - LOG_MAX_MESSAGE} chars truncated]"
+    return text
+
+# Adds the HTTP request id and Socket.IO session id. Handler filters run on the caller's thread,
+# which is why the request context is still there to read.
+class RequestContextFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = None
+        record.socket_id = None
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            record.socket_id = getattr(request, 'sid', None)
+        return True
+
+class DebugSampler(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': redact(record.getMessage())
+        }
+        if getattr(record, 'request_id', None):
+            entry['request_id'] = record.request_id
+        if getattr(record, 'socket_id', None):
+            entry['socket_id'] = record.socket_id
+        if record.exc_info:
+            entry['exception'] = redact(self.formatException(record.exc_info))
+        return json.dumps(entry, ensure_ascii=False)
+
+class RedactingFormatter(logging.Formatter):
+    def format(self, record):
+        record.request_id = getattr(record, 'request_id', None) or getattr(record, 'socket_id', None) or '-'
+        return redact(super().format(record))
+
+# Hands records to the listener unformatted (the stock QueueHandler formats on the caller's
+# thread) and drops them instead of blocking when the queue is full. The message is merged with
+# its args here, so the listener never renders objects that changed (or left their session) since.
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DeferredQueueHandler.dropped += 1
+
+def configure_logging():
+    production = LOG_PROFILE == 'production'
+    level = os.getenv("LOG_LEVEL", "DEBUG")
+    sample_rate = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", 0.01 if production else 1))
+    log_format = os.getenv("LOG_FORMAT", "json" if production else "text")
+
+    output = logging.StreamHandler()
+    if log_format == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(RedactingFormatter('%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'))
+
+    log_queue = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", 10000)))
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(DebugSampler(sample_rate))
+    handler.addFilter(RequestContextFilter())
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = configure_logging()
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 EMAIL_SENDER = os.getenv("EMAIL_SENDER")
 EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
 app.config['SECRET_KEY'] = os.getenv("SECRET_KEY", "your-secret-key-here")
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("DATABASE_URL", 'sqlite:///users.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['UPLOAD_FOLDER'] = os.path.join('static', 'uploads')
+app.config['UPLOAD_FOLDER'] = os.getenv("UPLOAD_FOLDER", os.path.join('static', 'uploads'))
 app.config['PROFILE_PICS_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'profile_pics')
 app.config['MESSAGES_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'messages')
+app.config['STATUS_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'status')
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'mp4', 'pdf', 'doc', 'docx'}
+app.config['AI_MAX_WORKERS'] = int(os.getenv("AI_MAX_WORKERS", 12))  # Concurrent OpenRouter calls across all /ask requests
+app.config['AI_MODEL_DEADLINE'] = float(os.getenv("AI_MODEL_DEADLINE", 45))  # Seconds each model gets before it is reported as slow
+app.config['OPENROUTER_BASE_URL'] = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+app.config['OPENROUTER_CONNECT_TIMEOUT'] = float(os.getenv("OPENROUTER_CONNECT_TIMEOUT", 5))
+app.config['OPENROUTER_MAX_RETRIES'] = int(os.getenv("OPENROUTER_MAX_RETRIES", 2))
+app.config['OPENROUTER_RETRY_BUDGET_RATIO'] = float(os.getenv("OPENROUTER_RETRY_BUDGET_RATIO", 0.2))  # Retries allowed per request, on average
+app.config['OPENROUTER_BREAKER_THRESHOLD'] = int(os.getenv("OPENROUTER_BREAKER_THRESHOLD", 3))  # Consecutive failures before a model is skipped
+app.config['OPENROUTER_BREAKER_RESET'] = float(os.getenv("OPENROUTER_BREAKER_RESET", 30))  # Seconds before a skipped model is tried again
+app.config['AI_CACHE_BACKEND'] = os.getenv("AI_CACHE_BACKEND", "memory")  # memory, disk or none
+app.config['AI_CACHE_SIZE'] = int(os.getenv("AI_CACHE_SIZE", 1000))
+app.config['AI_CACHE_TTL'] = float(os.getenv("AI_CACHE_TTL", 3600))
+app.config['AI_CACHE_PATH'] = os.getenv("AI_CACHE_PATH", os.path.join(app.instance_path, 'ai_cache.db'))
+app.config['AI_HISTORY_TOKEN_BUDGET'] = int(os.getenv("AI_HISTORY_TOKEN_BUDGET", 1500))  # Recent turns sent verbatim
+app.config['AI_HISTORY_MAX_TURNS'] = int(os.getenv("AI_HISTORY_MAX_TURNS", 20))
+app.config['AI_SUMMARY_TOKEN_BUDGET'] = int(os.getenv("AI_SUMMARY_TOKEN_BUDGET", 400))  # Rolling summary of older turns
+app.config['READ_RECEIPT_WINDOW'] = float(os.getenv("READ_RECEIPT_WINDOW", 0.5))  # Seconds of read acks coalesced into one write
+app.config['MESSAGE_ID_BLOCK'] = int(os.getenv("MESSAGE_ID_BLOCK", 100))  # Message ids reserved per database round trip (one process only)
+app.config['MESSAGE_ID_REDIS_URL'] = os.getenv("MESSAGE_ID_REDIS_URL")  # Shared message id counter for several workers, e.g. redis://localhost:6379/0
+app.config['MESSAGE_QUEUE_SIZE'] = int(os.getenv("MESSAGE_QUEUE_SIZE", 5000))  # Messages waiting to be written before senders are pushed back
+app.config['MESSAGE_QUEUE_TIMEOUT'] = float(os.getenv("MESSAGE_QUEUE_TIMEOUT", 2))  # Seconds a sender waits for room in a full queue
+app.config['MESSAGE_BATCH_SIZE'] = int(os.getenv("MESSAGE_BATCH_SIZE", 500))  # Most messages written per commit
+app.config['PRESENCE_BACKEND'] = os.getenv("PRESENCE_BACKEND", "memory")  # memory, or redis to share presence between workers
+app.config['PRESENCE_REDIS_URL'] = os.getenv("PRESENCE_REDIS_URL", "redis://localhost:6379/0")
+app.config['PRESENCE_DEBOUNCE'] = float(os.getenv("PRESENCE_DEBOUNCE", 5))  # Seconds a user may be disconnected before going offline
+app.config['PRESENCE_FLUSH_INTERVAL'] = float(os.getenv("PRESENCE_FLUSH_INTERVAL", 30))  # Seconds between last_seen writes
+app.config['PRESENCE_CONTACTS_TTL'] = float(os.getenv("PRESENCE_CONTACTS_TTL", 300))  # Seconds a user's contact list is cached
+app.config['PRESENCE_CONTACTS_MAX'] = int(os.getenv("PRESENCE_CONTACTS_MAX", 10000))  # Contact lists kept cached, least recently used dropped first
+app.config['TYPING_INTERVAL'] = float(os.getenv("TYPING_INTERVAL", 1))  # Seconds between typing_update events for a room
+app.config['TYPING_TTL'] = float(os.getenv("TYPING_TTL", 6))  # Seconds a typing indicator lasts without another typing event
+app.config['SOCKETIO_ASYNC_MODE'] = os.getenv("SOCKETIO_ASYNC_MODE", "threading")  # threading, eventlet or gevent
+app.config['SOCKETIO_MESSAGE_QUEUE'] = os.getenv("SOCKETIO_MESSAGE_QUEUE")  # e.g. redis://localhost:6379/1, or local:// in tests
+app.config['SOCKETIO_CHANNEL'] = os.getenv("SOCKETIO_CHANNEL", "x07-socketio")
+app.config['AES_KEYS'] = os.getenv("AES_KEYS")  # "kid:base64key,kid:base64key"; overrides the keyring file
+app.config['AES_ACTIVE_KEY_ID'] = os.getenv("AES_ACTIVE_KEY_ID")  # Key used for new messages (default: last in AES_KEYS)
+app.config['AES_KEYRING_PATH'] = os.getenv("AES_KEYRING_PATH", os.path.join(app.instance_path, 'keyring.json'))
+app.config['AES_REENCRYPT_BACKGROUND'] = os.getenv("AES_REENCRYPT_BACKGROUND", "0") == "1"  # Move old messages to the active key
+app.config['AES_REENCRYPT_BATCH'] = int(os.getenv("AES_REENCRYPT_BATCH", 500))
+app.config['PLAINTEXT_CACHE_SIZE'] = int(os.getenv("PLAINTEXT_CACHE_SIZE", 10000))  # Decrypted messages kept in memory (0 disables)
+app.config['PLAINTEXT_CACHE_TTL'] = float(os.getenv("PLAINTEXT_CACHE_TTL", 3600))
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("MAX_UPLOAD_MB", 64)) * 1024 * 1024  # Larger request bodies get a 413
+app.config['MEDIA_WORKERS'] = int(os.getenv("MEDIA_WORKERS", 2))  # Threads resizing uploaded images
+app.config['MEDIA_MAX_PIXELS'] = int(os.getenv("MEDIA_MAX_PIXELS", 50_000_000))  # Larger images are rejected before decoding
+app.config['UPLOAD_PARTIAL_FOLDER'] = os.getenv("UPLOAD_PARTIAL_FOLDER", os.path.join(app.instance_path, 'partial_uploads'))  # Chunked uploads in progress
+app.config['UPLOAD_CHUNK_SIZE'] = int(os.getenv("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))  # Chunk size suggested to clients
+app.config['MAX_ATTACHMENT_MB'] = int(os.getenv("MAX_ATTACHMENT_MB", 1024))  # Largest file a chunked upload may declare
+app.config['UPLOAD_SESSION_TTL'] = float(os.getenv("UPLOAD_SESSION_TTL", 86400))  # Seconds an idle upload is kept for resuming
+app.config['BLOB_GC_GRACE'] = float(os.getenv("BLOB_GC_GRACE", 3600))  # Seconds an unreferenced attachment is kept before `flask gc-blobs` removes it
+app.config['EXPIRY_HORIZON'] = float(os.getenv("EXPIRY_HORIZON", 300))  # Seconds between checks of the expires_at index for deadlines set by other workers
+app.config['EXPIRY_BATCH'] = int(os.getenv("EXPIRY_BATCH", 500))  # Expired messages deleted per transaction
+app.config['MAX_DISAPPEAR_TIMER'] = int(os.getenv("MAX_DISAPPEAR_TIMER", 365 * 24 * 3600))  # Longest disappearing-message timer, in seconds
+app.config['SEARCH_PAGE_SIZE'] = int(os.getenv("SEARCH_PAGE_SIZE", 20))  # Results per /api/search page
+app.config['SEARCH_BACKFILL_BATCH'] = int(os.getenv("SEARCH_BACKFILL_BATCH", 1000))  # Rows indexed per transaction by `flask search-backfill`
+app.config['STATUS_TTL'] = float(os.getenv("STATUS_TTL", 24 * 3600))  # Seconds a status stays in the feed before it is swept
+app.config['STATUS_FEED_CACHE_TTL'] = float(os.getenv("STATUS_FEED_CACHE_TTL", 30))  # Seconds a viewer's feed is cached (posts clear it sooner)
+app.config['STATUS_SWEEP_INTERVAL'] = float(os.getenv("STATUS_SWEEP_INTERVAL", 300))  # Seconds between sweeps of expired statuses
+app.config['STATUS_SWEEP_BATCH'] = int(os.getenv("STATUS_SWEEP_BATCH", 500))  # Statuses deleted per transaction
+app.config['MEDIA_OFFLOAD'] = os.getenv("MEDIA_OFFLOAD", "none")  # none, nginx (X-Accel-Redirect) or sendfile (X-Sendfile)
+app.config['MEDIA_ACCEL_PREFIX'] = os.getenv("MEDIA_ACCEL_PREFIX", "/protected-uploads/")  # nginx internal location aliased to UPLOAD_FOLDER
+app.config['USE_X_SENDFILE'] = app.config['MEDIA_OFFLOAD'] == 'sendfile'
+app.config['MEDIA_ORIGINALS_FOLDER'] = os.getenv("MEDIA_ORIGINALS_FOLDER", os.path.join(app.instance_path, 'media_originals'))  # Uploads waiting for a worker
+app.config['INBOX_PAGE_SIZE'] = int(os.getenv("INBOX_PAGE_SIZE", 50))  # Conversations per sidebar page
+app.config['INBOX_PREVIEW_CHARS'] = int(os.getenv("INBOX_PREVIEW_CHARS", 80))  # Characters of the last message kept for the sidebar
+app.config['DIRECTORY_RECENT_LIMIT'] = int(os.getenv("DIRECTORY_RECENT_LIMIT", 50))  # Recent correspondents listed on the messaging page
+app.config['DIRECTORY_RECENT_TTL'] = float(os.getenv("DIRECTORY_RECENT_TTL", 300))  # Seconds a recent list is cached (new messages clear it)
+app.config['DIRECTORY_PAGE_SIZE'] = int(os.getenv("DIRECTORY_PAGE_SIZE", 20))  # Users per /api/directory search page
+app.config['DIRECTORY_SEARCH_TTL'] = float(os.getenv("DIRECTORY_SEARCH_TTL", 30))  # Seconds a search page is cached
+app.config['MAIL_SERVER'] = os.getenv("MAIL_SERVER", "smtp.privateemail.com")
+app.config['MAIL_PORT'] = int(os.getenv("MAIL_PORT", 587))
+app.config['MAIL_STARTTLS'] = os.getenv("MAIL_STARTTLS", "1") == "1"  # Set 0 for `flask mail-sink`
+app.config['MAIL_FROM'] = os.getenv("MAIL_FROM", EMAIL_SENDER or "noreply@localhost")
+app.config['MAIL_TIMEOUT'] = float(os.getenv("MAIL_TIMEOUT", 15))  # Seconds each SMTP command may take
+app.config['MAIL_WORKERS'] = int(os.getenv("MAIL_WORKERS", 2))  # Sender threads, each with its own SMTP connection
+app.config['MAIL_QUEUE_SIZE'] = int(os.getenv("MAIL_QUEUE_SIZE", 1000))  # Emails waiting to be sent before send_email() fails
+app.config['MAIL_RATE_LIMIT'] = float(os.getenv("MAIL_RATE_LIMIT", 5))  # Emails per second across all senders (0 = no limit)
+app.config['MAIL_MAX_ATTEMPTS'] = int(os.getenv("MAIL_MAX_ATTEMPTS", 5))  # Tries before an email goes to the dead_letter_email table
+app.config['MAIL_RETRY_BASE'] = float(os.getenv("MAIL_RETRY_BASE", 5))  # Seconds before the first retry, doubling after each failure
+app.config['MAIL_IDLE_TIMEOUT'] = float(os.getenv("MAIL_IDLE_TIMEOUT", 30))  # Seconds an unused SMTP connection is kept open
+app.config['MAIL_MAX_PER_CONNECTION'] = int(os.getenv("MAIL_MAX_PER_CONNECTION", 100))  # Emails sent before a connection is renewed
 
 # Ensure upload folders exist
 os.makedirs(app.config['PROFILE_PICS_FOLDER'], exist_ok=True)
 os.makedirs(app.config['MESSAGES_FOLDER'], exist_ok=True)
+os.makedirs(app.config['STATUS_FOLDER'], exist_ok=True)
+os.makedirs(app.config['MEDIA_ORIGINALS_FOLDER'], exist_ok=True)
+os.makedirs(app.config['UPLOAD_PARTIAL_FOLDER'], exist_ok=True)
 
 # Initialize Flask-SQLAlchemy
 db = SQLAlchemy(app)
@@ -54,16 +263,63 @@ db = SQLAlchemy(app)
 # Initialize Flask-Migrate
 migrate = Migrate(app, db)
 
+# In-process stand-in for the Socket.IO message queue (SOCKETIO_MESSAGE_QUEUE=local://). Every
+# server created in this process shares the channel, so multi-worker fan-out can be tested
+# without Redis.
+class LocalQueueManager(socketio_module.PubSubManager):
+    name = 'local'
+    channels = {}
+    channels_lock = threading.Lock()
+
+    def _publish(self, data):
+        message = json.dumps(data)
+        with self.channels_lock:
+            subscribers = list(self.channels.get(self.channel, []))
+        for subscriber in subscribers:
+            subscriber.put(message)
+
+    def _listen(self):
+        inbox = queue.Queue()
+        with self.channels_lock:
+            self.channels.setdefault(self.channel, []).append(inbox)
+        while True:
+            yield inbox.get()
+
+# Function to pick the Socket.IO client manager. With a message queue every worker publishes
+# its room emits to the queue and delivers the ones for its own sockets.
+def make_socketio_options():
+    options = {'async_mode': app.config['SOCKETIO_ASYNC_MODE'], 'channel': app.config['SOCKETIO_CHANNEL']}
+    message_queue = app.config['SOCKETIO_MESSAGE_QUEUE']
+    if message_queue and message_queue.startswith('local://'):
+        options['client_manager'] = LocalQueueManager(channel=app.config['SOCKETIO_CHANNEL'])
+    elif message_queue:
+        options['message_queue'] = message_queue
+    return options
+
 # Initialize Flask-SocketIO with explicit transport configuration
-socketio = SocketIO(app, cors_allowed_origins="*", allow_transports=['polling', 'websocket'])
+socketio = SocketIO(app, cors_allowed_origins="*", allow_transports=['polling', 'websocket'], **make_socketio_options())
 
 # Initialize Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-# AES Encryption Key (32 bytes for AES-256)
-AES_KEY = get_random_bytes(32)  # Generate a random 32-byte key for AES-256
+# Bounded pool used to fan /ask out to several models at once
+ai_executor = ThreadPoolExecutor(max_workers=app.config['AI_MAX_WORKERS'], thread_name_prefix='openrouter')
+
+# Pool that turns uploaded images into size variants, off the request thread
+media_executor = ThreadPoolExecutor(max_workers=app.config['MEDIA_WORKERS'], thread_name_prefix='media')
+
+# Under eventlet or gevent those pool threads are green threads, and CPU-bound work like PIL
+# decoding would stall every socket on the worker. Such calls go to the hub's OS thread pool.
+def run_blocking(fn, *args):
+    if app.config['SOCKETIO_ASYNC_MODE'] == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute(fn, *args)
+    if app.config['SOCKETIO_ASYNC_MODE'] == 'gevent':
+        import gevent
+        return gevent.get_hub().threadpool.apply(fn, args)
+    return fn(*args)
 
 # User model for database
 class User(UserMixin, db.Model):
@@ -76,6 +332,11 @@ class User(UserMixin, db.Model):
     is_online = db.Column(db.Boolean, default=False)
     public_username = db.Column(db.String(80), unique=True, nullable=True)  # Telegram-like username
 
+    __table_args__ = (
+        db.Index('ix_user_username_lower', db.func.lower(username)),  # Directory prefix search
+        db.Index('ix_user_public_username_lower', db.func.lower(public_username)),
+    )
+
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
 
@@ -86,11 +347,35 @@ class User(UserMixin, db.Model):
 class ChatHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), nullable=True)
     chat_name = db.Column(db.String(100), nullable=False)
     user_message = db.Column(db.Text, nullable=False)
     bot_reply = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_chat_history_user_id_chat_name_timestamp', 'user_id', 'chat_name', 'timestamp'),
+        db.Index('ix_chat_history_conversation_id_id', 'conversation_id', 'id'),
+    )
+
+# Conversation model: one row per AI chat, so the sidebar never has to scan ChatHistory.
+# It also keeps the rolling summary of the turns that fell out of the history window.
+class Conversation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    name = db.Column(db.String(100), nullable=False)
+    model = db.Column(db.String(50), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    last_activity_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    turn_count = db.Column(db.Integer, nullable=False, default=0)
+    summary = db.Column(db.Text, nullable=False, default='')
+    summarized_up_to_id = db.Column(db.Integer, nullable=False, default=0)  # Last ChatHistory.id folded into the summary
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'name', name='uq_conversation_user_id_name'),
+        db.Index('ix_conversation_user_id_last_activity_at', 'user_id', 'last_activity_at', 'id'),
+    )
+
 # Group model
 class Group(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -106,6 +391,11 @@ class GroupMember(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
 
+    __table_args__ = (
+        db.Index('ix_group_member_user_id_group_id', 'user_id', 'group_id'),
+        db.Index('ix_group_member_group_id_user_id', 'group_id', 'user_id'),
+    )
+
 # Message model for messaging app (1:1 and group chats)
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -120,6 +410,57 @@ class Message(db.Model):
     is_secret = db.Column(db.Boolean, default=False)  # For Telegram-like secret chats
     disappear_timer = db.Column(db.Integer, nullable=True)  # Signal-like disappearing messages (in seconds)
     edited = db.Column(db.Boolean, default=False)  # For Telegram-like edit feature
+    edit_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Bumped on every edit (plaintext cache key)
+    conversation_key = db.Column(db.String(40), nullable=True)  # chat_<low id>_<high id> or group_<id>, same as the Socket.IO room
+    expires_at = db.Column(db.DateTime, nullable=True)  # When a disappearing message is deleted (set from disappear_timer)
+
+    __table_args__ = (
+        db.Index('ix_message_conversation_key_timestamp', 'conversation_key', 'timestamp', 'id'),
+        db.Index('ix_message_group_id_timestamp', 'group_id', 'timestamp'),
+        db.Index('ix_message_sender_id_receiver_id', 'sender_id', 'receiver_id'),
+        db.Index('ix_message_receiver_id_sender_id', 'receiver_id', 'sender_id'),
+        db.Index('ix_message_expires_at', 'expires_at'),
+    )
+
+# ReadState model: how far each user has read each conversation. A message counts as read by a
+# user once its id is at or below their watermark, which replaces flipping Message.is_read per row.
+class ReadState(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    conversation_key = db.Column(db.String(40), nullable=False)
+    last_read_message_id = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'conversation_key', name='uq_read_state_user_id_conversation_key'),
+        db.Index('ix_read_state_conversation_key_last_read_message_id', 'conversation_key', 'last_read_message_id'),
+    )
+
+# InboxEntry model: one row per user per conversation with its last message and unread count,
+# kept up to date as messages are stored, read, edited and expired, so the sidebar is one query
+class InboxEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    conversation_key = db.Column(db.String(40), nullable=False)
+    peer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # The other user, for 1:1 chats
+    group_id = db.Column(db.Integer, db.ForeignKey('group.id'), nullable=True)
+    last_message_id = db.Column(db.Integer, nullable=False)
+    last_sender_id = db.Column(db.Integer, nullable=True)
+    last_message_type = db.Column(db.String(20), nullable=True)  # None once the last message has expired
+    preview = db.Column(db.Text, nullable=True)  # Start of the last text message, encrypted like Message.content
+    last_message_at = db.Column(db.DateTime, nullable=False)
+    unread_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'conversation_key', name='uq_inbox_entry_user_id_conversation_key'),
+        db.Index('ix_inbox_entry_user_id_last_message_at', 'user_id', 'last_message_at', 'id'),
+        db.Index('ix_inbox_entry_conversation_key_last_message_id', 'conversation_key', 'last_message_id'),
+    )
+
+# IdSequence model: hi/lo id blocks, so messages get their id before they are written
+class IdSequence(db.Model):
+    name = db.Column(db.String(40), primary_key=True)
+    next_value = db.Column(db.Integer, nullable=False)
 
 # Status model for WhatsApp-like status feature
 class Status(db.Model):
@@ -127,46 +468,245 @@ class Status(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     content = db.Column(db.String(200), nullable=True)  # Text or file path
     content_type = db.Column(db.String(20), nullable=False, default='text')  # text, image, video
+    file_path = db.Column(db.String(200), nullable=True)  # Relative to UPLOAD_FOLDER; the medium JPEG variant for images
+    media_state = db.Column(db.String(20), nullable=True)  # processing, ready or failed (None for text)
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
 
-# Create database tables and add a default user
+    user = db.relationship('User')
+
+    __table_args__ = (
+        db.Index('ix_status_user_id_timestamp', 'user_id', 'timestamp'),
+        db.Index('ix_status_timestamp', 'timestamp'),
+    )
+
+# Blob model: one stored copy of each message attachment, keyed by its SHA-256. Messages refer to
+# it by file_path; ref_count is how many do, and `flask gc-blobs` removes blobs nobody uses.
+class Blob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), unique=True, nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    file_path = db.Column(db.String(200), unique=True, nullable=False)  # Relative to UPLOAD_FOLDER
+    ref_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)  # Last upload that resolved to it
+
+# UploadSession model: a chunked upload in progress; the bytes so far are in UPLOAD_PARTIAL_FOLDER/<id>
+class UploadSession(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    filename = db.Column(db.String(200), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    received = db.Column(db.BigInteger, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+# DeadLetterEmail model: an email the sender gave up on, kept for `flask mail-requeue`
+class DeadLetterEmail(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    to_email = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)  # When send_email() was called
+    failed_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+# Bring the database schema up to date (set AUTO_MIGRATE=0 to manage it with `flask db` only)
+# and add a default user. Databases created by the old db.create_all() are stamped with the
+# baseline revision first.
+BASELINE_REVISION = '4111a7d113ae'
+
+def init_database():
+    inspector = db.inspect(db.engine)
+    tables = inspector.get_table_names()
+    if 'user' in tables and 'alembic_version' not in tables:
+        stamp(revision=BASELINE_REVISION)
+    upgrade()
+
 with app.app_context():
-    db.create_all()
-    # Add a default user if not exists
-    default_user = User.query.filter_by(username='testuser').first()
-    if not default_user:
+    if os.getenv("AUTO_MIGRATE", "1") == "1":
+        init_database()
+    # Add a default user if not exists (skipped until the schema exists)
+    schema_ready = db.inspect(db.engine).has_table('user')
+    default_user = User.query.filter_by(username='testuser').first() if schema_ready else None
+    if schema_ready and not default_user:
         default_user = User(username='testuser', email='testuser@example.com', public_username='testuser_public')
         default_user.set_password('testpassword')
         db.session.add(default_user)
         db.session.commit()
-        print("Default user 'testuser' created with password 'testpassword'")
+        logger.info("Default user 'testuser' created")
 
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
+# Correlation id for every HTTP request: taken from X-Request-ID when a proxy sets one
+@app.before_request
+def assign_request_id():
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex[:16]
+
+@app.after_request
+def add_request_id_header(response):
+    if g.get('request_id'):
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
 # Utility functions
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
+# Function to get the normalized key of a 1:1 or group conversation (also its Socket.IO room name)
+def conversation_key(user_id=None, other_user_id=None, group_id=None):
+    if group_id:
+        return f"group_{int(group_id)}"
+    low, high = sorted((int(user_id), int(other_user_id)))
+    return f"chat_{low}_{high}"
+
+# Keyset cursors for paginated lists: urlsafe base64 of "<timestamp>|<id>"
+def encode_cursor(timestamp, row_id):
+    raw = f"{timestamp.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    timestamp, row_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+    return datetime.datetime.fromisoformat(timestamp), int(row_id)
+
+# Function to check that a user takes part in a conversation, given its key
+def user_in_conversation(user_id, key):
+    kind, _, ids = key.partition('_')
+    try:
+        if kind == 'chat':
+            return int(user_id) in [int(part) for part in ids.split('_')]
+        if kind == 'group':
+            return GroupMember.query.filter_by(group_id=int(ids), user_id=user_id).first() is not None
+    except ValueError:
+        pass
+    return False
+
+# Function to move read watermarks forward. One INSERT .. ON CONFLICT for the whole batch;
+# MAX() keeps a late or duplicate ack from moving a watermark backwards.
+def advance_read_states(watermarks):
+    if not watermarks:
+        return
+    now = datetime.datetime.utcnow()
+    statement = sqlite_insert(ReadState).values([
+        {'user_id': user_id, 'conversation_key': key, 'last_read_message_id': message_id, 'updated_at': now}
+        for (user_id, key), message_id in watermarks.items()
+    ])
+    statement = statement.on_conflict_do_update(
+        index_elements=['user_id', 'conversation_key'],
+        set_={
+            'last_read_message_id': db.func.max(ReadState.last_read_message_id, statement.excluded.last_read_message_id),
+            'updated_at': statement.excluded.updated_at
+        }
+    )
+    db.session.execute(statement)
+    db.session.commit()
+
+# Function to get the read watermarks of a conversation: (mine, highest of everyone else)
+def read_watermarks(user_id, key):
+    mine = db.session.query(ReadState.last_read_message_id).filter_by(user_id=user_id, conversation_key=key).scalar()
+    others = db.session.query(db.func.max(ReadState.last_read_message_id)).filter(
+        ReadState.conversation_key == key,
+        ReadState.user_id != user_id
+    ).scalar()
+    return mine or 0, others or 0
+
+# AES keyring. Every worker loads the same keys (AES_KEYS, or the keyring file created on first
+# start), so messages stay readable across restarts, workers and nodes. Ciphertext is
+# "v2:<key id>:<base64 nonce + ciphertext + tag>" with AES-256-GCM; the key id is also the
+# associated data, so a token cannot be replayed under another key.
+class Keyring:
+    def __init__(self, keys, active_key_id):
+        if active_key_id not in keys:
+            raise ValueError(f"Active key {active_key_id} is not in the keyring")
+        self.keys = keys
+        self.active_key_id = active_key_id
+
+    def encrypt(self, plaintext):
+        nonce = get_random_bytes(12)
+        cipher = AES.new(self.keys[self.active_key_id], AES.MODE_GCM, nonce=nonce)
+        cipher.update(self.active_key_id.encode('utf-8'))
+        ciphertext, tag = cipher.encrypt_and_digest(plaintext.encode('utf-8'))
+        return f"v2:{self.active_key_id}:{base64.b64encode(nonce + ciphertext + tag).decode('ascii')}"
+
+    def decrypt(self, token):
+        if not token.startswith('v2:'):
+            return self._decrypt_legacy(token)
+        _, key_id, payload = token.split(':', 2)
+        raw = base64.b64decode(payload)
+        cipher = AES.new(self.keys[key_id], AES.MODE_GCM, nonce=raw[:12])
+        cipher.update(key_id.encode('utf-8'))
+        return cipher.decrypt_and_verify(raw[12:-16], raw[-16:]).decode('utf-8')
+
+    # Pre-keyring ciphertext: base64(iv + AES-CBC). Readable only if its key is kept as "legacy".
+    def _decrypt_legacy(self, token):
+        raw = base64.b64decode(token.encode('utf-8'))
+        cipher = AES.new(self.keys['legacy'], AES.MODE_CBC, raw[:16])
+        decrypted = cipher.decrypt(raw[16:])
+        return decrypted[:-decrypted[-1]].decode('utf-8')
+
+    def is_current(self, token):
+        return token.startswith(f"v2:{self.active_key_id}:")
+
+def parse_keys(value):
+    keys = {}
+    for entry in value.split(','):
+        key_id, _, encoded = entry.strip().partition(':')
+        keys[key_id] = base64.b64decode(encoded)
+    return keys
+
+# The keyring is written to a private temp file next to it and fsynced first, so a worker never
+# reads a partial one. exclusive links it into place (FileExistsError if another worker won);
+# otherwise it replaces the current file (rotation).
+def write_keyring_file(path, keys, active_key_id, exclusive=False):
+    data = json.dumps({
+        'active': active_key_id,
+        'keys': {key_id: base64.b64encode(key).decode('ascii') for key_id, key in keys.items()}
+    })
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.keyring-')  # Mode 0600
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if exclusive:
+            os.link(temp_path, path)
+        else:
+            os.replace(temp_path, path)
+    finally:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+
+# Function to load the keyring: AES_KEYS from the environment, else the keyring file. The first
+# process to start without either creates the file; the rest lose the link and read that one.
+def load_keyring():
+    if app.config['AES_KEYS']:
+        keys = parse_keys(app.config['AES_KEYS'])
+        return Keyring(keys, app.config['AES_ACTIVE_KEY_ID'] or list(keys)[-1])
+
+    path = app.config['AES_KEYRING_PATH']
+    if not os.path.exists(path):
+        try:
+            write_keyring_file(path, {'k1': get_random_bytes(32)}, 'k1', exclusive=True)
+            logger.info(f"Created AES keyring at {path}")
+        except FileExistsError:
+            pass
+    with open(path) as f:
+        data = json.load(f)
+    keys = {key_id: base64.b64decode(encoded) for key_id, encoded in data['keys'].items()}
+    return Keyring(keys, app.config['AES_ACTIVE_KEY_ID'] or data['active'])
+
+keyring = load_keyring()
+
 # AES Encryption and Decryption
 def encrypt_message(message):
     try:
-        # Pad the message to be a multiple of 16 bytes
-        message = message.encode('utf-8')
-        pad_length = 16 - (len(message) % 16)
-        message += bytes([pad_length] * pad_length)
-
-        # Generate a random IV (Initialization Vector)
-        iv = get_random_bytes(16)
-        cipher = AES.new(AES_KEY, AES.MODE_CBC, iv)
-
-        # Encrypt the message
-        encrypted = cipher.encrypt(message)
-        # Combine IV and encrypted message, then encode to base64
-        encrypted_message = base64.b64encode(iv + encrypted).decode('utf-8')
-        logger.info(f"Encrypted message: {message} -> {encrypted_message}")
-        return encrypted_message
+        return keyring.encrypt(message)
     except Exception as e:
         logger.error(f"Error encrypting message: {str(e)}")
         traceback.print_exc()
@@ -174,26 +714,80 @@ def encrypt_message(message):
 
 def decrypt_message(encrypted_message):
     try:
-        # Decode from base64
-        encrypted = base64.b64decode(encrypted_message.encode('utf-8'))
-        # Extract IV and encrypted message
-        iv = encrypted[:16]
-        encrypted = encrypted[16:]
-
-        # Decrypt the message
-        cipher = AES.new(AES_KEY, AES.MODE_CBC, iv)
-        decrypted = cipher.decrypt(encrypted)
-
-        # Remove padding
-        pad_length = decrypted[-1]
-        decrypted = decrypted[:-pad_length].decode('utf-8')
-        logger.info(f"Decrypted message: {encrypted_message} -> {decrypted}")
-        return decrypted
+        return keyring.decrypt(encrypted_message)
     except Exception as e:
         logger.error(f"Error decrypting message: {str(e)}")
-        traceback.print_exc()
         return "Error decrypting message"
 
+# Function to move one batch of text messages that are not on the active key onto it. Walks the
+# table by id from `after_id`; the UPDATE only applies if the row was not edited meanwhile.
+# Returns (last id seen, rows re-encrypted), or (None, 0) once the end of the table is reached.
+def reencrypt_batch(after_id, batch_size):
+    rows = db.session.query(Message.id, Message.content).filter(
+        Message.id > after_id,
+        Message.content_type == 'text',
+        Message.content.isnot(None)
+    ).order_by(Message.id.asc()).limit(batch_size).all()
+    if not rows:
+        return None, 0
+    updates = []
+    for message_id, content in rows:
+        if keyring.is_current(content):
+            continue
+        try:
+            updates.append({'message_id': message_id, 'old': content, 'new': keyring.encrypt(keyring.decrypt(content))})
+        except Exception as e:
+            logger.warning(f"Message {message_id} cannot be decrypted with the keyring, leaving it: {str(e)}")
+    if updates:
+        db.session.execute(
+            db.text("UPDATE message SET content = :new WHERE id = :message_id AND content = :old"),
+            updates
+        )
+        db.session.commit()
+    return rows[-1][0], len(updates)
+
+def reencrypt_messages(batch_size, pause=0):
+    after_id, total = 0, 0
+    while True:
+        after_id, changed = reencrypt_batch(after_id, batch_size)
+        if after_id is None:
+            return total
+        total += changed
+        if pause:
+            time.sleep(pause)
+
+def reencrypt_in_background():
+    try:
+        with app.app_context():
+            total = reencrypt_messages(app.config['AES_REENCRYPT_BATCH'], pause=0.5)
+        logger.info(f"Background re-encryption finished, {total} messages moved to key {keyring.active_key_id}")
+    except Exception as e:
+        logger.error(f"Background re-encryption stopped: {str(e)}")
+
+if app.config['AES_REENCRYPT_BACKGROUND']:
+    threading.Thread(target=reencrypt_in_background, name='reencrypt', daemon=True).start()
+
+# Key rotation: `flask rotate-key` adds a new key to the keyring file and makes it active. Restart
+# the workers to pick it up, then run `flask reencrypt-messages` (or set AES_REENCRYPT_BACKGROUND=1)
+# and `flask inbox-rebuild`.
+@app.cli.command('rotate-key')
+def rotate_key():
+    if app.config['AES_KEYS']:
+        raise click.ClickException("Keys come from AES_KEYS; add the new key there and set AES_ACTIVE_KEY_ID")
+    keys = dict(keyring.keys)
+    key_id = f"k{len(keys) + 1}"
+    while key_id in keys:
+        key_id = f"{key_id}_"
+    keys[key_id] = get_random_bytes(32)
+    write_keyring_file(app.config['AES_KEYRING_PATH'], keys, key_id)
+    print(f"Active key is now {key_id}; restart the workers, then run `flask reencrypt-messages` and `flask inbox-rebuild`")
+
+@app.cli.command('reencrypt-messages')
+@click.option('--batch-size', default=500, help='Messages per transaction.')
+def reencrypt_messages_command(batch_size):
+    total = reencrypt_messages(batch_size)
+    print(f"Re-encrypted {total} messages with key {keyring.active_key_id}")
+
 # Function to clean LaTeX formatting and convert to plain text (for AI chat)
 def clean_latex(text):
     text = re.sub(r'\\boxed\{(.*?)\}', r'\1', text)
@@ -202,6 +796,138 @@ def clean_latex(text):
     text = re.sub(r'\s+', ' ', text).strip()
     return text
 
+# Incremental version of clean_latex for streamed replies: only text up to the last
+# whitespace that isn't inside an open \\boxed{...}, \\(...\\) or \\[...\\] is cleaned and released
+LATEX_OPEN_RE = re.compile(r'\\boxed\{|\\[\[\(]')
+LATEX_CLOSE_RE = re.compile(r'\\[\]\)]')
+
+class LatexStreamCleaner:
+    max_hold = 2000  # Never hold back more than this many characters waiting for a closing bracket
+
+    def __init__(self):
+        self.buffer = ""
+        self.started = False
+        self.trailing_space = False
+
+    def _dangling_start(self, text):
+        for match in LATEX_OPEN_RE.finditer(text):
+            rest = text[match.end():]
+            closed = '}' in rest if match.group().startswith('\\boxed') else LATEX_CLOSE_RE.search(rest)
+            if not closed:
+                return match.start()
+        return None
+
+    def _clean(self, text):
+        text = re.sub(r'\\boxed\{(.*?)\}', r'\1', text)
+        text = re.sub(r'\\[\[\(](.*?)\\[\]\)]', r'\1', text)
+        text = re.sub(r'\\[a-zA-Z]+', '', text)
+        text = re.sub(r'\s+', ' ', text)
+        if not self.started or self.trailing_space:
+            text = text.lstrip()
+        if text:
+            self.started = True
+            self.trailing_space = text.endswith(' ')
+        return text
+
+    def feed(self, delta):
+        self.buffer += delta
+        cut = max(self.buffer.rfind(' '), self.buffer.rfind('\n'), self.buffer.rfind('\t')) + 1
+        dangling = self._dangling_start(self.buffer[:cut])
+        if dangling is not None and len(self.buffer) < self.max_hold:
+            cut = dangling
+        if cut <= 0:
+            return ""
+        ready, self.buffer = self.buffer[:cut], self.buffer[cut:]
+        return self._clean(ready)
+
+    def flush(self):
+        ready, self.buffer = self.buffer, ""
+        return self._clean(ready).rstrip()
+
+# Rough token count (~4 characters per token) used for the history budget
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+# Function to squeeze one old chat turn into a single summary line
+def summarize_turn(chat):
+    user_part = ' '.join(chat.user_message.split())[:120]
+    bot_part = ' '.join(chat.bot_reply.split())
+    bot_part = re.split(r'(?<=[.!?])\s', bot_part, maxsplit=1)[0][:160]
+    return f"- User asked: {user_part} | Bot said: {bot_part}"
+
+# Function to create a new AI conversation. Names are unique per user, so a clash gets a timestamp suffix.
+def create_conversation(user_id, name, model=None):
+    try:
+        conversation = Conversation(user_id=user_id, name=name, model=model)
+        db.session.add(conversation)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        conversation = Conversation(user_id=user_id, name=f"{name}_{timestamp}", model=model)
+        db.session.add(conversation)
+        db.session.commit()
+    return conversation
+
+# Function to store one AI chat turn and bump the conversation's activity in the same commit
+def record_chat_turn(conversation_id, model, user_message, bot_reply):
+    conversation = db.session.get(Conversation, conversation_id)
+    now = datetime.datetime.utcnow()
+    db.session.add(ChatHistory(
+        user_id=conversation.user_id,
+        conversation_id=conversation.id,
+        chat_name=conversation.name,
+        user_message=user_message,
+        bot_reply=bot_reply,
+        timestamp=now
+    ))
+    conversation.model = model
+    conversation.turn_count += 1
+    conversation.last_activity_at = now
+    db.session.commit()
+
+# Function to build the AI chat history context: the most recent turns that fit the token budget,
+# plus a rolling summary of everything older. Turns that leave the window are folded into the
+# stored summary once, so each request only reads a bounded number of rows.
+def build_history_context(conversation):
+    recent = ChatHistory.query.filter(
+        ChatHistory.conversation_id == conversation.id,
+        ChatHistory.id > conversation.summarized_up_to_id
+    ).order_by(ChatHistory.id.desc()).limit(app.config['AI_HISTORY_MAX_TURNS']).all()
+
+    window = []
+    budget = app.config['AI_HISTORY_TOKEN_BUDGET']
+    for chat in recent:
+        turn = f"User: {chat.user_message}\nBot: {chat.bot_reply}\n"
+        cost = estimate_tokens(turn)
+        if window and cost > budget:
+            break
+        window.append(turn)
+        budget -= cost
+    window.reverse()
+
+    # Everything unsummarized that is older than the window goes into the summary
+    if len(window) < len(recent) or len(recent) == app.config['AI_HISTORY_MAX_TURNS']:
+        window_start_id = recent[len(window) - 1].id if window else None
+        overflow = ChatHistory.query.filter(
+            ChatHistory.conversation_id == conversation.id,
+            ChatHistory.id > conversation.summarized_up_to_id,
+            ChatHistory.id < window_start_id
+        ).order_by(ChatHistory.id.asc()).all() if window_start_id else []
+        if overflow:
+            lines = conversation.summary.splitlines() + [summarize_turn(chat) for chat in overflow]
+            while len(lines) > 1 and estimate_tokens('\n'.join(lines)) > app.config['AI_SUMMARY_TOKEN_BUDGET']:
+                lines.pop(0)
+            conversation.summary = '\n'.join(lines)
+            conversation.summarized_up_to_id = overflow[-1].id
+            db.session.commit()
+
+    history_context = ""
+    if conversation.summary:
+        history_context += f"Summary of the earlier conversation:\n{conversation.summary}\n\nRecent messages:\n"
+    history_context += ''.join(window)
+    return history_context
+
 # Function to map model name to OpenRouter model (for AI chat)
 def map_model_to_openrouter(model_name):
     model_map = {
@@ -223,30 +949,833 @@ def generate_chat_name(message):
         chat_name = "Untitled Chat"
     return chat_name
 
-# Function to send email (used for verification code, username, and password reset)
-def send_email(to_email, subject, body):
+# Per-model circuit breaker: after `threshold` consecutive failures the model is skipped
+# for `reset_after` seconds, then a single trial request decides whether it closes again
+class CircuitBreaker:
+    def __init__(self, threshold, reset_after):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_after and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+    # The caller gave up (client gone) before the model answered either way
+    def release(self):
+        with self.lock:
+            self.trial_running = False
+
+# Global retry budget: every request earns `ratio` of a retry, so retries can never
+# add more than that fraction of extra load on OpenRouter while it is struggling
+class RetryBudget:
+    def __init__(self, ratio, max_tokens=10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+class OpenRouterError(requests.exceptions.RequestException):
+    pass
+
+# The caller stopped waiting (deadline passed elsewhere, or the browser went away)
+class OpenRouterStopped(OpenRouterError):
+    pass
+
+# OpenRouter client: one pooled keep-alive session shared by every /ask call
+class OpenRouterClient:
+    fallback_model = 'xai/grok'
+    retry_statuses = {429, 500, 502, 503, 504}
+
+    def __init__(self, api_key, base_url, connect_timeout, read_timeout, max_retries, retry_budget_ratio,
+                 breaker_threshold, breaker_reset_after, pool_size):
+        self.url = f"{base_url.rstrip('/')}/chat/completions"
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.budget = RetryBudget(retry_budget_ratio)
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset_after = breaker_reset_after
+        self.breakers = {}
+        self.breakers_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "https://x07.in",
+            "X-Title": "ChatGod"
+        })
+
+    def breaker(self, model):
+        with self.breakers_lock:
+            if model not in self.breakers:
+                self.breakers[model] = CircuitBreaker(self.breaker_threshold, self.breaker_reset_after)
+            return self.breakers[model]
+
+    # Seconds left before the caller's deadline (time.monotonic() value); raises once it has passed
+    @staticmethod
+    def remaining(deadline, stop=None):
+        if stop is not None and stop.is_set():
+            raise OpenRouterStopped("Request stopped by the caller")
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise OpenRouterError("Deadline passed")
+        return left
+
+    def _post(self, payload, deadline, stop):
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            # No single read may outlast the deadline; the readers check it between reads
+            left = self.remaining(deadline, stop)
+            timeout = (min(self.connect_timeout, left), left)
+            try:
+                response = self.session.post(self.url, json=payload, timeout=timeout, stream=True)
+                if response.status_code not in self.retry_statuses:
+                    return response
+                error = OpenRouterError(f"OpenRouter returned {response.status_code} for {payload['model']}: {response.text}")
+                response.close()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+            if attempt >= self.max_retries or not self.budget.withdraw():
+                raise error
+            attempt += 1
+            # Full jitter backoff: 0..(0.25 * 2^attempt) seconds, never past the deadline
+            delay = random.uniform(0, 0.25 * 2 ** attempt)
+            if delay >= deadline - time.monotonic() or (stop is not None and stop.is_set()):
+                raise error
+            time.sleep(delay)
+            logger.warning(f"Retrying {payload['model']} (attempt {attempt}) after: {str(error)}")
+
+    # Returns (response, breaker of the model that answered). The caller records the outcome on
+    # the breaker once it has read the whole body, since a stream can still fail halfway.
+    def _request(self, payload, deadline, stop):
+        # Try the requested model, then xai/grok; an open breaker skips the model without a request
+        model = payload['model']
+        last_error = None
+        for candidate in (model, self.fallback_model):
+            if time.monotonic() >= deadline or (stop is not None and stop.is_set()):
+                break
+            breaker = self.breaker(candidate)
+            if not breaker.allow():
+                logger.warning(f"Circuit open for {candidate}, skipping it")
+                last_error = OpenRouterError(f"Circuit open for {candidate}")
+                continue
+            if candidate != model:
+                logger.warning(f"Model {model} failed, falling back to {candidate}")
+            try:
+                response = self._post(dict(payload, model=candidate), deadline, stop)
+            except OpenRouterStopped:
+                breaker.release()
+                raise
+            except requests.exceptions.RequestException as e:
+                breaker.record_failure()
+                last_error = e
+                continue
+            if response.status_code == 200:
+                return response, breaker
+            breaker.record_failure()
+            last_error = OpenRouterError(f"Request to {candidate} failed with status {response.status_code}: {response.text}")
+            response.close()
+        raise last_error or OpenRouterError(f"Deadline passed before {model} was tried")
+
+    # Body bytes as they arrive. read1() returns whatever the socket has instead of waiting for a
+    # full chunk, so a reply trickling in is still cut off at the deadline or when stop is set.
+    def _chunks(self, response, deadline, stop):
+        while True:
+            self.remaining(deadline, stop)
+            chunk = response.raw.read1(16384, decode_content=True)
+            if not chunk:
+                return
+            yield chunk
+
+    # Records how reading a response went: a failure for errors and missed deadlines, nothing
+    # when the caller stopped (or closed the stream) before the model could answer
+    @staticmethod
+    @contextlib.contextmanager
+    def outcome(breaker):
+        try:
+            yield
+        except OpenRouterStopped:
+            breaker.release()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record_success()
+
+    def complete(self, mapped_model, system_prompt, user_message, deadline=None, stop=None):
+        deadline = deadline or time.monotonic() + self.read_timeout
+        payload = {
+            "model": mapped_model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_message}
+            ],
+            "temperature": 0.7,
+            "max_tokens": 500
+        }
+        logger.debug("Sending request to OpenRouter API for model %s", mapped_model)
+        response, breaker = self._request(payload, deadline, stop)
+        with self.outcome(breaker), response:
+            result = json.loads(b''.join(self._chunks(response, deadline, stop)))
+            if 'choices' not in result or not result['choices']:
+                raise ValueError("No choices in API response")
+        logger.debug("OpenRouter API response for model %s: usage %s", mapped_model, result.get('usage'))
+        return clean_latex(result['choices'][0]['message']['content'])
+
+    def stream(self, mapped_model, system_prompt, user_message, deadline=None, stop=None):
+        deadline = deadline or time.monotonic() + self.read_timeout
+        payload = {
+            "model": mapped_model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_message}
+            ],
+            "temperature": 0.7,
+            "max_tokens": 500,
+            "stream": True
+        }
+        logger.debug("Opening stream to OpenRouter API for model %s", mapped_model)
+        response, breaker = self._request(payload, deadline, stop)
+        with self.outcome(breaker), response:
+            buffer = b''
+            for chunk in self._chunks(response, deadline, stop):
+                *lines, buffer = (buffer + chunk).split(b'\n')
+                for line in lines:
+                    line = line.decode('utf-8').rstrip('\r')
+                    # OpenRouter sends ": OPENROUTER PROCESSING" keep-alive comments between chunks
+                    if not line or not line.startswith('data: '):
+                        continue
+                    data = line[len('data: '):]
+                    if data == '[DONE]':
+                        return
+                    event = json.loads(data)
+                    if 'error' in event:
+                        raise OpenRouterError(f"Stream error from {mapped_model}: {event['error']}")
+                    for choice in event.get('choices', []):
+                        delta = choice.get('delta', {}).get('content')
+                        if delta:
+                            yield delta
+            raise OpenRouterError(f"Stream from {mapped_model} ended before [DONE]")
+
+openrouter = OpenRouterClient(
+    api_key=OPENROUTER_API_KEY,
+    base_url=app.config['OPENROUTER_BASE_URL'],
+    connect_timeout=app.config['OPENROUTER_CONNECT_TIMEOUT'],
+    read_timeout=app.config['AI_MODEL_DEADLINE'],
+    max_retries=app.config['OPENROUTER_MAX_RETRIES'],
+    retry_budget_ratio=app.config['OPENROUTER_RETRY_BUDGET_RATIO'],
+    breaker_threshold=app.config['OPENROUTER_BREAKER_THRESHOLD'],
+    breaker_reset_after=app.config['OPENROUTER_BREAKER_RESET'],
+    pool_size=app.config['AI_MAX_WORKERS']
+)
+
+# Completion cache backends: both evict least-recently-used entries past max_size and expire after ttl
+class MemoryCacheBackend:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.time() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+class DiskCacheBackend:
+    def __init__(self, path, max_size, ttl):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS completion_cache "
+                         "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_completion_cache_accessed_at ON completion_cache (accessed_at)")
+
+    # One transaction on a fresh connection, closed afterwards (sqlite3's own context manager only commits)
+    @contextlib.contextmanager
+    def _connect(self):
+        with contextlib.closing(sqlite3.connect(self.path, timeout=5)) as conn, conn:
+            yield conn
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM completion_cache WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE completion_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def set(self, key, value):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO completion_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                         (key, value, now + self.ttl, now))
+            conn.execute("DELETE FROM completion_cache WHERE expires_at <= ?", (now,))
+            conn.execute("DELETE FROM completion_cache WHERE key IN (SELECT key FROM completion_cache "
+                         "ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)", (self.max_size,))
+
+# Completion cache with single-flight: concurrent misses for the same key share one upstream call
+class CompletionCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(mapped_model, mode, system_prompt, user_message):
+        prompt_digest = hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()
+        return hashlib.sha256(json.dumps([mapped_model, mode, prompt_digest, user_message]).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        if self.backend is None:
+            return None
+        value = self.backend.get(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if self.backend is not None:
+            self.backend.set(key, value)
+
+    # Registers a miss: (new future, True) for the caller that has to fetch the value and then
+    # resolve() it, (the leader's future, False) for everyone asking while that is in flight
+    def claim(self, key):
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is None:
+                future = self.inflight[key] = Future()
+                return future, True
+            self.coalesced += 1
+            return future, False
+
+    def resolve(self, key, value=None, error=None):
+        if error is None:
+            self.set(key, value)
+        with self.lock:
+            future = self.inflight.pop(key, None)
+        if future is None:
+            return
+        if error is None:
+            future.set_result(value)
+        else:
+            future.set_exception(error)
+
+    # Followers wait at most timeout seconds. The leader always releases the key, even when it
+    # dies of something that is not an Exception (GeneratorExit, a gevent Timeout).
+    def get_or_compute(self, key, compute, timeout=None):
+        if self.backend is None:
+            return compute()
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        future, leader = self.claim(key)
+        if not leader:
+            return future.result(timeout)
+        error = OpenRouterStopped("The request computing this reply stopped")
+        try:
+            value = compute()
+            error = None
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.resolve(key, value, error)
+        return value
+
+    # For streamed replies: the cached value, or None when the caller should stream it and then
+    # resolve() the key. Misses while another caller streams the same prompt wait for its reply.
+    def get_or_lead(self, key, timeout=None):
+        if self.backend is None:
+            return None
+        value = self.get(key)
+        while value is None:
+            future, leader = self.claim(key)
+            if leader:
+                return None
+            try:
+                value = future.result(timeout)
+            except OpenRouterStopped:
+                continue  # The leader's browser went away before the reply was complete
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {
+                'backend': app.config['AI_CACHE_BACKEND'],
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'inflight': len(self.inflight)
+            }
+
+def make_completion_cache_backend():
+    backend = app.config['AI_CACHE_BACKEND']
+    if backend == 'memory':
+        return MemoryCacheBackend(app.config['AI_CACHE_SIZE'], app.config['AI_CACHE_TTL'])
+    if backend == 'disk':
+        return DiskCacheBackend(app.config['AI_CACHE_PATH'], app.config['AI_CACHE_SIZE'], app.config['AI_CACHE_TTL'])
+    return None
+
+completion_cache = CompletionCache(make_completion_cache_backend())
+
+# Function to get one model's reply, served from the completion cache when the same prompt was seen before
+def cached_completion(mapped_model, mode, system_prompt, user_message, deadline, stop):
+    key = CompletionCache.make_key(mapped_model, mode, system_prompt, user_message)
+    return completion_cache.get_or_compute(
+        key, lambda: openrouter.complete(mapped_model, system_prompt, user_message, deadline, stop),
+        timeout=max(deadline - time.monotonic(), 0)
+    )
+
+# Function to relay every model's stream to the browser as Server-Sent Events
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def stream_ask_reply(prompts, mode, user_message, conversation_id, model_name):
+    deadline = app.config['AI_MODEL_DEADLINE']
+    deadline_at = time.monotonic() + deadline
+    stop = threading.Event()  # Set when the reply is over, so producers still running let go of their pool slot
+    events = queue.Queue()
+    cache_keys = [CompletionCache.make_key(mapped_model, mode, system_prompt, user_message)
+                  for model, mapped_model, system_prompt in prompts]
+
+    def produce(index, mapped_model, system_prompt):
+        key = cache_keys[index]
+        try:
+            cached = completion_cache.get_or_lead(key, max(deadline_at - time.monotonic(), 0))
+            if cached is not None:
+                events.put((index, 'delta', cached))
+            else:
+                parts = []
+                reply, error = None, OpenRouterStopped("The request streaming this reply stopped")
+                try:
+                    for delta in openrouter.stream(mapped_model, system_prompt, user_message, deadline_at, stop):
+                        parts.append(delta)
+                        events.put((index, 'delta', delta))
+                    reply, error = clean_latex(''.join(parts)), None
+                except Exception as e:
+                    error = e
+                    raise
+                finally:
+                    completion_cache.resolve(key, reply, error)
+            events.put((index, 'done', None))
+        except Exception as e:
+            events.put((index, 'error', e))
+
+    for index, (model, mapped_model, system_prompt) in enumerate(prompts):
+        ai_executor.submit(produce, index, mapped_model, system_prompt)
+
+    cleaners = [LatexStreamCleaner() for _ in prompts]
+    replies = [""] * len(prompts)
+    finished = [False] * len(prompts)
+    errors = []
     try:
-        msg = MIMEMultipart()
-        msg['From'] = EMAIL_SENDER
-        msg['To'] = to_email
-        msg['Subject'] = subject
+        while not all(finished):
+            try:
+                index, kind, value = events.get(timeout=max(deadline_at - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            model = prompts[index][0]
+            if kind == 'delta':
+                text = cleaners[index].feed(value)
+            elif kind == 'done':
+                text = cleaners[index].flush()
+                finished[index] = True
+            else:
+                logger.error(f"Model {model} failed while streaming: {str(value)}")
+                text = f"({model} failed to reply: {str(value)})"
+                errors.append(value)
+                finished[index] = True
+            if text:
+                replies[index] += text
+                yield sse_event('delta', {'index': index, 'model': model, 'text': text})
 
-        msg.attach(MIMEText(body, 'plain'))
+        for index, done in enumerate(finished):
+            if not done:
+                model = prompts[index][0]
+                logger.warning(f"Model {model} missed the {deadline}s deadline while streaming, returning partial reply")
+                text = cleaners[index].flush() + f" ({model} is taking too long to reply, bhai. Try again in a bit! ⏳)"
+                replies[index] += text
+                yield sse_event('delta', {'index': index, 'model': model, 'text': text})
 
-        server = smtplib.SMTP('smtp.privateemail.com', 587)
-        server.starttls()
-        server.login(EMAIL_SENDER, EMAIL_PASSWORD)
-        text = msg.as_string()
-        server.sendmail(EMAIL_SENDER, to_email, text)
-        server.quit()
-        logger.info(f"Email sent to {to_email}")
-    except Exception as e:
-        logger.error(f"Error sending email: {str(e)}")
+        bot_reply = "\n".join(reply.strip() for reply in replies).strip()
+        # As in the non-stream path: every model failed is an error, and so is no model finishing
+        if errors and len(errors) == len(prompts):
+            yield sse_event('error', {'reply': f"Bhosdike, kuch galat ho gaya! 😅 Error: {str(errors[0])}"})
+            return
+        if sum(finished) == len(errors):
+            yield sse_event('error', {'reply': bot_reply})
+            return
+
+        # Store the turn only once every stream has finished
+        record_chat_turn(conversation_id, model_name, user_message, bot_reply)
+        logger.debug("Successfully streamed bot reply")
+        yield sse_event('done', {'reply': bot_reply})
+    finally:
+        # Streams past the deadline, or all of them once the browser has gone, stop reading
+        stop.set()
+
+# Outbound email: send_email() puts the message on a queue and returns at once. MAIL_WORKERS sender
+# threads each keep one authenticated SMTP connection and reuse it until it has been idle for
+# MAIL_IDLE_TIMEOUT or has sent MAIL_MAX_PER_CONNECTION emails. All senders share one token bucket
+# (MAIL_RATE_LIMIT per second). Temporary failures (4xx replies, dropped connections) are retried
+# with jittered exponential backoff; permanent ones (5xx) and emails that run out of attempts are
+# stored in dead_letter_email, as is anything still unsent at shutdown.
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Blocks until a token is free
+    def take(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def open_smtp_connection():
+    server = smtplib.SMTP(app.config['MAIL_SERVER'], app.config['MAIL_PORT'], timeout=app.config['MAIL_TIMEOUT'])
+    try:
+        if app.config['MAIL_STARTTLS']:
+            server.starttls()
+        if EMAIL_PASSWORD:
+            server.login(EMAIL_SENDER, EMAIL_PASSWORD)
+    except Exception:
+        server.close()
         raise
+    return server
+
+# One sender thread's SMTP connection
+class SmtpConnection:
+    def __init__(self, connect, idle_timeout, max_sent):
+        self.connect = connect
+        self.idle_timeout = idle_timeout
+        self.max_sent = max_sent
+        self.server = None
+        self.sent = 0
+        self.last_used = 0
+
+    def stale(self):
+        return self.server is not None and (
+            self.sent >= self.max_sent or time.monotonic() - self.last_used >= self.idle_timeout)
+
+    def send(self, from_addr, to_addr, text):
+        # The server may have dropped a reused connection; that costs a reconnect, not an attempt
+        if self.server is not None:
+            try:
+                return self._send(from_addr, to_addr, text)
+            except smtplib.SMTPServerDisconnected:
+                self.close()
+        self.server = self.connect()
+        self.sent = 0
+        self.last_used = time.monotonic()
+        self._send(from_addr, to_addr, text)
+
+    def _send(self, from_addr, to_addr, text):
+        self.server.sendmail(from_addr, to_addr, text)
+        self.sent += 1
+        self.last_used = time.monotonic()
+
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+        self.server = None
+
+class MailSender:
+    # Refusals that leave the SMTP session usable (smtplib sends RSET after them)
+    session_errors = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+    def __init__(self, workers, max_queue, max_attempts, retry_base, idle_timeout, max_per_connection,
+                 rate_limit, connect=open_smtp_connection):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.idle_timeout = idle_timeout
+        self.max_per_connection = max_per_connection
+        self.bucket = TokenBucket(rate_limit)
+        self.connect = connect
+        self.retries = []  # Heap of (due, sequence, mail)
+        self.sequence = itertools.count()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, to_email, subject, body, block=False):
+        self._ensure_started()
+        mail = {'to': to_email, 'subject': subject, 'body': body, 'attempts': 0, 'last_error': None,
+                'created_at': datetime.datetime.utcnow()}
+        try:
+            self.queue.put(mail, block=block)
+        except queue.Full:
+            raise RuntimeError('Too many emails waiting to be sent, try again in a minute') from None
+
+    # Sends everything already queued, waiting at most timeout seconds; pending retries and anything
+    # left on the queue go to dead_letter_email
+    def close(self, timeout=10):
+        with self.lock:
+            threads, self.threads = self.threads, []
+        if not threads:
+            return
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for _ in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        with self.lock:
+            unsent = [mail for _, _, mail in self.retries]
+            self.retries = []
+        while True:
+            try:
+                mail = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if mail is not None:
+                unsent.append(mail)
+        if unsent:
+            for mail in unsent:
+                mail['last_error'] = mail['last_error'] or 'Not sent before shutdown'
+            self._dead_letter(unsent)
+
+    def _ensure_started(self):
+        with self.lock:
+            if not self.threads:
+                for number in range(self.workers):
+                    thread = threading.Thread(target=self._run, name=f'mail-sender-{number}', daemon=True)
+                    thread.start()
+                    self.threads.append(thread)
+
+    # The next queued or due email, None on timeout, or 'stop'
+    def _next(self, idle):
+        with self.lock:
+            if self.retries and self.retries[0][0] <= time.monotonic():
+                return heapq.heappop(self.retries)[2]
+            wait = min(self.retries[0][0] - time.monotonic(), idle) if self.retries else idle
+        try:
+            mail = self.queue.get(timeout=max(wait, 0.01))
+        except queue.Empty:
+            return None
+        return 'stop' if mail is None else mail
+
+    def _run(self):
+        connection = SmtpConnection(self.connect, self.idle_timeout, self.max_per_connection)
+        with app.app_context():
+            while True:
+                mail = self._next(self.idle_timeout)
+                if connection.stale():
+                    connection.close()
+                if mail is None:
+                    continue
+                if mail == 'stop':
+                    connection.close()
+                    return
+                self.bucket.take()
+                try:
+                    connection.send(app.config['MAIL_FROM'], mail['to'], self._render(mail))
+                    logger.info(f"Email sent to {mail['to']}")
+                except Exception as e:
+                    if not isinstance(e, self.session_errors):
+                        connection.close()
+                    self._failed(mail, e)
+
+    @staticmethod
+    def _render(mail):
+        msg = MIMEMultipart()
+        msg['From'] = app.config['MAIL_FROM']
+        msg['To'] = mail['to']
+        msg['Subject'] = mail['subject']
+        msg.attach(MIMEText(mail['body'], 'plain'))
+        return msg.as_string()
+
+    @staticmethod
+    def is_permanent(error):
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return all(code >= 500 for code, _ in error.recipients.values())
+        if isinstance(error, smtplib.SMTPAuthenticationError):
+            return False  # Fixed in configuration, not per email; retry until attempts run out
+        return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+    def _failed(self, mail, error):
+        mail['attempts'] += 1
+        mail['last_error'] = str(error)[:1000]
+        if self.is_permanent(error) or mail['attempts'] >= self.max_attempts:
+            logger.error(f"Giving up on email to {mail['to']} after {mail['attempts']} attempts: {mail['last_error']}")
+            self._dead_letter([mail])
+            return
+        delay = random.uniform(0.5, 1) * self.retry_base * 2 ** (mail['attempts'] - 1)
+        logger.warning(f"Email to {mail['to']} failed (attempt {mail['attempts']}), retrying in {delay:.0f}s: {mail['last_error']}")
+        with self.lock:
+            heapq.heappush(self.retries, (time.monotonic() + delay, next(self.sequence), mail))
+
+    def _dead_letter(self, mails):
+        try:
+            with app.app_context():
+                with db.engine.begin() as conn:
+                    conn.execute(db.insert(DeadLetterEmail), [{
+                        'to_email': mail['to'], 'subject': mail['subject'], 'body': mail['body'],
+                        'attempts': mail['attempts'], 'last_error': mail['last_error'],
+                        'created_at': mail['created_at'], 'failed_at': datetime.datetime.utcnow()
+                    } for mail in mails])
+        except Exception as e:
+            logger.error(f"Could not store {len(mails)} undeliverable emails: {str(e)}")
+
+mail_sender = MailSender(
+    app.config['MAIL_WORKERS'],
+    app.config['MAIL_QUEUE_SIZE'],
+    app.config['MAIL_MAX_ATTEMPTS'],
+    app.config['MAIL_RETRY_BASE'],
+    app.config['MAIL_IDLE_TIMEOUT'],
+    app.config['MAIL_MAX_PER_CONNECTION'],
+    app.config['MAIL_RATE_LIMIT']
+)
+atexit.register(mail_sender.close)
+
+# Function to send email (used for verification code, username, and password reset); raises
+# RuntimeError when the sender is too far behind
+def send_email(to_email, subject, body):
+    mail_sender.submit(to_email, subject, body)
+
+# Local SMTP stand-in for development and `flask bench-mail`: accepts every message (and any
+# AUTH) and passes it to on_message. Run it with `flask mail-sink` and set MAIL_SERVER=localhost,
+# MAIL_PORT=1025, MAIL_STARTTLS=0.
+class SmtpSinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, *lines):
+        self.wfile.write(''.join(f'{line}\r\n' for line in lines).encode())
+
+    def handle(self):
+        time.sleep(self.server.connect_delay)
+        self.reply('220 localhost ESMTP sink')
+        mail_from, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command[:4].upper()
+            if verb == 'EHLO':
+                self.reply('250-localhost', '250-AUTH PLAIN LOGIN', '250 8BITMIME')
+            elif verb in ('HELO', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'AUTH':
+                self.reply('235 2.7.0 Authentication successful')
+            elif verb == 'MAIL':
+                mail_from, recipients = command.partition(':')[2].strip(), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command.partition(':')[2].strip())
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for line in self.rfile:
+                    if line in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(line[1:] if line.startswith(b'..') else line)
+                self.server.on_message(mail_from, recipients, b''.join(data))
+                self.reply('250 OK')
+            elif verb == 'RSET':
+                mail_from, recipients = None, []
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, on_message, connect_delay=0):
+        self.on_message = on_message
+        self.connect_delay = connect_delay  # Stands in for the TLS handshake and login of a real server
+        super().__init__(address, SmtpSinkHandler)
 
 @app.route('/')
 def index():
-    print("Rendering index.html for home page")
     return render_template('index.html')
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -313,23 +1842,15 @@ def login():
         if step == 'login':
             username = request.form['username']
             password = request.form['password']
-            print(f"Login attempt with username: {username}, password: {password}")
             user = User.query.filter_by(username=username).first()
-            
-            if user:
-                print(f"User found: {user.username}")
-            else:
-                print("User not found!")
             if user and user.check_password(password):
                 login_user(user)
-                user.is_online = True
-                user.last_seen = datetime.datetime.utcnow()
-                db.session.commit()
-                print(f"User {username} logged in successfully!")
+                presence.touch(user.id, True)
+                logger.info(f"User {user.id} logged in")
                 flash('Logged in successfully!', 'success')
                 return redirect(url_for('index'))
             else:
-                print("Invalid credentials!")
+                logger.info("Login failed: invalid credentials")
                 flash('Invalid username or password.', 'error')
                 return redirect(url_for('login'))
         
@@ -394,9 +1915,7 @@ def login():
 @app.route('/logout')
 @login_required
 def logout():
-    current_user.is_online = False
-    current_user.last_seen = datetime.datetime.utcnow()
-    db.session.commit()
+    presence.touch(current_user.id, False)
     logout_user()
     flash('Logged out successfully!', 'success')
     return redirect(url_for('index'))
@@ -405,7 +1924,7 @@ def logout():
 @app.route('/ai_chat')
 @login_required
 def ai_chat():
-    logger.info("Serving AI chat page")
+    logger.debug("Serving AI chat page")
     if 'current_chat_name' not in session:
         session['current_chat_name'] = f"Chat_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
         session['reset_history'] = True
@@ -432,6 +1951,7 @@ def delete_history():
     try:
         logger.info(f"Deleting chat history for user {current_user.id}")
         ChatHistory.query.filter_by(user_id=current_user.id).delete()
+        Conversation.query.filter_by(user_id=current_user.id).delete()
         db.session.commit()
         session.pop('current_chat_name', None)
         session.pop('reset_history', None)
@@ -449,10 +1969,38 @@ def delete_history():
 def get_chat_history():
     try:
         logger.info(f"Fetching chat history for user {current_user.id}")
-        chats = db.session.query(ChatHistory.chat_name).filter_by(user_id=current_user.id).distinct().all()
-        chat_names = [chat[0] for chat in chats]
-        logger.info(f"Chat names fetched: {chat_names}")
-        return jsonify({'chat_names': chat_names})
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+        before = request.args.get('before')
+
+        # Most recently active first, straight off ix_conversation_user_id_last_activity_at
+        query = Conversation.query.filter(Conversation.user_id == current_user.id, Conversation.turn_count > 0)
+        if before:
+            try:
+                last_activity_at, conversation_id = decode_cursor(before)
+            except (ValueError, UnicodeDecodeError):
+                return jsonify({'error': 'Invalid cursor'}), 400
+            query = query.filter(db.or_(
+                Conversation.last_activity_at < last_activity_at,
+                db.and_(Conversation.last_activity_at == last_activity_at, Conversation.id < conversation_id)
+            ))
+        page = query.order_by(Conversation.last_activity_at.desc(), Conversation.id.desc()).limit(limit + 1).all()
+        has_more = len(page) > limit
+        page = page[:limit]
+
+        chat_names = [conversation.name for conversation in page]
+        logger.debug("Chat list page for user %s: %d chats", current_user.id, len(chat_names))
+        return jsonify({
+            'chat_names': chat_names,
+            'conversations': [{
+                'id': conversation.id,
+                'name': conversation.name,
+                'model': conversation.model,
+                'turn_count': conversation.turn_count,
+                'last_activity_at': conversation.last_activity_at.strftime('%Y-%m-%d %H:%M:%S')
+            } for conversation in page],
+            'next_cursor': encode_cursor(page[-1].last_activity_at, page[-1].id) if has_more else None,
+            'has_more': has_more
+        })
     except Exception as e:
         logger.error(f"Error fetching chat history: {str(e)}")
         return jsonify({'error': 'Error fetching chat history'}), 500
@@ -462,11 +2010,12 @@ def get_chat_history():
 def load_chat(chat_name):
     try:
         logger.info(f"Loading chat {chat_name} for user {current_user.id}")
-        chat_history = ChatHistory.query.filter_by(user_id=current_user.id, chat_name=chat_name).order_by(ChatHistory.timestamp.asc()).all()
+        conversation = Conversation.query.filter_by(user_id=current_user.id, name=chat_name).first()
+        chat_history = ChatHistory.query.filter_by(conversation_id=conversation.id).order_by(ChatHistory.id.asc()).all() if conversation else []
         history = [{'user': chat.user_message, 'bot': chat.bot_reply} for chat in chat_history]
         session['current_chat_name'] = chat_name
         session['reset_history'] = False
-        logger.info(f"Chat history loaded: {history}")
+        logger.debug("Chat %s loaded: %d turns", chat_name, len(history))
         return jsonify({'history': history})
     except Exception as e:
         logger.error(f"Error loading chat: {str(e)}")
@@ -476,7 +2025,7 @@ def load_chat(chat_name):
 @login_required
 def ask():
     try:
-        logger.info("Received request at /ask endpoint")
+        logger.debug("Received request at /ask endpoint")
         data = request.get_json()
         if data is None:
             logger.error("No JSON data found in request")
@@ -486,9 +2035,7 @@ def ask():
         mode = data.get('mode', 'Normal')
         models = data.get('models', ['Grok'])
 
-        logger.debug(f"User message: {user_message}")
-        logger.debug(f"Mode: {mode}")
-        logger.debug(f"Models received: {models}")
+        logger.debug("Ask: %d chars, mode %s, models %s", len(user_message or ''), mode, models)
 
         if not user_message:
             logger.error("No message provided in request")
@@ -504,39 +2051,23 @@ def ask():
             session['reset_history'] = True
             logger.info(f"Model switched to {new_model}, resetting history")
 
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": "https://x07.in",
-            "X-Title": "ChatGod"
-        }
-        logger.debug(f"Headers: {headers}")
+        current_chat_name = session.get('current_chat_name', f"Chat_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}")
+        conversation = Conversation.query.filter_by(user_id=current_user.id, name=current_chat_name).first()
 
         history_context = ""
         if not session.get('reset_history', False):
-            current_chat_name = session.get('current_chat_name')
-            if current_chat_name:
-                chat_history = ChatHistory.query.filter_by(
-                    user_id=current_user.id,
-                    chat_name=current_chat_name
-                ).order_by(ChatHistory.timestamp.asc()).all()
-                for chat in chat_history:
-                    history_context += f"User: {chat.user_message}\nBot: {chat.bot_reply}\n"
+            if conversation:
+                history_context = build_history_context(conversation)
         else:
             session['reset_history'] = False
             logger.info("History reset for new chat or model switch")
 
-        current_chat_name = session.get('current_chat_name', f"Chat_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}")
-        chat_exists = ChatHistory.query.filter_by(user_id=current_user.id, chat_name=current_chat_name).first()
-
-        if not chat_exists and current_chat_name.startswith("Chat_"):
-            new_chat_name = generate_chat_name(user_message)
-            existing_chat = ChatHistory.query.filter_by(user_id=current_user.id, chat_name=new_chat_name).first()
-            if existing_chat:
-                timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-                new_chat_name = f"{new_chat_name}_{timestamp}"
-            session['current_chat_name'] = new_chat_name
-            current_chat_name = new_chat_name
+        if conversation is None:
+            if current_chat_name.startswith("Chat_"):
+                current_chat_name = generate_chat_name(user_message)
+            conversation = create_conversation(current_user.id, current_chat_name, new_model)
+            session['current_chat_name'] = conversation.name
+            current_chat_name = conversation.name
             logger.info(f"Updated chat name to: {current_chat_name}")
 
         base_instructions = (
@@ -565,25 +2096,22 @@ def ask():
         custom_instructions = {
             'Normal': (
                 "You are ChatGod, a friendly and witty AI with a desi vibe. "
-                "Focus on giving simple and fun answers with a casual tone. "
-                "Here is the user's chat history to provide context:\n" + history_context
+                "Focus on giving simple and fun answers with a casual tone."
             ),
             'Pro': (
                 "You are ChatGod, a knowledgeable AI who gives detailed and accurate answers. "
-                "Focus on explaining things thoroughly but keep it simple,no abusive bad words and engaging. "
-                "Here is the user's chat history to provide context:\n" + history_context
+                "Focus on explaining things thoroughly but keep it simple,no abusive bad words and engaging."
             ),
             'Fun': (
                 "You are ChatGod, a dark-humored AI who roasts and uses gandi-gandi gaali in answers. "
-                "Keep it max 4-5 lines, use lots of roasting, and add emojis for fun. "
-                "Here is the user's chat history to provide context:\n" + history_context
+                "Keep it max 4-5 lines, use lots of roasting, and add emojis for fun."
             )
         }
 
-        bot_reply = ""
-        for i, model in enumerate(models):
+        prompts = []
+        for model in models:
             mapped_model = map_model_to_openrouter(model)
-            logger.debug(f"Using model: {mapped_model} (original: {model})")
+            logger.debug("Using model: %s (original: %s)", mapped_model, model)
 
             mode_instruction = custom_instructions.get(mode, custom_instructions['Normal'])
             model_tone = model_instructions.get(model, "Act like a friendly and witty AI with a desi vibe. 😎")
@@ -592,132 +2120,675 @@ def ask():
                 f"{model_tone}\n"
                 f"{base_instructions}"
             )
+            prompts.append((model, mapped_model, system_prompt))
 
-            data = {
-                "model": mapped_model,
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message}
-                ],
-                "temperature": 0.7,
-                "max_tokens": 500
-            }
-            logger.debug(f"Request data for model {mapped_model}: {data}")
-
-            logger.debug(f"Sending request to OpenRouter API for model {mapped_model}")
-            response = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=data)
-            logger.debug(f"Response status for model {mapped_model}: {response.status_code}")
-            logger.debug(f"Raw response for model {mapped_model}: {response.text}")
+        if data.get('stream'):
+            return Response(
+                stream_with_context(stream_ask_reply(prompts, mode, user_message, conversation.id, new_model)),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
 
-            if response.status_code != 200:
-                logger.warning(f"Model {mapped_model} failed with status {response.status_code}, falling back to xai/grok")
-                data['model'] = 'xai/grok'
-                response = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=data)
-                logger.debug(f"Fallback response status: {response.status_code}")
-                logger.debug(f"Fallback raw response: {response.text}")
-                if response.status_code != 200:
-                    raise requests.exceptions.RequestException(f"Fallback request failed with status {response.status_code}: {response.text}")
+        # Send every selected model at once; the reply keeps the order the models were picked in
+        deadline = app.config['AI_MODEL_DEADLINE']
+        deadline_at = time.monotonic() + deadline
+        stop = threading.Event()
+        futures = [
+            ai_executor.submit(cached_completion, mapped_model, mode, system_prompt, user_message, deadline_at, stop)
+            for model, mapped_model, system_prompt in prompts
+        ]
 
-            result = response.json()
-            logger.debug(f"OpenRouter API response for model {mapped_model}: {result}")
+        wait(futures, timeout=deadline)
+        # cancel() only drops calls that have not started; running ones check stop between reads
+        stop.set()
 
-            if 'choices' not in result or not result['choices']:
-                raise ValueError("No choices in API response")
+        bot_reply = ""
+        errors = []
+        replied = 0
+        for model, future in zip(models, futures):
+            if not future.done():
+                future.cancel()
+                logger.warning(f"Model {model} missed the {deadline}s deadline, returning partial reply")
+                bot_reply += f"({model} is taking too long to reply, bhai. Try again in a bit! ⏳)\n"
+                continue
+            try:
+                bot_reply += future.result() + "\n"
+                replied += 1
+            except Exception as e:
+                logger.error(f"Model {model} failed: {str(e)}")
+                errors.append(e)
+                bot_reply += f"({model} failed to reply: {str(e)})\n"
 
-            model_reply = result['choices'][0]['message']['content']
-            model_reply = clean_latex(model_reply)
-            bot_reply += model_reply + "\n"
+        # Same as before for a single model: if nothing came back, the request fails
+        if errors and len(errors) == len(models):
+            raise errors[0]
+        if not replied:
+            return jsonify({'reply': bot_reply.strip()}), 504
 
-        chat_entry = ChatHistory(
-            user_id=current_user.id,
-            chat_name=current_chat_name,
-            user_message=user_message,
-            bot_reply=bot_reply.strip()
-        )
-        db.session.add(chat_entry)
-        db.session.commit()
+        record_chat_turn(conversation.id, new_model, user_message, bot_reply.strip())
 
-        logger.info("Successfully got bot reply")
+        logger.debug("Successfully got bot reply")
         return jsonify({'reply': bot_reply.strip()})
     except Exception as e:
         logger.error(f"Error in /ask endpoint: {str(e)}")
         return jsonify({'reply': f"Bhosdike, kuch galat ho gaya! 😅 Error: {str(e)}"}), 500
 
-# Messaging App Routes
-@app.route('/messaging', methods=['GET', 'POST'])
+@app.route('/ai_cache_stats', methods=['GET'])
 @login_required
-def messaging():
-    users = User.query.filter(User.id != current_user.id).all()
-    groups = Group.query.join(GroupMember, GroupMember.group_id == Group.id).filter(GroupMember.user_id == current_user.id).all()
-    selected_user_id = request.args.get('user_id')
-    selected_group_id = request.args.get('group_id')
-    messages = []
-    selected_user = None
+def ai_cache_stats():
+    return jsonify(completion_cache.stats())
+
+# Inbox: the sidebar's conversations, newest first. Every participant has an InboxEntry per
+# conversation. The message writer upserts them in the same transaction as the messages (group
+# messages fan out to every member), read acks and expiry recount unread messages from the read
+# watermarks, and edits of a last message refresh its preview. Each changed entry is pushed whole
+# to its owner's user_<id> room as an inbox_updated event.
+MEDIA_PREVIEWS = {'image': '📷 Photo', 'video': '🎥 Video'}
+
+class Inbox:
+    latest_columns = ('last_message_id', 'last_sender_id', 'last_message_type', 'preview', 'last_message_at')
+
+    def __init__(self, page_size, preview_chars):
+        self.page_size = page_size
+        self.preview_chars = preview_chars
+
+    # Previews are encrypted like messages; a text short enough shares its message's ciphertext.
+    # Either way the plaintext goes to plaintext_cache, so publishing the entry decrypts nothing.
+    def encrypt_preview(self, text, ciphertext=None):
+        if not text:
+            return None
+        if ciphertext is None or len(text) > self.preview_chars:
+            text = text[:self.preview_chars]
+            ciphertext = encrypt_message(text)
+        if app.config['PLAINTEXT_CACHE_SIZE'] > 0:
+            plaintext_cache.set(('preview', ciphertext), text)
+        return ciphertext
+
+    def preview_text(self, message_type, preview):
+        if message_type == 'text':
+            if not preview:
+                return ''
+            text = plaintext_cache.get(('preview', preview))
+            return text if text is not None else decrypt_message(preview)[:self.preview_chars]
+        if message_type is None:
+            return ''
+        return MEDIA_PREVIEWS.get(message_type, '📎 File')
+
+    @staticmethod
+    def query():
+        return db.select(InboxEntry.__table__, User.username, User.public_username, User.profile_pic,
+                         Group.name.label('group_name'), Group.is_channel).select_from(
+            InboxEntry.__table__
+            .outerjoin(User.__table__, User.id == InboxEntry.peer_id)
+            .outerjoin(Group.__table__, Group.id == InboxEntry.group_id)
+        )
+
+    def entry_json(self, row):
+        entry = {
+            'conversation_key': row.conversation_key,
+            'type': 'group' if row.group_id else 'user',
+            'id': row.group_id or row.peer_id,
+            'name': row.group_name if row.group_id else row.username,
+            'preview': self.preview_text(row.last_message_type, row.preview),
+            'last_message_id': row.last_message_id,
+            'last_sender_id': row.last_sender_id,
+            'last_message_at': row.last_message_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'unread_count': row.unread_count
+        }
+        if row.group_id:
+            entry['is_channel'] = bool(row.is_channel)
+        else:
+            entry.update(directory.entry(row.peer_id, row.username, row.public_username, row.profile_pic))
+        return entry
+
+    # One page of a user's conversations, newest first: (entries, cursor for the next page)
+    def page(self, user_id, before=None, limit=None):
+        limit = limit or self.page_size
+        query = self.query().where(InboxEntry.user_id == user_id)
+        if before:
+            last_message_at, entry_id = before
+            query = query.where(db.or_(
+                InboxEntry.last_message_at < last_message_at,
+                db.and_(InboxEntry.last_message_at == last_message_at, InboxEntry.id < entry_id)
+            ))
+        rows = db.session.execute(query.order_by(InboxEntry.last_message_at.desc(), InboxEntry.id.desc()).limit(limit + 1)).all()
+        page = rows[:limit]
+        next_cursor = encode_cursor(page[-1].last_message_at, page[-1].id) if len(rows) > limit else None
+        return [self.entry_json(row) for row in page], next_cursor
+
+    # Upserts the entries of everyone in the conversations of newly stored messages. Runs inside
+    # the writer's transaction; a sender's own message clears their unread count.
+    def record_messages(self, conn, rows):
+        group_ids = {int(row['group_id']) for row in rows if row.get('group_id')}
+        members = {}
+        if group_ids:
+            for group_id, user_id in conn.execute(db.select(GroupMember.group_id, GroupMember.user_id).where(GroupMember.group_id.in_(group_ids))):
+                members.setdefault(group_id, set()).add(user_id)
+
+        entries = {}
+        for row in sorted(rows, key=lambda row: row['id']):
+            group_id = int(row['group_id']) if row.get('group_id') else None
+            receiver_id = int(row['receiver_id']) if row.get('receiver_id') else None
+            participants = members.get(group_id, set()) if group_id else {row['sender_id'], receiver_id}
+            preview = self.encrypt_preview(row.get(SEARCH_TEXT_KEY), row['content']) if row['content_type'] == 'text' else None
+            for user_id in participants:
+                entry = entries.setdefault((user_id, row['conversation_key']), {
+                    'user_id': user_id,
+                    'conversation_key': row['conversation_key'],
+                    'peer_id': None if group_id else (receiver_id if user_id == row['sender_id'] else row['sender_id']),
+                    'group_id': group_id,
+                    'unread_count': 0,
+                    'reset': False
+                })
+                entry.update(last_message_id=row['id'], last_sender_id=row['sender_id'], last_message_type=row['content_type'],
+                             preview=preview, last_message_at=row['timestamp'])
+                if user_id == row['sender_id']:
+                    entry.update(unread_count=0, reset=True)
+                else:
+                    entry['unread_count'] += 1
+
+        for reset in (True, False):
+            batch = [{key: value for key, value in entry.items() if key != 'reset'} for entry in entries.values() if entry['reset'] == reset]
+            if batch:
+                conn.execute(self._upsert(reset), batch)
+
+    # One statement run for every entry (executemany), instead of a VALUES list compiled per batch
+    def _upsert(self, reset):
+        statement = sqlite_insert(InboxEntry)
+        excluded = statement.excluded
+        # Writers on other workers may store an older message after a newer one
+        newer = excluded.last_message_id > InboxEntry.last_message_id
+        set_ = {column: db.case((newer, excluded[column]), else_=InboxEntry.__table__.c[column]) for column in self.latest_columns}
+        set_['unread_count'] = excluded.unread_count if reset else InboxEntry.unread_count + excluded.unread_count
+        return statement.on_conflict_do_update(index_elements=['user_id', 'conversation_key'], set_=set_)
+
+    # Unread messages of an entry after its owner's read watermark; group members who never
+    # acked have no watermark, so their count can only go down
+    @staticmethod
+    def unread_count():
+        watermark = db.select(ReadState.last_read_message_id).where(
+            ReadState.user_id == InboxEntry.user_id,
+            ReadState.conversation_key == InboxEntry.conversation_key
+        ).correlate(InboxEntry).scalar_subquery()  # Also inside unread_after(), two levels down
+
+        def unread_after(message_id):
+            return db.select(db.func.count()).select_from(Message).where(
+                Message.conversation_key == InboxEntry.conversation_key,
+                Message.id > message_id,
+                Message.sender_id != InboxEntry.user_id
+            ).scalar_subquery()
+
+        return db.case(
+            (watermark >= InboxEntry.last_message_id, 0),
+            (db.and_(watermark.is_(None), InboxEntry.group_id.isnot(None)), db.func.min(InboxEntry.unread_count, unread_after(0))),
+            else_=unread_after(db.func.coalesce(watermark, 0))
+        )
+
+    # After advance_read_states(): recount the acked entries (usually 0, without counting)
+    def mark_read(self, watermarks):
+        condition = db.tuple_(InboxEntry.user_id, InboxEntry.conversation_key).in_(list(watermarks))
+        db.session.execute(db.update(InboxEntry).where(condition).values(unread_count=self.unread_count()))
+        db.session.commit()
+        return condition
+
+    def message_edited(self, conn, message, new_content):
+        condition = db.and_(InboxEntry.conversation_key == message.conversation_key, InboxEntry.last_message_id == message.id)
+        conn.execute(db.update(InboxEntry).where(condition).values(preview=self.encrypt_preview(new_content, message.content)))
+        return condition
+
+    # Rebuilds last message and unread counts of every entry in these conversations from the
+    # messages that are left (expiry, `flask inbox-rebuild`)
+    def refresh(self, conn, keys):
+        for key in keys:
+            last = conn.execute(db.select(Message.id, Message.sender_id, Message.content_type, Message.content, Message.timestamp).where(
+                Message.conversation_key == key).order_by(Message.timestamp.desc(), Message.id.desc()).limit(1)).first()
+            values = {'unread_count': self.unread_count()}
+            if last is None:
+                values.update(last_message_type=None, preview=None)
+            else:
+                text = decrypt_message(last.content) if last.content and last.content_type == 'text' else None
+                values.update(last_message_id=last.id, last_sender_id=last.sender_id, last_message_type=last.content_type,
+                              preview=self.encrypt_preview(text, last.content), last_message_at=last.timestamp)
+            conn.execute(db.update(InboxEntry).where(InboxEntry.conversation_key == key).values(**values))
+        return InboxEntry.conversation_key.in_(list(keys))
+
+    # Sends the entries matching condition to their owners
+    def publish(self, engine, condition):
+        with engine.connect() as conn:
+            rows = conn.execute(self.query().where(condition)).all()
+        for row in rows:
+            socketio.emit('inbox_updated', self.entry_json(row), room=f"user_{row.user_id}")
+
+inbox = Inbox(app.config['INBOX_PAGE_SIZE'], app.config['INBOX_PREVIEW_CHARS'])
+
+# Sidebar pages after the first (which the messaging page renders)
+@app.route('/api/inbox')
+@login_required
+def inbox_page():
+    before = request.args.get('before')
+    try:
+        cursor = decode_cursor(before) if before else None
+    except (ValueError, UnicodeDecodeError):
+        return jsonify({'error': 'Invalid cursor'}), 400
+    entries, next_cursor = inbox.page(current_user.id, cursor)
+    return jsonify({'entries': entries, 'next_cursor': next_cursor})
+
+# Contact directory for the messaging sidebar and group creation. A user's recent 1:1
+# correspondents come from their inbox entries, and the prefix search over
+# username and public_username uses lower() expression indexes, so neither depends on how many
+# accounts exist. Search pages are shared by every viewer and cached per (prefix, cursor) for
+# DIRECTORY_SEARCH_TTL seconds; recent lists are cached per user until one of their chats changes.
+ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')  # Same folding as SQLite's lower()
+
+class Directory:
+    def __init__(self, recent_limit, recent_ttl, search_ttl):
+        self.recent_limit = recent_limit
+        self.recent_cache = MemoryCacheBackend(10000, recent_ttl)
+        self.search_cache = MemoryCacheBackend(10000, search_ttl)
+
+    @staticmethod
+    def entry(user_id, username, public_username, profile_pic):
+        return {
+            'id': user_id,
+            'username': username,
+            'public_username': public_username,
+            'profile_pic': profile_pic,
+            'profile_pic_url': media_url(f"profile_pics/{profile_pic}") if profile_pic else None
+        }
+
+    def recent(self, user_id):
+        contacts = self.recent_cache.get(user_id)
+        if contacts is None:
+            contacts = self._load_recent(user_id)
+            self.recent_cache.set(user_id, contacts)
+        return contacts
+
+    def invalidate(self, *user_ids):
+        for user_id in user_ids:
+            self.recent_cache.delete(int(user_id))  # Socket payloads may carry ids as strings
+
+    # session defaults to the app's; `flask bench-directory` passes one on a scratch database
+    def _load_recent(self, user_id, session=None):
+        rows = (session or db.session).execute(
+            db.select(User.id, User.username, User.public_username, User.profile_pic)
+            .join(InboxEntry, InboxEntry.peer_id == User.id)
+            .where(InboxEntry.user_id == user_id, InboxEntry.peer_id != user_id)
+            .order_by(InboxEntry.last_message_at.desc(), InboxEntry.id.desc()).limit(self.recent_limit)
+        ).all()
+        return [self.entry(*row) for row in rows]
+
+    # One page of users whose username or public username starts with query (case-insensitive)
+    def search(self, query, cursor, limit):
+        prefix = query.strip().lstrip('@').translate(ASCII_LOWER)[:80]
+        if not prefix:
+            return {'users': [], 'next_cursor': None}
+        key = (prefix, cursor, limit)
+        page = self.search_cache.get(key)
+        if page is None:
+            page = self._search(prefix, self.decode_cursor(cursor) if cursor else None, limit)
+            self.search_cache.set(key, page)
+        return page
+
+    @staticmethod
+    def encode_cursor(match_key, user_id):
+        return base64.urlsafe_b64encode(json.dumps([match_key, user_id]).encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        match_key, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return str(match_key), int(user_id)
+
+    def _search(self, prefix, after, limit, session=None):
+        upper = prefix + '\U0010ffff'  # Sorts after every string that starts with prefix
+        name_key = db.func.lower(User.username)
+        public_key = db.func.lower(User.public_username)
+
+        # Each branch walks its own index in (key, id) order; users whose username matches are
+        # left out of the public_username branch, so every user has one position in the merge
+        def branch(key, *conditions):
+            query = db.select(User.id, User.username, User.public_username, User.profile_pic, key.label('match_key')).where(
+                key >= prefix, key < upper, *conditions)
+            if after:
+                query = query.where(db.tuple_(key, User.id) > after)
+            return db.select(query.order_by(key, User.id).limit(limit + 1).subquery())
+
+        merged = db.union_all(
+            branch(name_key),
+            branch(public_key, db.not_(db.and_(name_key >= prefix, name_key < upper)))
+        ).subquery()
+        rows = (session or db.session).execute(db.select(merged).order_by(merged.c.match_key, merged.c.id).limit(limit + 1)).all()
+        page = rows[:limit]
+        return {
+            'users': [self.entry(row.id, row.username, row.public_username, row.profile_pic) for row in page],
+            'next_cursor': self.encode_cursor(page[-1].match_key, page[-1].id) if len(rows) > limit else None
+        }
+
+directory = Directory(
+    app.config['DIRECTORY_RECENT_LIMIT'],
+    app.config['DIRECTORY_RECENT_TTL'],
+    app.config['DIRECTORY_SEARCH_TTL']
+)
+
+# Recent correspondents with no q, otherwise users whose username or public username starts with q
+@app.route('/api/directory')
+@login_required
+def directory_search():
+    query = request.args.get('q', '')
+    if not query.strip().lstrip('@'):
+        return jsonify({'users': directory.recent(current_user.id), 'next_cursor': None})
+    limit = max(1, min(request.args.get('limit', app.config['DIRECTORY_PAGE_SIZE'], type=int), 50))
+    try:
+        page = directory.search(query, request.args.get('cursor'), limit)
+    except (ValueError, TypeError, UnicodeDecodeError):
+        return jsonify({'error': 'Invalid cursor'}), 400
+    return jsonify({
+        'users': [user for user in page['users'] if user['id'] != current_user.id],
+        'next_cursor': page['next_cursor']
+    })
+
+# Messaging App Routes
+@app.route('/messaging', methods=['GET', 'POST'])
+@login_required
+def messaging():
+    groups = Group.query.join(GroupMember, GroupMember.group_id == Group.id).filter(GroupMember.user_id == current_user.id).all()
+    selected_user_id = request.args.get('user_id')
+    selected_group_id = request.args.get('group_id')
+    selected_user = None
     selected_group = None
     chat_type = request.args.get('chat_type', 'user')
 
-    # Convert users to JSON-serializable format
-    users_list = [
-        {
-            'id': user.id,
-            'username': user.username,
-            'profile_pic': user.profile_pic
-        } for user in users
-    ]
+    # The sidebar is the first inbox page, newest conversation first; anyone else is found through
+    # the search box (/api/directory). Groups without messages yet follow the ones in the inbox.
+    entries, inbox_cursor = inbox.page(current_user.id)
+    users_list = [entry for entry in entries if entry['type'] == 'user' and entry['id'] != current_user.id]
+    group_entries = {entry['id']: entry for entry in entries if entry['type'] == 'group'}
 
     # Convert groups to JSON-serializable format
     groups_list = [
         {
             'id': group.id,
             'name': group.name,
-            'is_channel': group.is_channel
+            'is_channel': group.is_channel,
+            'preview': group_entries[group.id]['preview'] if group.id in group_entries else '',
+            'unread_count': group_entries[group.id]['unread_count'] if group.id in group_entries else 0
         } for group in groups
     ]
+    position = {group_id: index for index, group_id in enumerate(group_entries)}
+    groups_list.sort(key=lambda group: position.get(group['id'], len(position)))
 
-    print(f"Fetching messaging data for user {current_user.id}")
-    print(f"Users: {[u['username'] for u in users_list]}")
-    print(f"Groups: {[g['name'] for g in groups_list]}")
+    logger.debug("Messaging page for user %s: %d users, %d groups", current_user.id, len(users_list), len(groups_list))
 
+    # Messages themselves are loaded page by page from /api/messages
     if selected_user_id:
         selected_user = User.query.get(selected_user_id)
-        if selected_user:
-            print(f"Selected user: {selected_user.username}")
-            messages = Message.query.filter(
-                ((Message.sender_id == current_user.id) & (Message.receiver_id == selected_user.id)) |
-                ((Message.sender_id == selected_user.id) & (Message.receiver_id == current_user.id))
-            ).filter_by(group_id=None).order_by(Message.timestamp.asc()).all()
-            for message in messages:
-                if message.content and message.content_type == 'text':
-                    try:
-                        message.content = decrypt_message(message.content)
-                    except Exception as e:
-                        print(f"Error decrypting message {message.id}: {str(e)}")
-                        message.content = "Error decrypting message"
-            for message in messages:
-                if message.sender_id == selected_user.id and not message.is_read:
-                    message.is_read = True
-            db.session.commit()
-            chat_type = 'user'
-            print(f"Messages fetched for user {selected_user_id}: {len(messages)} messages")
-
+        chat_type = 'user'
+        if selected_user and all(user['id'] != selected_user.id for user in users_list):
+            users_list.insert(0, directory.entry(selected_user.id, selected_user.username,
+                                                 selected_user.public_username, selected_user.profile_pic))
     elif selected_group_id:
         selected_group = Group.query.get(selected_group_id)
-        if selected_group:
-            print(f"Selected group: {selected_group.name}")
-            messages = Message.query.filter_by(group_id=selected_group_id).order_by(Message.timestamp.asc()).all()
-            for message in messages:
-                if message.content and message.content_type == 'text':
-                    try:
-                        message.content = decrypt_message(message.content)
-                    except Exception as e:
-                        print(f"Error decrypting message {message.id}: {str(e)}")
-                        message.content = "Error decrypting message"
-            chat_type = 'group'
-            print(f"Messages fetched for group {selected_group_id}: {len(messages)} messages")
+        chat_type = 'group'
+
+    return render_template('messaging.html', users=users_list, users_list=users_list, groups=groups_list, groups_list=groups_list,
+                           inbox_cursor=inbox_cursor, selected_user=selected_user, selected_group=selected_group, chat_type=chat_type)
+
+# Decrypted message text, keyed by (message id, edit version) so an edit never serves stale text.
+# Filled when a message is sent or edited, and by decrypt_messages() for conversation pages.
+plaintext_cache = MemoryCacheBackend(app.config['PLAINTEXT_CACHE_SIZE'], app.config['PLAINTEXT_CACHE_TTL'])
+
+def cache_plaintext(message_id, edit_version, plaintext):
+    if app.config['PLAINTEXT_CACHE_SIZE'] > 0:
+        plaintext_cache.set((message_id, edit_version), plaintext)
+
+# Function to decrypt a page of messages in one pass: cached text first, the keyring for the rest.
+# Returns {message id: plaintext} for the text messages.
+def decrypt_messages(messages):
+    plaintexts = {}
+    for message in messages:
+        if not message.content or message.content_type != 'text':
+            continue
+        key = (message.id, message.edit_version or 0)
+        plaintext = plaintext_cache.get(key)
+        if plaintext is None:
+            plaintext = decrypt_message(message.content)
+            if plaintext != "Error decrypting message":
+                cache_plaintext(message.id, message.edit_version or 0, plaintext)
+        plaintexts[message.id] = plaintext
+    return plaintexts
+
+def serialize_message(message, watermarks=None, plaintexts=None):
+    content = message.content
+    if content and message.content_type == 'text':
+        content = plaintexts[message.id] if plaintexts is not None else decrypt_messages([message])[message.id]
+    return {
+        'message_id': message.id,
+        'sender_id': message.sender_id,
+        'receiver_id': message.receiver_id,
+        'group_id': message.group_id,
+        'content': content,
+        'content_type': message.content_type,
+        'file_path': message.file_path,
+        'file_url': media_url(message.file_path) if message.file_path else None,
+        'timestamp': message.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+        'is_read': bool(message.is_read) if watermarks is None else message_is_read(message, *watermarks),
+        'is_secret': bool(message.is_secret),
+        'disappear_timer': message.disappear_timer,
+        'expires_at': message.expires_at.strftime('%Y-%m-%d %H:%M:%S') if message.expires_at else None,
+        'edited': bool(message.edited)
+    }
+
+# Function to derive the old is_read flag from the watermarks: a sent message is read once the
+# other side (anyone else, for groups) has read up to it, a received one once the viewer has
+def message_is_read(message, my_watermark, others_watermark):
+    if message.sender_id == current_user.id:
+        return message.id <= others_watermark
+    return message.id <= my_watermark
+
+# Conversation page API: the newest `limit` messages by default, `before=<cursor>` for older
+# pages and `after=<cursor>` for everything since a message. Keyset pagination on
+# (timestamp, id) keeps every page one index range scan, however long the history is.
+@app.route('/api/messages/<chat_type>/<int:chat_id>', methods=['GET'])
+@login_required
+def conversation_messages(chat_type, chat_id):
+    if chat_type == 'user':
+        if not User.query.get(chat_id):
+            return jsonify({'error': 'User not found'}), 404
+        key = conversation_key(current_user.id, chat_id)
+    elif chat_type == 'group':
+        if not GroupMember.query.filter_by(group_id=chat_id, user_id=current_user.id).first():
+            return jsonify({'error': 'You are not a member of this group!'}), 403
+        key = conversation_key(group_id=chat_id)
+    else:
+        return jsonify({'error': 'chat_type must be user or group'}), 400
+
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    before = request.args.get('before')
+    after = request.args.get('after')
+    try:
+        cursor = decode_cursor(after or before) if (after or before) else None
+    except (ValueError, UnicodeDecodeError):
+        return jsonify({'error': 'Invalid cursor'}), 400
+
+    query = Message.query.filter(Message.conversation_key == key)
+    if after:
+        timestamp, message_id = cursor
+        query = query.filter(db.or_(
+            Message.timestamp > timestamp,
+            db.and_(Message.timestamp == timestamp, Message.id > message_id)
+        )).order_by(Message.timestamp.asc(), Message.id.asc())
+        page = query.limit(limit + 1).all()
+        has_more = len(page) > limit
+        page = page[:limit]
+    else:
+        if before:
+            timestamp, message_id = cursor
+            query = query.filter(db.or_(
+                Message.timestamp < timestamp,
+                db.and_(Message.timestamp == timestamp, Message.id < message_id)
+            ))
+        page = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit + 1).all()
+        has_more = len(page) > limit
+        page = page[:limit][::-1]
+
+    # Opening the latest page marks the conversation read up to its newest message
+    if page and not before and not (after and has_more):
+        read_receipts.ack(current_user.id, key, page[-1].id)
+
+    watermarks = read_watermarks(current_user.id, key)
+    plaintexts = decrypt_messages(page)
+    return jsonify({
+        'messages': [serialize_message(message, watermarks, plaintexts) for message in page],
+        'conversation_key': key,
+        'oldest_cursor': encode_cursor(page[0].timestamp, page[0].id) if page else before,
+        'newest_cursor': encode_cursor(page[-1].timestamp, page[-1].id) if page else after,
+        'has_more': has_more
+    })
+
+# Full-text search (SQLite FTS5). chat_history_fts keeps its own copy of each AI turn and is
+# maintained by triggers on chat_history (see migration a8e4c6d2f105). message_fts is contentless:
+# it holds only the index of each text message's plaintext, written next to the encrypted row
+# (MessageWriter, edit_message, ExpiryScheduler), never the text. Every row carries a scope token
+# (u<user id> for AI turns, the conversation key for messages) and queries are limited to the
+# caller's scopes. `flask search-backfill` indexes rows stored before search existed.
+SEARCH_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chat_history_fts USING fts5("
+    "scope, user_message, bot_reply, tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5("
+    "scope, body, content='', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+]
+SEARCH_TEXT_KEY = 'search_text'  # Plaintext riding along on a MessageWriter row; not a Message column
+SNIPPET_START, SNIPPET_END = '\x02', '\x03'
+
+# Scope token for a conversation key; FTS5 would split chat_1_2 into three tokens
+def search_scope(key):
+    return key.replace('_', 'x')
+
+# Turns user input into an FTS5 query: every word must match, the last one as a prefix
+def search_terms(text):
+    words = re.findall(r'\w+', (text or '').lower())[:10]
+    if not words:
+        return None, []
+    return ' '.join(f'"{word}"' for word in words) + '*', words
+
+# HTML for a snippet whose matches are wrapped in SNIPPET_START/SNIPPET_END
+def render_snippet(text):
+    return html.escape(text or '').replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+
+# Snippet for a decrypted message (contentless tables cannot build one)
+def message_snippet(text, words, width=80):
+    pattern = re.compile('|'.join(rf'\b{re.escape(word)}' for word in words), re.IGNORECASE)
+    first = pattern.search(text)
+    start = max(0, first.start() - width // 3) if first else 0
+    piece = text[start:start + width]
+    marked = pattern.sub(lambda match: f"{SNIPPET_START}{match.group(0)}{SNIPPET_END}", piece)
+    return ('…' if start else '') + marked + ('…' if start + width < len(text) else '')
 
-    print("Rendering messaging.html")
-    return render_template('messaging.html', users=users, users_list=users_list, groups=groups, groups_list=groups_list, messages=messages, 
-                           selected_user=selected_user, selected_group=selected_group, chat_type=chat_type)
+def message_columns(row):
+    return {key: value for key, value in row.items() if key != SEARCH_TEXT_KEY}
+
+# Indexes new messages in the same transaction as their rows (called by MessageWriter)
+def index_message_rows(conn, rows):
+    entries = [
+        {'rowid': row['id'], 'scope': search_scope(row['conversation_key']), 'body': row[SEARCH_TEXT_KEY]}
+        for row in rows if row.get(SEARCH_TEXT_KEY)
+    ]
+    if entries:
+        conn.execute(db.text("INSERT INTO message_fts (rowid, scope, body) VALUES (:rowid, :scope, :body)"), entries)
+
+# Removes messages from the contentless index, which needs the exact text that was indexed.
+# Rows that were never indexed are skipped, since a 'delete' for them would corrupt the index.
+# So are rows whose text failed to decrypt: their entries stay, and search drops ids that no
+# longer have a Message row.
+def unindex_messages(conn, entries):
+    entries = [entry for entry in entries if entry[2] != "Error decrypting message"]
+    if not entries:
+        return
+    indexed = set(conn.execute(
+        db.text("SELECT rowid FROM message_fts WHERE rowid IN (SELECT value FROM json_each(:ids))"),
+        {'ids': json.dumps([message_id for message_id, _, _ in entries])}
+    ).scalars())
+    deletes = [{'rowid': message_id, 'scope': search_scope(key), 'body': text} for message_id, key, text in entries if message_id in indexed]
+    if deletes:
+        conn.execute(db.text("INSERT INTO message_fts (message_fts, rowid, scope, body) VALUES ('delete', :rowid, :scope, :body)"), deletes)
+
+# Conversations the user can read: 1:1 chats from their inbox, their own notes, their groups
+def search_scopes(user_id):
+    chats = db.session.query(InboxEntry.conversation_key).filter(InboxEntry.user_id == user_id, InboxEntry.peer_id.isnot(None))
+    keys = {key for (key,) in chats} | {conversation_key(user_id, user_id)}
+    groups = db.session.query(GroupMember.group_id).filter(GroupMember.user_id == user_id)
+    keys.update(conversation_key(user_id, None, group_id) for (group_id,) in groups)
+    return [search_scope(key) for key in keys]
+
+def search_chat_history(user_id, query, limit, offset):
+    rows = db.session.execute(db.text(
+        "SELECT h.id, h.chat_name, h.timestamp, "
+        "snippet(chat_history_fts, 1, :start, :end, '…', 12) AS user_snippet, "
+        "snippet(chat_history_fts, 2, :start, :end, '…', 16) AS reply_snippet "
+        "FROM chat_history_fts JOIN chat_history h ON h.id = chat_history_fts.rowid "
+        "WHERE chat_history_fts MATCH :match ORDER BY rank LIMIT :limit OFFSET :offset"
+    ), {
+        'match': f"scope : u{user_id} AND {{user_message bot_reply}} : ({query})",
+        'start': SNIPPET_START, 'end': SNIPPET_END, 'limit': limit, 'offset': offset
+    }).all()
+    return [{
+        'type': 'ai',
+        'id': row.id,
+        'chat_name': row.chat_name,
+        'timestamp': str(row.timestamp)[:19],
+        'user_snippet': render_snippet(row.user_snippet),
+        'reply_snippet': render_snippet(row.reply_snippet)
+    } for row in rows]
+
+def search_messages(user_id, query, words, limit, offset):
+    scopes = ' OR '.join(search_scopes(user_id))
+    ids = db.session.execute(db.text(
+        "SELECT rowid FROM message_fts WHERE message_fts MATCH :match ORDER BY rank LIMIT :limit OFFSET :offset"
+    ), {'match': f"scope : ({scopes}) AND body : ({query})", 'limit': limit, 'offset': offset}).scalars().all()
+    messages = {message.id: message for message in Message.query.filter(Message.id.in_(ids)).all()}
+    plaintexts = decrypt_messages(list(messages.values()))
+    results = []
+    for message_id in ids:
+        message = messages.get(message_id)
+        if message is None:
+            continue
+        results.append({
+            'type': 'message',
+            'id': message.id,
+            'conversation_key': message.conversation_key,
+            'sender_id': message.sender_id,
+            'receiver_id': message.receiver_id,
+            'group_id': message.group_id,
+            'timestamp': message.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+            'snippet': render_snippet(message_snippet(plaintexts[message.id] or '', words))
+        })
+    return results
+
+# Ranked search over the user's AI chats (type=ai) or messages (type=messages); the cursor is
+# the offset of the next page
+@app.route('/api/search')
+@login_required
+def search():
+    search_type = request.args.get('type', 'ai')
+    if search_type not in ('ai', 'messages'):
+        return jsonify({'error': 'type must be ai or messages'}), 400
+    query, words = search_terms(request.args.get('q'))
+    if not query:
+        return jsonify({'results': [], 'next_cursor': None, 'has_more': False})
+    limit = max(min(request.args.get('limit', app.config['SEARCH_PAGE_SIZE'], type=int), 100), 1)
+    offset = max(request.args.get('cursor', 0, type=int), 0)
+
+    started = time.perf_counter()
+    if search_type == 'ai':
+        results = search_chat_history(current_user.id, query, limit + 1, offset)
+    else:
+        results = search_messages(current_user.id, query, words, limit + 1, offset)
+    has_more = len(results) > limit
+    logger.debug("Search %s: %d results in %.1f ms", search_type, len(results), (time.perf_counter() - started) * 1000)
+    return jsonify({
+        'results': results[:limit],
+        'next_cursor': offset + limit if has_more else None,
+        'has_more': has_more
+    })
 
 @app.route('/create_group', methods=['GET', 'POST'])
 @login_required
@@ -742,73 +2813,524 @@ def create_group():
         flash('Group created successfully!', 'success')
         return redirect(url_for('messaging', group_id=group.id, chat_type='group'))
 
-    users = User.query.filter(User.id != current_user.id).all()
-    return render_template('group_create.html', users=users)
+    return render_template('group_create.html', users=directory.recent(current_user.id))
+
+# Chunked, resumable attachment uploads. POST /api/uploads opens a session, each PUT appends the
+# bytes at its Upload-Offset header (a mismatch gets a 409 with the offset to resume from), and the
+# SHA-256 is computed while writing. The finished file is stored once per hash under
+# MESSAGES_FOLDER, so the same video sent to many chats takes the space of one.
+UPLOAD_READ_SIZE = 64 * 1024
+
+# Running SHA-256 of each upload on this process, so a chunk only hashes its own bytes. After a
+# restart, or a chunk that landed on another worker, the partial file is hashed again from disk.
+class UploadHashes:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = {}
+        self.locks = {}
+
+    def lock_for(self, upload_id):
+        with self.lock:
+            return self.locks.setdefault(upload_id, threading.Lock())
+
+    def resume(self, upload_id, partial_path, offset):
+        with self.lock:
+            state = self.states.pop(upload_id, None)
+        if state and state[0] == offset:
+            return state[1]
+        hasher = hashlib.sha256()
+        if offset:
+            with open(partial_path, 'rb') as f:
+                remaining = offset
+                while remaining:
+                    chunk = f.read(min(1024 * 1024, remaining))
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    remaining -= len(chunk)
+        return hasher
+
+    def save(self, upload_id, offset, hasher):
+        with self.lock:
+            self.states[upload_id] = (offset, hasher)
+
+    def discard(self, upload_id):
+        with self.lock:
+            self.states.pop(upload_id, None)
+            self.locks.pop(upload_id, None)
+
+upload_hashes = UploadHashes()
+
+def partial_upload_path(upload_id):
+    return os.path.join(app.config['UPLOAD_PARTIAL_FOLDER'], upload_id)
+
+def upload_json(upload):
+    return {'upload_id': upload.id, 'offset': upload.received, 'size': upload.size, 'complete': False,
+            'chunk_size': app.config['UPLOAD_CHUNK_SIZE']}
+
+def blob_json(blob):
+    return {'complete': True, 'file_path': blob.file_path, 'sha256': blob.sha256, 'size': blob.size}
+
+def get_upload_or_404(upload_id):
+    upload = db.session.get(UploadSession, upload_id)
+    if upload is None or upload.user_id != current_user.id:
+        abort(404)
+    return upload
+
+# Moves a finished upload into place, or drops it if a blob with the same hash already exists
+def store_blob(upload, digest):
+    partial_path = partial_upload_path(upload.id)
+    blob = Blob.query.filter_by(sha256=digest).first()
+    file_path = None
+    if blob is None:
+        ext = secure_filename(upload.filename).rsplit('.', 1)[1].lower()
+        file_path = f"messages/{digest[:2]}/{digest}.{ext}"
+        destination = os.path.join(app.config['UPLOAD_FOLDER'], file_path)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.replace(partial_path, destination)
+        blob = Blob(sha256=digest, size=upload.size, file_path=file_path, ref_count=0)
+        db.session.add(blob)
+    else:
+        os.remove(partial_path)
+        blob.last_used_at = datetime.datetime.utcnow()
+    db.session.delete(upload)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another upload of the same content finished first; its file is byte-for-byte the same.
+        # Under another extension it has a different path, so the copy written here is dropped.
+        db.session.rollback()
+        blob = Blob.query.filter_by(sha256=digest).one()
+        if file_path and file_path != blob.file_path:
+            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], file_path))
+        db.session.delete(db.session.get(UploadSession, upload.id))
+        db.session.commit()
+    upload_hashes.discard(upload.id)
+    return blob
+
+@app.route('/api/uploads', methods=['POST'])
+@login_required
+def create_upload():
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename') or ''
+    size = data.get('size')
+    if not allowed_file(secure_filename(filename)):
+        return jsonify({'error': 'Invalid file format!'}), 400
+    if not isinstance(size, int) or size <= 0 or size > app.config['MAX_ATTACHMENT_MB'] * 1024 * 1024:
+        return jsonify({'error': f"File size 1 byte se {app.config['MAX_ATTACHMENT_MB']} MB tak honi chahiye!"}), 400
+
+    # Clients that already know the hash skip the upload when the content is stored and they have
+    # sent it before. Knowing a hash is no proof of having the file, so anyone else uploads it
+    # (and the finished upload still resolves to the one stored copy).
+    sha256 = (data.get('sha256') or '').lower()
+    if sha256:
+        blob = Blob.query.filter_by(sha256=sha256, size=size).first()
+        if blob and Message.query.filter_by(sender_id=current_user.id, file_path=blob.file_path).first():
+            blob.last_used_at = datetime.datetime.utcnow()
+            db.session.commit()
+            return jsonify(blob_json(blob))
+
+    upload = UploadSession(id=uuid.uuid4().hex, user_id=current_user.id, filename=filename[:200], size=size)
+    db.session.add(upload)
+    db.session.commit()
+    open(partial_upload_path(upload.id), 'wb').close()
+    return jsonify(upload_json(upload)), 201
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required
+def upload_status(upload_id):
+    return jsonify(upload_json(get_upload_or_404(upload_id)))
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id):
+    upload = get_upload_or_404(upload_id)
+    offset = request.headers.get('Upload-Offset', type=int)
+    partial_path = partial_upload_path(upload.id)
+
+    with upload_hashes.lock_for(upload.id):
+        db.session.refresh(upload)
+        if offset != upload.received:
+            return jsonify({'error': 'Upload-Offset match nahi hua', 'offset': upload.received}), 409
+
+        hasher = upload_hashes.resume(upload.id, partial_path, offset)
+        remaining = upload.size - offset
+        written = 0
+        try:
+            with open(partial_path, 'r+b') as f:
+                f.seek(offset)
+                f.truncate()
+                while written < remaining:
+                    chunk = request.stream.read(min(UPLOAD_READ_SIZE, remaining - written))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    written += len(chunk)
+        finally:
+            # Whatever arrived counts, even if the client dropped mid-chunk
+            upload.received = offset + written
+            upload.updated_at = datetime.datetime.utcnow()
+            db.session.commit()
+            upload_hashes.save(upload.id, upload.received, hasher)
+
+        if request.stream.read(1):
+            return jsonify({'error': 'Chunk declared file size se bada hai', 'offset': upload.received}), 400
+        if upload.received < upload.size:
+            return jsonify(upload_json(upload))
+        return jsonify(blob_json(store_blob(upload, hasher.hexdigest())))
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+@login_required
+def cancel_upload(upload_id):
+    upload = get_upload_or_404(upload_id)
+    with upload_hashes.lock_for(upload.id):
+        db.session.delete(upload)
+        db.session.commit()
+        if os.path.exists(partial_upload_path(upload.id)):
+            os.remove(partial_upload_path(upload.id))
+    upload_hashes.discard(upload.id)
+    return jsonify({'message': 'Upload cancelled'})
+
+# Media pipeline: the request only streams the upload to disk and reads the image header, then
+# a media worker decodes it (JPEG at reduced scale via draft mode), applies the EXIF orientation
+# and writes thumb/medium variants as WebP and JPEG, and the owner gets a media_ready event.
+MEDIA_VARIANTS = {'thumb': 150, 'medium': 1080}  # Longest side in pixels; thumb is cropped square
+MEDIA_IMAGE_FORMATS = {'JPEG', 'PNG', 'GIF', 'WEBP'}
+MEDIA_OUTPUT_FORMATS = (
+    ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+    ('jpg', 'JPEG', {'quality': 85, 'optimize': True, 'progressive': True}),
+)
+
+# Pillow raises DecompressionBombError past twice this, even for images opened elsewhere
+Image.MAX_IMAGE_PIXELS = app.config['MEDIA_MAX_PIXELS']
+
+def accept_image_upload(file):
+    token = uuid.uuid4().hex
+    source_path = os.path.join(app.config['MEDIA_ORIGINALS_FOLDER'], token)
+    file.save(source_path)
+    try:
+        # Only the header is read here; the pixels are decoded by the worker
+        with Image.open(source_path) as img:
+            if img.format not in MEDIA_IMAGE_FORMATS:
+                raise ValueError('Yeh image format supported nahi hai!')
+            if img.width * img.height > app.config['MEDIA_MAX_PIXELS']:
+                raise ValueError('Image bahut badi hai, chhoti image upload karo!')
+    except (OSError, Image.DecompressionBombError) as e:
+        os.remove(source_path)
+        raise ValueError('Image file kharab hai ya supported nahi hai!') from e
+    except ValueError:
+        os.remove(source_path)
+        raise
+    return token, source_path
+
+def render_image_variants(source_path, dest_dir, token):
+    largest = max(MEDIA_VARIANTS.values())
+    with Image.open(source_path) as img:
+        # Lets libjpeg decode at 1/2, 1/4 or 1/8 scale while staying at least `largest` pixels
+        img.draft('RGB', (largest, largest))
+        img = ImageOps.exif_transpose(img)
+        img = img.convert('RGB')
+
+    written = []
+    for variant, size in MEDIA_VARIANTS.items():
+        if variant == 'thumb':
+            resized = ImageOps.fit(img, (size, size), Image.LANCZOS)
+        else:
+            resized = img.copy()
+            resized.thumbnail((size, size), Image.LANCZOS)
+        for ext, image_format, options in MEDIA_OUTPUT_FORMATS:
+            path = os.path.join(dest_dir, f"{token}_{variant}.{ext}")
+            resized.save(f"{path}.tmp", image_format, **options)
+            os.replace(f"{path}.tmp", path)
+            written.append(path)
+    return written
+
+def remove_image_variants(dest_dir, token):
+    for variant in MEDIA_VARIANTS:
+        for ext, _, _ in MEDIA_OUTPUT_FORMATS:
+            try:
+                os.remove(os.path.join(dest_dir, f"{token}_{variant}.{ext}"))
+            except FileNotFoundError:
+                pass
+
+# Runs on a media worker. kind is 'profile' (record_id is the user) or 'status'.
+def process_media_upload(kind, owner_id, record_id, source_path, token):
+    dest_dir = app.config['PROFILE_PICS_FOLDER'] if kind == 'profile' else app.config['STATUS_FOLDER']
+    started = time.perf_counter()
+    try:
+        run_blocking(render_image_variants, source_path, dest_dir, token)
+        state = 'ready'
+    except Exception as e:
+        logger.error(f"Media processing failed for {kind} {record_id}: {str(e)}")
+        remove_image_variants(dest_dir, token)
+        state = 'failed'
+    finally:
+        os.remove(source_path)
+
+    event = {'kind': kind, 'id': record_id, 'state': state}
+    media_path = None
+    with app.app_context():
+        try:
+            if kind == 'profile':
+                user = db.session.get(User, record_id)
+                if state == 'ready':
+                    previous = user.profile_pic
+                    user.profile_pic = f"{token}_thumb.jpg"
+                    db.session.commit()
+                    if previous and previous.endswith('_thumb.jpg'):
+                        remove_image_variants(dest_dir, previous[:-len('_thumb.jpg')])
+                    media_path = f"profile_pics/{user.profile_pic}"
+            else:
+                status = db.session.get(Status, record_id)
+                if status is None:
+                    remove_image_variants(dest_dir, token)
+                    return
+                status.media_state = state
+                db.session.commit()
+                status_feed.invalidate(owner_id)
+                if state == 'ready':
+                    media_path = status.file_path
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error saving processed {kind} {record_id}: {str(e)}")
+            return
+        finally:
+            db.session.remove()
+
+    logger.info(f"Processed {kind} image {record_id} in {(time.perf_counter() - started) * 1000:.0f} ms ({state})")
+    if media_path:
+        event['url'] = media_url(media_path)
+        event['webp_url'] = media_url(webp_variant(media_path))
+    socketio.emit('media_ready', event, room=f"user_{owner_id}")
+
+# The WebP sibling of a processed JPEG variant
+@app.template_filter('webp')
+def webp_variant(path):
+    return re.sub(r'\.jpg$', '.webp', path)
+
+# Status feed: the last STATUS_TTL seconds of statuses from the viewer and their contacts, grouped
+# by author (viewer first, then most recent), read through ix_status_user_id_timestamp and cached
+# per viewer. A sweeper thread deletes expired statuses and their media in batches.
+class StatusFeed:
+    def __init__(self, window, cache_ttl, sweep_interval, sweep_batch):
+        self.window = window
+        self.cache = MemoryCacheBackend(10000, cache_ttl)
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self.lock = threading.Lock()
+        self.sweeper = None
+
+    def for_viewer(self, viewer_id):
+        self._ensure_sweeper()
+        feed = self.cache.get(viewer_id)
+        if feed is None:
+            feed = self._build(viewer_id)
+            self.cache.set(viewer_id, feed)
+        # A cached feed may hold statuses that expired since it was built
+        cutoff = time.time() - self.window
+        groups = []
+        for group in feed:
+            statuses = [status for status in group['statuses'] if status['posted_at'] >= cutoff]
+            if statuses:
+                groups.append({**group, 'statuses': statuses})
+        return groups
+
+    # Feeds that show this author's statuses
+    def invalidate(self, author_id):
+        self.cache.delete(author_id)
+        for viewer_id in presence.contacts(author_id):
+            self.cache.delete(viewer_id)
+
+    def _build(self, viewer_id):
+        authors = presence.contacts(viewer_id) | {viewer_id}
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.window)
+        rows = db.session.query(Status, User.username, User.profile_pic).join(User, User.id == Status.user_id).filter(
+            Status.user_id.in_(authors), Status.timestamp >= cutoff
+        ).order_by(Status.user_id, Status.timestamp.desc()).all()
+
+        groups = {}
+        for status, username, profile_pic in rows:
+            group = groups.setdefault(status.user_id, {
+                'user_id': status.user_id,
+                'username': username,
+                'profile_pic_url': media_url(f"profile_pics/{profile_pic}") if profile_pic else None,
+                'statuses': []
+            })
+            ready = status.file_path and status.media_state == 'ready'
+            group['statuses'].append({
+                'id': status.id,
+                'content': status.content,
+                'content_type': status.content_type,
+                'media_state': status.media_state,
+                'file_url': media_url(status.file_path) if ready else None,
+                'webp_url': media_url(webp_variant(status.file_path)) if ready and status.content_type == 'image' else None,
+                'timestamp': status.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                'posted_at': status.timestamp.replace(tzinfo=datetime.timezone.utc).timestamp()
+            })
+        return sorted(groups.values(), key=lambda group: (group['user_id'] != viewer_id, -group['statuses'][0]['posted_at']))
+
+    # Deletes expired statuses a batch at a time, then their media files; returns how many went
+    def sweep(self):
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.window)
+        total = 0
+        while True:
+            expired = db.session.query(Status.id, Status.user_id, Status.content_type, Status.file_path).filter(
+                Status.timestamp < cutoff
+            ).order_by(Status.timestamp).limit(self.sweep_batch).all()
+            if not expired:
+                return total
+            db.session.execute(db.delete(Status).where(Status.id.in_([row.id for row in expired])))
+            db.session.commit()
+            for row in expired:
+                if not row.file_path:
+                    continue
+                if row.content_type == 'image':
+                    remove_image_variants(app.config['STATUS_FOLDER'], os.path.basename(row.file_path).rsplit('_', 1)[0])
+                else:
+                    try:
+                        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], row.file_path))
+                    except FileNotFoundError:
+                        pass
+            for author_id in {row.user_id for row in expired}:
+                self.invalidate(author_id)
+            total += len(expired)
+
+    def _ensure_sweeper(self):
+        with self.lock:
+            if self.sweeper is None:
+                self.sweeper = threading.Thread(target=self._sweep_loop, name='status-sweeper', daemon=True)
+                self.sweeper.start()
+
+    def _sweep_loop(self):
+        while True:
+            with app.app_context():
+                try:
+                    removed = self.sweep()
+                    if removed:
+                        logger.info(f"Swept {removed} expired statuses")
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Error sweeping statuses: {str(e)}")
+            time.sleep(self.sweep_interval)
+
+status_feed = StatusFeed(
+    app.config['STATUS_TTL'],
+    app.config['STATUS_FEED_CACHE_TTL'],
+    app.config['STATUS_SWEEP_INTERVAL'],
+    app.config['STATUS_SWEEP_BATCH']
+)
 
 @app.route('/status', methods=['GET', 'POST'])
 @login_required
 def status():
     if request.method == 'POST':
         content = request.form.get('content')
-        content_type = 'text'
-        file_path = None
+        status = Status(user_id=current_user.id, content=content, content_type='text')
+        token = None
 
-        if 'file' in request.files:
-            file = request.files['file']
-            if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                file_path = os.path.join(app.config['MESSAGES_FOLDER'], f"status_{current_user.id}_{filename}")
-                file.save(file_path)
-                content_type = 'image' if file.mimetype.startswith('image') else 'video'
+        file = request.files.get('file')
+        if file and file.filename:
+            if not allowed_file(file.filename):
+                flash('Invalid file format!', 'error')
+                return redirect(url_for('status'))
+            if file.mimetype.startswith('image'):
+                try:
+                    token, source_path = accept_image_upload(file)
+                except ValueError as e:
+                    flash(str(e), 'error')
+                    return redirect(url_for('status'))
+                status.content_type = 'image'
+                status.file_path = f"status/{token}_medium.jpg"
+                status.media_state = 'processing'
+            else:
+                ext = secure_filename(file.filename).rsplit('.', 1)[1].lower()
+                status.content_type = 'video'
+                status.file_path = f"status/{uuid.uuid4().hex}.{ext}"
+                status.media_state = 'ready'
+                file.save(os.path.join(app.config['UPLOAD_FOLDER'], status.file_path))
 
-        status = Status(user_id=current_user.id, content=content, content_type=content_type, file_path=file_path)
         db.session.add(status)
         db.session.commit()
-        flash('Status updated!', 'success')
+        status_feed.invalidate(current_user.id)
+        if token:
+            media_executor.submit(process_media_upload, 'status', current_user.id, status.id, source_path, token)
+            flash('Status posted! Image is being processed.', 'success')
+        else:
+            flash('Status updated!', 'success')
         return redirect(url_for('status'))
 
-    statuses = Status.query.all()
-    return render_template('status.html', statuses=statuses)
+    return render_template('status.html', feed=status_feed.for_viewer(current_user.id))
+
+# A message just sent may still be on the write queue; wait for it before giving up
+def find_message(message_id):
+    message = db.session.get(Message, message_id)
+    if message is None and message_writer.flush(timeout=app.config['MESSAGE_QUEUE_TIMEOUT']):
+        message = db.session.get(Message, message_id)
+    return message
+
+def get_message_or_404(message_id):
+    message = find_message(message_id)
+    if message is None:
+        abort(404)
+    return message
 
 @app.route('/edit_message/<int:message_id>', methods=['POST'])
 @login_required
 def edit_message(message_id):
-    message = Message.query.get_or_404(message_id)
+    message = get_message_or_404(message_id)
     if message.sender_id != current_user.id:
         return jsonify({'error': 'You can only edit your own messages!'}), 403
 
     new_content = request.form.get('content')
-    encrypted_content = encrypt_message(new_content) if new_content else None
-    message.content = encrypted_content
+    old_content = decrypt_messages([message])[message.id] if message.content and message.content_type == 'text' else None
+    plaintext_cache.delete((message.id, message.edit_version or 0))
+    message.content = encrypt_message(new_content) if new_content else None
     message.edited = True
+    message.edit_version = (message.edit_version or 0) + 1
+    conn = db.session.connection()
+    unindex_messages(conn, [(message.id, message.conversation_key, old_content)] if old_content else [])
+    if new_content and message.content_type == 'text':
+        index_message_rows(conn, [{'id': message.id, 'conversation_key': message.conversation_key, SEARCH_TEXT_KEY: new_content}])
+    inbox_changed = inbox.message_edited(conn, message, new_content) if message.content_type == 'text' else None
     db.session.commit()
+    if new_content:
+        cache_plaintext(message.id, message.edit_version, new_content)
+    if inbox_changed is not None:
+        inbox.publish(db.engine, inbox_changed)
 
-    decrypted_content = decrypt_message(encrypted_content) if encrypted_content else new_content
-    room = f"chat_{min(current_user.id, message.receiver_id)}_{max(current_user.id, message.receiver_id)}" if message.receiver_id else f"group_{message.group_id}"
-    emit('message_edited', {
+    room = message.conversation_key
+    socketio.emit('message_edited', {
         'message_id': message.id,
-        'content': decrypted_content,
+        'content': new_content,
         'edited': True
-    }, room=room, broadcast=True)
+    }, room=room)
 
     return jsonify({'message': 'Message edited successfully!'})
 
 @app.route('/set_disappear_timer/<int:message_id>', methods=['POST'])
 @login_required
 def set_disappear_timer(message_id):
-    message = Message.query.get_or_404(message_id)
+    message = get_message_or_404(message_id)
     if message.sender_id != current_user.id:
         return jsonify({'error': 'You can only set timers for your own messages!'}), 403
 
-    timer = int(request.form.get('timer', 0))
-    message.disappear_timer = timer
+    try:
+        timer = parse_disappear_timer(request.form.get('timer')) or 0
+    except ValueError:
+        return jsonify({'error': 'Timer must be a whole number of seconds!'}), 400
+    message.disappear_timer = timer or None
+    message.expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=timer) if timer > 0 else None
     db.session.commit()
+    if message.expires_at:
+        message_expiry.schedule(message.expires_at)
 
-    room = f"chat_{min(current_user.id, message.receiver_id)}_{max(current_user.id, message.receiver_id)}" if message.receiver_id else f"group_{message.group_id}"
-    emit('disappear_timer_set', {
+    room = message.conversation_key
+    socketio.emit('disappear_timer_set', {
         'message_id': message.id,
-        'timer': timer
-    }, room=room, broadcast=True)
+        'timer': timer,
+        'expires_at': message.expires_at.strftime('%Y-%m-%d %H:%M:%S') if message.expires_at else None
+    }, room=room)
 
     return jsonify({'message': 'Disappear timer set successfully!'})
 
@@ -819,58 +3341,1305 @@ def profile():
         if 'profile_pic' in request.files:
             file = request.files['profile_pic']
             if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                user_id = str(current_user.id)
-                ext = filename.rsplit('.', 1)[1].lower()
-                new_filename = f"{user_id}.{ext}"
-                file_path = os.path.join(app.config['PROFILE_PICS_FOLDER'], new_filename)
-                
-                img = Image.open(file)
-                img = img.resize((150, 150), Image.LANCZOS)
-                img.save(file_path)
-
-                current_user.profile_pic = new_filename
-                db.session.commit()
-                flash('Profile picture updated!', 'success')
+                try:
+                    token, source_path = accept_image_upload(file)
+                except ValueError as e:
+                    flash(str(e), 'error')
+                    return redirect(url_for('profile'))
+                media_executor.submit(process_media_upload, 'profile', current_user.id, current_user.id, source_path, token)
+                flash('Profile picture uploaded! It will appear in a moment.', 'success')
             else:
                 flash('Invalid file format!', 'error')
         return redirect(url_for('profile'))
 
     return render_template('profile.html', user=current_user)
 
+# Media serving. Pages link to /media/<fingerprint>/<path>, where the fingerprint changes whenever
+# the file does, so browsers and CDNs may cache it for a year. Conditional and Range requests
+# (video seeking) are answered by send_file; with MEDIA_OFFLOAD the front proxy sends the bytes.
+MEDIA_IMMUTABLE = 'public, max-age=31536000, immutable'
+
+def media_root():
+    return os.path.join(app.root_path, app.config['UPLOAD_FOLDER'])
+
+def media_fingerprint(stat):
+    return hashlib.sha1(f"{stat.st_mtime_ns}:{stat.st_size}".encode()).hexdigest()[:12]
+
+# Fingerprinted URL for a path relative to UPLOAD_FOLDER (plain /uploads URL if it is missing)
+@app.template_global()
+def media_url(filename):
+    try:
+        stat = os.stat(os.path.join(media_root(), filename))
+    except OSError:
+        return f"/uploads/{filename}"
+    return f"/media/{media_fingerprint(stat)}/{quote(filename)}"
+
+def send_media(filename, cache_control):
+    if app.config['MEDIA_OFFLOAD'] == 'nginx':
+        path = safe_join(media_root(), filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        # nginx answers Range and conditional requests for the internal location itself
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = app.config['MEDIA_ACCEL_PREFIX'] + quote(filename)
+    else:
+        response = send_from_directory(app.config['UPLOAD_FOLDER'], filename, conditional=True)
+        response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+@app.route('/media/<fingerprint>/<path:filename>')
+def media_file(fingerprint, filename):
+    path = safe_join(media_root(), filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    # A stale fingerprint still gets the current file, just not cached for long
+    current = fingerprint == media_fingerprint(os.stat(path))
+    return send_media(filename, MEDIA_IMMUTABLE if current else 'no-cache')
+
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_media(filename, 'no-cache')
+
+# Benchmark for the hot query shapes: `flask explain-queries` prints each query's plan and
+# average run time. To compare with the schema before the indexes, run it against a scratch copy
+# of the database: `DATABASE_URL=sqlite:///copy.db AUTO_MIGRATE=0 flask db downgrade 9c3d5b1e7a42`.
+# That downgrade also drops every table added since (inbox, read state, blobs, search, ...), so
+# never point it at the live database.
+@app.cli.command('explain-queries')
+def explain_queries():
+    user_id, other_user_id, group_id, runs = 1, 2, 1, 50
+    conversation_id = db.select(Conversation.id).filter_by(user_id=user_id).limit(1).scalar_subquery()
+    # Only id and content are selected so the plans also work on the pre-index schema
+    rows = db.session.query(Message.id, Message.content)
+    queries = {
+        '1:1 conversation (legacy OR query)': rows.filter(
+            ((Message.sender_id == user_id) & (Message.receiver_id == other_user_id)) |
+            ((Message.sender_id == other_user_id) & (Message.receiver_id == user_id))
+        ).filter(Message.group_id.is_(None)).order_by(Message.timestamp.asc()),
+        '1:1 conversation (conversation_key)': rows.filter(
+            Message.conversation_key == conversation_key(user_id, other_user_id)
+        ).order_by(Message.timestamp.asc(), Message.id.asc()),
+        'group messages': rows.filter(Message.group_id == group_id).order_by(Message.timestamp.asc()),
+        'AI chat history': db.session.query(ChatHistory.id, ChatHistory.bot_reply).filter(
+            ChatHistory.conversation_id == conversation_id
+        ).order_by(ChatHistory.id.asc()),
+        'AI chat sidebar (legacy DISTINCT)': db.session.query(ChatHistory.chat_name).filter_by(user_id=user_id).distinct(),
+        'AI chat sidebar (conversation)': db.session.query(Conversation.id, Conversation.name).filter(
+            Conversation.user_id == user_id, Conversation.turn_count > 0
+        ).order_by(Conversation.last_activity_at.desc(), Conversation.id.desc()).limit(50),
+        'group sidebar': Group.query.join(GroupMember, GroupMember.group_id == Group.id).filter(GroupMember.user_id == user_id)
+    }
+    for label, query in queries.items():
+        sql = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+        try:
+            plan = db.session.execute(db.text(f"EXPLAIN QUERY PLAN {sql}")).fetchall()
+        except Exception as e:
+            db.session.rollback()
+            print(f"{label}: skipped ({str(e).splitlines()[0]})")
+            continue
+        started = time.perf_counter()
+        for _ in range(runs):
+            query.all()
+        elapsed_ms = (time.perf_counter() - started) * 1000 / runs
+        print(f"{label}: {elapsed_ms:.3f} ms")
+        for row in plan:
+            print(f"    {row[-1]}")
+
+# Hands out ids from blocks reserved in id_sequence. Reserving a block is one short write
+# transaction, so separate worker processes never hand out the same id. Ids only go up within a
+# process; with several processes, use a block size of 1 or RedisIdAllocator (see make_message_ids()).
+class IdAllocator:
+    def __init__(self, name, model, block_size, engine=None):
+        self.name = name
+        self.model = model
+        self.block_size = block_size
+        self.engine = engine
+        self.next_id = 0
+        self.limit = 0
+        self.lock = threading.Lock()
+
+    def next(self):
+        with self.lock:
+            if self.next_id >= self.limit:
+                self.next_id, self.limit = self._reserve()
+            value = self.next_id
+            self.next_id += 1
+            return value
+
+    def _reserve(self):
+        engine = self.engine or db.engine
+        # Never below the table's ids, which RedisIdAllocator may have handed out meanwhile
+        start = db.select(db.func.coalesce(db.func.max(self.model.id), 0) + 1).scalar_subquery()
+        with engine.begin() as conn:
+            reserved = conn.execute(
+                db.update(IdSequence).where(IdSequence.name == self.name)
+                .values(next_value=db.func.max(IdSequence.next_value, start) + self.block_size)
+            ).rowcount
+            if not reserved:
+                conn.execute(db.insert(IdSequence).values(name=self.name, next_value=db.select(start + self.block_size).scalar_subquery()))
+            end = conn.execute(db.select(IdSequence.next_value).where(IdSequence.name == self.name)).scalar()
+        return end - self.block_size, end
+
+# One id per INCR on a counter every worker and node shares, so a later message always gets a
+# higher id. The counter never goes below the ids already in the database, which also covers a
+# Redis restart that lost the key.
+class RedisIdAllocator:
+    script = (
+        "local floor = tonumber(ARGV[1]) "
+        "if tonumber(redis.call('get', KEYS[1]) or '0') < floor then redis.call('set', KEYS[1], floor) end "
+        "return redis.call('incr', KEYS[1])"
+    )
+
+    def __init__(self, name, model, url, engine=None):
+        import redis  # Only needed with MESSAGE_ID_REDIS_URL
+        self.name = name
+        self.key = f"id_sequence:{name}"
+        self.model = model
+        self.engine = engine
+        self.floor = None
+        self.redis = redis.Redis.from_url(url)
+        self.increment = self.redis.register_script(self.script)
+
+    def next(self):
+        if self.floor is None:
+            engine = self.engine or db.engine
+            with engine.connect() as conn:
+                self.floor = conn.execute(db.select(db.func.max(
+                    db.func.coalesce(db.select(db.func.max(self.model.id)).scalar_subquery(), 0),
+                    db.func.coalesce(db.select(IdSequence.next_value - 1).where(IdSequence.name == self.name)
+                                     .scalar_subquery(), 0)
+                ))).scalar()
+        return self.increment(keys=[self.key], args=[self.floor])
+
+# Write-behind pipeline for chat messages: send_message puts the row on a bounded queue and fans
+# it out straight away; one writer thread drains the queue and commits whatever has piled up
+# (up to MESSAGE_BATCH_SIZE rows) in a single transaction. Senders get message_stored once their
+# row is committed. A full queue makes submit() wait and then fail (backpressure).
+class MessageWriter:
+    def __init__(self, max_queue, batch_size, put_timeout, engine=None, on_stored=None, on_failed=None):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self.engine = engine
+        self.on_stored = on_stored
+        self.on_failed = on_failed
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, row, sid=None):
+        self._ensure_started()
+        self.queue.put((row, sid), timeout=self.put_timeout)
+
+    # Wait until everything submitted so far is committed
+    def flush(self, timeout=None):
+        if self.thread is None:
+            return True
+        marker = threading.Event()
+        self.queue.put(marker)
+        return marker.wait(timeout)
+
+    def close(self, timeout=10):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join(timeout)
+        self.thread = None
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        with app.app_context():
+            while True:
+                batch = [self.queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                self._write([item for item in batch if isinstance(item, tuple)])
+                for item in batch:
+                    if isinstance(item, threading.Event):
+                        item.set()
+                if None in batch:
+                    return
+
+    def _write(self, items):
+        if not items:
+            return
+        engine = self.engine or db.engine
+        try:
+            with engine.begin() as conn:
+                conn.execute(db.insert(Message), [message_columns(row) for row, sid in items])
+                add_blob_references(conn, [row for row, sid in items])
+                index_message_rows(conn, [row for row, sid in items])
+                inbox.record_messages(conn, [row for row, sid in items])
+            stored, failed = items, []
+        except Exception as e:
+            # Find the bad rows one by one so the rest of the batch still lands
+            logger.error(f"Batch write of {len(items)} messages failed, retrying one by one: {str(e)}")
+            stored, failed = [], []
+            for row, sid in items:
+                try:
+                    with engine.begin() as conn:
+                        conn.execute(db.insert(Message), [message_columns(row)])
+                        add_blob_references(conn, [row])
+                        index_message_rows(conn, [row])
+                        inbox.record_messages(conn, [row])
+                    stored.append((row, sid))
+                except Exception as row_error:
+                    logger.error(f"Message {row['id']} could not be saved: {str(row_error)}")
+                    failed.append((row, sid, row_error))
+        if stored:
+            try:
+                inbox.publish(engine, db.and_(
+                    InboxEntry.conversation_key.in_({row['conversation_key'] for row, sid in stored}),
+                    InboxEntry.last_message_id.in_([row['id'] for row, sid in stored])
+                ))
+            except Exception as e:
+                logger.error(f"Error publishing inbox updates: {str(e)}")
+        for row, sid in stored:
+            if self.on_stored:
+                self.on_stored(row, sid)
+        for row, sid, error in failed:
+            if self.on_failed:
+                self.on_failed(row, sid, error)
+
+# Counts the attachments of newly stored messages, in the same transaction as the rows
+def add_blob_references(conn, rows, delta=1):
+    counts = {}
+    for row in rows:
+        if row.get('file_path'):
+            counts[row['file_path']] = counts.get(row['file_path'], 0) + 1
+    for file_path, count in counts.items():
+        conn.execute(db.update(Blob).where(Blob.file_path == file_path).values(ref_count=Blob.ref_count + delta * count))
+
+def message_stored(row, sid):
+    if row.get('receiver_id'):
+        directory.invalidate(row['sender_id'], row['receiver_id'])
+    if sid:
+        socketio.emit('message_stored', {'message_id': row['id'], 'conversation_key': row['conversation_key']}, to=sid)
+
+def message_failed(row, sid, error):
+    socketio.emit('message_failed', {'message_id': row['id'], 'conversation_key': row['conversation_key']}, room=row['conversation_key'])
+
+# Read watermarks, unread counts and the inbox all assume a later message has a higher id. Blocks
+# only keep that within one process, so several workers (a message queue other than local://)
+# share one counter: MESSAGE_ID_REDIS_URL, or else id_sequence one id at a time.
+def make_message_ids():
+    if app.config['MESSAGE_ID_REDIS_URL']:
+        return RedisIdAllocator('message', Message, app.config['MESSAGE_ID_REDIS_URL'])
+    block_size = app.config['MESSAGE_ID_BLOCK']
+    message_queue = app.config['SOCKETIO_MESSAGE_QUEUE']
+    if message_queue and not message_queue.startswith('local://') and block_size > 1:
+        logger.warning("Several workers share SOCKETIO_MESSAGE_QUEUE; reserving message ids one at a time. "
+                       "Set MESSAGE_ID_REDIS_URL to take them from Redis instead")
+        block_size = 1
+    return IdAllocator('message', Message, block_size)
+
+message_ids = make_message_ids()
+message_writer = MessageWriter(
+    app.config['MESSAGE_QUEUE_SIZE'],
+    app.config['MESSAGE_BATCH_SIZE'],
+    app.config['MESSAGE_QUEUE_TIMEOUT'],
+    on_stored=message_stored,
+    on_failed=message_failed
+)
+atexit.register(message_writer.close)
+
+# Disappearing messages: Message.expires_at (indexed) is the source of truth. The scheduler keeps a
+# heap of upcoming deadlines, sleeps until the earliest, then deletes every due message in batches
+# and sends each room one messages_expired event with the ids. After each pass, and at least every
+# EXPIRY_HORIZON seconds, the next deadline is read back from the index, which covers restarts and
+# timers set on other workers.
+class ExpiryScheduler:
+    slack = 0.25  # Seconds a pass waits past a deadline, so messages sent together expire together
+
+    def __init__(self, horizon, batch_size):
+        self.horizon = horizon
+        self.batch_size = batch_size
+        self.heap = []
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def schedule(self, expires_at):
+        self.start()
+        with self.condition:
+            heapq.heappush(self.heap, expires_at.replace(tzinfo=datetime.timezone.utc).timestamp())
+            self.condition.notify()
+
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='message-expiry', daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        with app.app_context():
+            while True:
+                self._load_next_deadline()
+                with self.condition:
+                    checked_at = time.time()
+                    while True:
+                        now = time.time()
+                        wake_at = min(self.heap[0] + self.slack if self.heap else float('inf'), checked_at + self.horizon)
+                        if wake_at <= now:
+                            break
+                        self.condition.wait(wake_at - now)
+                    while self.heap and self.heap[0] <= now:
+                        heapq.heappop(self.heap)
+                try:
+                    # Messages sent just before their deadline may still be on the write queue
+                    message_writer.flush(timeout=app.config['MESSAGE_QUEUE_TIMEOUT'])
+                    removed = self.expire_due()
+                    if removed:
+                        logger.debug("Expired %d disappearing messages", removed)
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Error expiring messages: {str(e)}")
+                finally:
+                    db.session.remove()
+
+    def _load_next_deadline(self):
+        next_expiry = db.session.scalar(db.select(db.func.min(Message.expires_at)))
+        db.session.remove()
+        if next_expiry is not None:
+            with self.condition:
+                heapq.heappush(self.heap, next_expiry.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+    # Deletes due messages a batch at a time; DELETE ... RETURNING hands each row to one worker only
+    def expire_due(self):
+        total = 0
+        while True:
+            due = db.select(Message.id).where(Message.expires_at <= datetime.datetime.utcnow()).order_by(
+                Message.expires_at).limit(self.batch_size).scalar_subquery()
+            with db.engine.begin() as conn:
+                rows = conn.execute(db.delete(Message).where(Message.id.in_(due)).returning(
+                    Message.id, Message.conversation_key, Message.file_path, Message.edit_version,
+                    Message.content, Message.content_type)).all()
+                add_blob_references(conn, [{'file_path': row.file_path} for row in rows], delta=-1)
+                unindex_messages(conn, [
+                    (row.id, row.conversation_key, decrypt_message(row.content))
+                    for row in rows if row.content and row.content_type == 'text'
+                ])
+                inbox_changed = inbox.refresh(conn, {row.conversation_key for row in rows})
+            if rows:
+                inbox.publish(db.engine, inbox_changed)
+
+            expired = {}
+            for row in rows:
+                expired.setdefault(row.conversation_key, []).append(row.id)
+                plaintext_cache.delete((row.id, row.edit_version or 0))
+            for room, message_ids in expired.items():
+                socketio.emit('messages_expired', {'conversation_key': room, 'message_ids': message_ids}, room=room)
+            total += len(rows)
+            if len(rows) < self.batch_size:
+                return total
+
+message_expiry = ExpiryScheduler(app.config['EXPIRY_HORIZON'], app.config['EXPIRY_BATCH'])
+# Started with the app, so messages left by a previous run expire before anyone connects
+if schema_ready:
+    message_expiry.start()
+
+# Seconds for a disappearing-message timer, or None when it is off. Raises ValueError for
+# anything but a whole number of seconds up to MAX_DISAPPEAR_TIMER.
+def parse_disappear_timer(value):
+    if value in (None, ''):
+        return None
+    if isinstance(value, (bool, float)):
+        raise ValueError(f"Invalid disappear timer {value!r}")
+    timer = int(value)
+    if not 0 <= timer <= app.config['MAX_DISAPPEAR_TIMER']:
+        raise ValueError(f"Disappear timer {timer} out of range")
+    return timer or None
+
+# Presence: live connection counts per user, kept in memory (one worker) or in Redis (several)
+class MemoryPresenceBackend:
+    def __init__(self):
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def connect(self, user_id):
+        with self.lock:
+            self.connections[user_id] = self.connections.get(user_id, 0) + 1
+            return self.connections[user_id]
+
+    def disconnect(self, user_id):
+        with self.lock:
+            count = max(self.connections.get(user_id, 0) - 1, 0)
+            if count:
+                self.connections[user_id] = count
+            else:
+                self.connections.pop(user_id, None)
+            return count
+
+    def count(self, user_id):
+        with self.lock:
+            return self.connections.get(user_id, 0)
+
+class RedisPresenceBackend:
+    key = 'presence:connections'
+
+    def __init__(self, url):
+        import redis  # Only needed with PRESENCE_BACKEND=redis
+        self.redis = redis.Redis.from_url(url)
+
+    def connect(self, user_id):
+        return self.redis.hincrby(self.key, user_id, 1)
+
+    def disconnect(self, user_id):
+        count = self.redis.hincrby(self.key, user_id, -1)
+        if count <= 0:
+            self.redis.hdel(self.key, user_id)
+        return max(count, 0)
+
+    def count(self, user_id):
+        return int(self.redis.hget(self.key, user_id) or 0)
+
+def make_presence_backend():
+    if app.config['PRESENCE_BACKEND'] == 'redis':
+        return RedisPresenceBackend(app.config['PRESENCE_REDIS_URL'])
+    return MemoryPresenceBackend()
+
+# Presence tracker: a user goes offline only after PRESENCE_DEBOUNCE seconds without any socket,
+# so reconnect flaps cause no events and no writes. Changes go to the user_<id> rooms of people
+# who share a 1:1 chat or a group with the user, and last_seen/is_online reach the database in
+# one batched UPDATE every PRESENCE_FLUSH_INTERVAL seconds.
+class PresenceTracker:
+    def __init__(self, backend, debounce, flush_interval, contacts_ttl, contacts_max):
+        self.backend = backend
+        self.debounce = debounce
+        self.flush_interval = flush_interval
+        self.contacts_ttl = contacts_ttl
+        self.contacts_max = contacts_max
+        self.offline_timers = {}
+        self.dirty = {}
+        self.contacts_cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.flusher = None
+
+    def connect(self, user_id):
+        with self.lock:
+            timer = self.offline_timers.pop(user_id, None)
+        if timer:
+            timer.cancel()
+        count = self.backend.connect(user_id)
+        if count == 1 and timer is None:
+            self._changed(user_id, True)
+
+    def disconnect(self, user_id):
+        if self.backend.disconnect(user_id):
+            return
+        timer = threading.Timer(self.debounce, self._expire)
+        timer.args = (user_id, timer)
+        timer.daemon = True
+        with self.lock:
+            previous = self.offline_timers.pop(user_id, None)
+            self.offline_timers[user_id] = timer
+        if previous:
+            previous.cancel()
+        timer.start()
+
+    def touch(self, user_id, is_online):
+        with self.lock:
+            self.dirty[user_id] = (is_online, datetime.datetime.utcnow())
+        self._ensure_flusher()
+
+    def is_online(self, user_id):
+        return self.backend.count(user_id) > 0
+
+    def add_contact(self, user_id, other_user_id):
+        with self.lock:
+            for a, b in ((user_id, other_user_id), (other_user_id, user_id)):
+                cached = self.contacts_cache.get(a)
+                if cached:
+                    cached[1].add(b)
+
+    def _expire(self, user_id, timer):
+        with self.lock:
+            # A reconnect that raced with this timer already took it out
+            if self.offline_timers.get(user_id) is not timer:
+                return
+            del self.offline_timers[user_id]
+        if self.backend.count(user_id) == 0:
+            self._changed(user_id, False)
+
+    def _changed(self, user_id, is_online):
+        self.touch(user_id, is_online)
+        payload = {'user_id': user_id, 'status': 'online' if is_online else 'offline'}
+        if not is_online:
+            payload['last_seen'] = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        for contact_id in self.contacts(user_id):
+            socketio.emit('user_status', payload, room=f"user_{contact_id}")
+
+    def contacts(self, user_id):
+        with self.lock:
+            cached = self.contacts_cache.get(user_id)
+            if cached and cached[0] > time.time():
+                self.contacts_cache.move_to_end(user_id)
+                return set(cached[1])
+            self.contacts_cache.pop(user_id, None)
+        # 1:1 peers come from the inbox, which already has one row per conversation
+        with app.app_context():
+            chat_peers = db.session.query(InboxEntry.peer_id).filter(InboxEntry.user_id == user_id, InboxEntry.peer_id.isnot(None))
+            my_groups = db.session.query(GroupMember.group_id).filter(GroupMember.user_id == user_id)
+            group_peers = db.session.query(GroupMember.user_id).filter(GroupMember.group_id.in_(my_groups))
+            contacts = {row[0] for row in chat_peers.union(group_peers).all()}
+        contacts.discard(user_id)
+        with self.lock:
+            self.contacts_cache[user_id] = (time.time() + self.contacts_ttl, contacts)
+            self.contacts_cache.move_to_end(user_id)
+            while len(self.contacts_cache) > self.contacts_max:
+                self.contacts_cache.popitem(last=False)
+        return set(contacts)
+
+    def _ensure_flusher(self):
+        with self.lock:
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self._flush_loop, name='presence-flush', daemon=True)
+                self.flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+        if not dirty:
+            return
+        try:
+            with app.app_context():
+                db.session.execute(db.update(User), [
+                    {'id': user_id, 'is_online': is_online, 'last_seen': last_seen}
+                    for user_id, (is_online, last_seen) in dirty.items()
+                ])
+                db.session.commit()
+        except Exception as e:
+            logger.error(f"Error saving presence for {len(dirty)} users: {str(e)}")
+
+presence = PresenceTracker(
+    make_presence_backend(),
+    app.config['PRESENCE_DEBOUNCE'],
+    app.config['PRESENCE_FLUSH_INTERVAL'],
+    app.config['PRESENCE_CONTACTS_TTL'],
+    app.config['PRESENCE_CONTACTS_MAX']
+)
+atexit.register(presence.flush)
+
+# Typing indicators: typing/stop_typing only update who is typing in each room. Once per
+# TYPING_INTERVAL, rooms whose typists changed get one typing_update event listing who started
+# and who stopped. Sending changes rather than the full list lets several workers, each knowing
+# only its own typists, update the same room without overwriting each other.
+# Entries expire after TYPING_TTL, so a client that vanishes without stop_typing drops out.
+class TypingAggregator:
+    def __init__(self, interval, ttl):
+        self.interval = interval
+        self.ttl = ttl
+        self.rooms = {}
+        self.changes = {}  # room -> {user_id: username, or None once they stopped}
+        self.lock = threading.Lock()
+        self.ticker = None
+
+    def typing(self, room, user_id, username):
+        with self.lock:
+            typists = self.rooms.setdefault(room, {})
+            if user_id not in typists:
+                self.changes.setdefault(room, {})[user_id] = username
+            typists[user_id] = (username, time.time() + self.ttl)
+        self._ensure_ticker()
+
+    def stop(self, room, user_id):
+        with self.lock:
+            if self.rooms.get(room, {}).pop(user_id, None):
+                self.changes.setdefault(room, {})[user_id] = None
+
+    def leave_all(self, user_id):
+        with self.lock:
+            for room, typists in self.rooms.items():
+                if typists.pop(user_id, None):
+                    self.changes.setdefault(room, {})[user_id] = None
+
+    def _ensure_ticker(self):
+        with self.lock:
+            if self.ticker is None:
+                self.ticker = threading.Thread(target=self._tick_loop, name='typing-ticker', daemon=True)
+                self.ticker.start()
+
+    def _tick_loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.tick()
+
+    def tick(self):
+        now = time.time()
+        with self.lock:
+            for room, typists in list(self.rooms.items()):
+                for user_id, (_, expires_at) in list(typists.items()):
+                    if expires_at <= now:
+                        del typists[user_id]
+                        self.changes.setdefault(room, {})[user_id] = None
+                if not typists:
+                    del self.rooms[room]
+            changes, self.changes = self.changes, {}
+        for room, users in changes.items():
+            started = [{'user_id': user_id, 'username': username} for user_id, username in users.items() if username is not None]
+            stopped = [user_id for user_id, username in users.items() if username is None]
+            socketio.emit('typing_update', {'room': room, 'started': started, 'stopped': stopped}, room=room)
+
+typing_indicators = TypingAggregator(app.config['TYPING_INTERVAL'], app.config['TYPING_TTL'])
+
+# Read receipts: acks arriving within READ_RECEIPT_WINDOW are coalesced per (user, conversation)
+# into the highest message id, written with one statement and announced with one read_up_to event
+class ReadReceiptBatcher:
+    def __init__(self, window):
+        self.window = window
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def ack(self, user_id, key, message_id):
+        with self.lock:
+            entry = (user_id, key)
+            self.pending[entry] = max(self.pending.get(entry, 0), message_id)
+            if self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            watermarks, self.pending, self.timer = self.pending, {}, None
+        if not watermarks:
+            return
+        try:
+            with app.app_context():
+                advance_read_states(watermarks)
+        except Exception as e:
+            logger.error(f"Error saving read receipts: {str(e)}")
+            return
+        for (user_id, key), message_id in watermarks.items():
+            socketio.emit('read_up_to', {'conversation_key': key, 'user_id': user_id, 'message_id': message_id}, room=key)
+        try:
+            with app.app_context():
+                inbox.publish(db.engine, inbox.mark_read(watermarks))
+        except Exception as e:
+            logger.error(f"Error updating unread counts: {str(e)}")
+
+read_receipts = ReadReceiptBatcher(app.config['READ_RECEIPT_WINDOW'])
+
+# Benchmark for message ingestion: `flask bench-messages` sends --count messages into a scratch
+# database, once with a commit per message (the old send_message path) and once through the
+# write-behind pipeline, and prints messages/sec for each.
+@app.cli.command('bench-messages')
+@click.option('--count', default=2000, help='Messages sent per run.')
+def bench_messages(count):
+    def make_row(i):
+        return {
+            'sender_id': 1,
+            'receiver_id': 2,
+            'content': encrypt_message(f"bench message {i}"),
+            'content_type': 'text',
+            'conversation_key': conversation_key(1, 2)
+        }
+
+    with tempfile.TemporaryDirectory() as scratch:
+        engine = create_engine(f"sqlite:///{os.path.join(scratch, 'bench.db')}")
+        db.metadata.create_all(engine)
+
+        started = time.perf_counter()
+        with Session(engine) as bench_session:
+            for i in range(count):
+                message = Message(**make_row(i))
+                bench_session.add(message)
+                bench_session.commit()
+                decrypt_message(message.content)
+        elapsed = time.perf_counter() - started
+        print(f"commit per message: {count / elapsed:.0f} msg/s")
+
+        ids = IdAllocator('message', Message, app.config['MESSAGE_ID_BLOCK'], engine=engine)
+        writer = MessageWriter(app.config['MESSAGE_QUEUE_SIZE'], app.config['MESSAGE_BATCH_SIZE'],
+                               app.config['MESSAGE_QUEUE_TIMEOUT'], engine=engine)
+        started = time.perf_counter()
+        for i in range(count):
+            row = make_row(i)
+            row.update(id=ids.next(), timestamp=datetime.datetime.utcnow())
+            writer.submit(row)
+        accepted = time.perf_counter() - started
+        writer.flush()
+        committed = time.perf_counter() - started
+        writer.close()
+        print(f"write-behind, ready to fan out: {count / accepted:.0f} msg/s")
+        print(f"write-behind, committed: {count / committed:.0f} msg/s")
+        engine.dispose()
+
+# Microbenchmark for message crypto: `flask bench-crypto` prints the per-message cost of
+# encrypting, decrypting, the old send path (encrypt then decrypt again) and a cached page read.
+@app.cli.command('bench-crypto')
+@click.option('--count', default=5000, help='Messages per measurement.')
+def bench_crypto(count):
+    texts = [f"bench message {i} " + "x" * (i % 200) for i in range(count)]
+
+    def per_message_us(fn):
+        started = time.perf_counter()
+        result = fn()
+        return (time.perf_counter() - started) * 1e6 / count, result
+
+    encrypt_us, tokens = per_message_us(lambda: [encrypt_message(text) for text in texts])
+    decrypt_us, _ = per_message_us(lambda: [decrypt_message(token) for token in tokens])
+    round_trip_us, _ = per_message_us(lambda: [decrypt_message(encrypt_message(text)) for text in texts])
+
+    messages = [Message(id=-(i + 1), content=token, content_type='text', edit_version=0) for i, token in enumerate(tokens)]
+    cold_us, _ = per_message_us(lambda: decrypt_messages(messages))
+    warm_us, _ = per_message_us(lambda: decrypt_messages(messages))
+    for message in messages:
+        plaintext_cache.delete((message.id, 0))
+
+    print(f"encrypt:                        {encrypt_us:8.1f} us/message")
+    print(f"decrypt:                        {decrypt_us:8.1f} us/message")
+    print(f"old send path (encrypt+decrypt):{round_trip_us:8.1f} us/message")
+    print(f"page decrypt, cold cache:       {cold_us:8.1f} us/message")
+    print(f"page decrypt, warm cache:       {warm_us:8.1f} us/message")
+
+# Garbage collection for attachments: `flask gc-blobs` recounts each blob's references from the
+# message table, deletes blobs nobody has used for BLOB_GC_GRACE seconds (long enough for an
+# upload to be sent) and drops uploads idle for longer than UPLOAD_SESSION_TTL.
+@app.cli.command('gc-blobs')
+@click.option('--dry-run', is_flag=True, help='Only report what would be removed.')
+def gc_blobs(dry_run):
+    counts = dict(db.session.execute(
+        db.select(Message.file_path, db.func.count()).where(Message.file_path.isnot(None)).group_by(Message.file_path)
+    ).all())
+    now = datetime.datetime.utcnow()
+    blob_cutoff = now - datetime.timedelta(seconds=app.config['BLOB_GC_GRACE'])
+    removed, freed = 0, 0
+    for blob in Blob.query.all():
+        blob.ref_count = counts.get(blob.file_path, 0)
+        if blob.ref_count == 0 and blob.last_used_at < blob_cutoff:
+            removed += 1
+            freed += blob.size
+            if not dry_run:
+                db.session.delete(blob)
+                try:
+                    os.remove(os.path.join(app.config['UPLOAD_FOLDER'], blob.file_path))
+                except FileNotFoundError:
+                    pass
+
+    session_cutoff = now - datetime.timedelta(seconds=app.config['UPLOAD_SESSION_TTL'])
+    stale = UploadSession.query.filter(UploadSession.updated_at < session_cutoff).all()
+    for upload in stale:
+        if not dry_run:
+            db.session.delete(upload)
+            if os.path.exists(partial_upload_path(upload.id)):
+                os.remove(partial_upload_path(upload.id))
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.commit()
+    print(f"{'Would remove' if dry_run else 'Removed'} {removed} blobs ({freed / 1e6:.1f} MB) and {len(stale)} stale uploads")
+
+# Deletes expired statuses now instead of waiting for the sweeper thread
+@app.cli.command('sweep-statuses')
+def sweep_statuses():
+    print(f"Removed {status_feed.sweep()} expired statuses")
+
+# Sends the emails in dead_letter_email again (all of them, or just --id); the rows are removed
+# once the sender has finished, and emails that fail again get new rows
+@app.cli.command('mail-requeue')
+@click.option('--id', 'ids', type=int, multiple=True, help='Dead letter id (repeatable).')
+def mail_requeue(ids):
+    query = DeadLetterEmail.query.order_by(DeadLetterEmail.id)
+    if ids:
+        query = query.filter(DeadLetterEmail.id.in_(ids))
+    letters = query.all()
+    for letter in letters:
+        mail_sender.submit(letter.to_email, letter.subject, letter.body, block=True)
+    mail_sender.close(timeout=None)
+    for letter in letters:
+        db.session.delete(letter)
+    db.session.commit()
+    print(f"Requeued {len(letters)} emails, {DeadLetterEmail.query.count()} dead letters left")
+
+# Runs the local SMTP sink and prints every email it receives
+@app.cli.command('mail-sink')
+@click.option('--host', default='localhost')
+@click.option('--port', default=1025, type=int)
+def mail_sink(host, port):
+    def show(mail_from, recipients, data):
+        message = message_from_bytes(data)
+        parts = [part.get_payload(decode=True).decode('utf-8', 'replace')
+                 for part in message.walk() if part.get_content_type() == 'text/plain']
+        print(f"From: {mail_from}\nTo: {', '.join(recipients)}\nSubject: {message['Subject']}\n\n"
+              f"{''.join(parts).strip()}\n{'-' * 60}", flush=True)
+
+    with SmtpSink((host, port), show) as sink:
+        print(f"SMTP sink listening on {host}:{port} (MAIL_SERVER={host} MAIL_PORT={port} MAIL_STARTTLS=0)")
+        try:
+            sink.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+# Recomputes every inbox entry (last message, preview, unread count) from the messages, --batch-size
+# conversations per transaction. Run once after the inbox migration to fill in previews, and after
+# removing an old AES key, since previews are encrypted like messages.
+@app.cli.command('inbox-rebuild')
+@click.option('--batch-size', default=200, help='Conversations per transaction.')
+def inbox_rebuild(batch_size):
+    keys = db.session.scalars(db.select(InboxEntry.conversation_key).distinct().order_by(InboxEntry.conversation_key)).all()
+    db.session.remove()
+    for start in range(0, len(keys), batch_size):
+        with db.engine.begin() as conn:
+            inbox.refresh(conn, keys[start:start + batch_size])
+    print(f"Rebuilt the inbox entries of {len(keys)} conversations")
+
+# Indexes chat history and messages stored before search existed, --batch-size rows per
+# transaction, skipping rows that are already indexed; safe to stop and run again
+@app.cli.command('search-backfill')
+@click.option('--batch-size', default=None, type=int, help='Rows per transaction (default SEARCH_BACKFILL_BATCH).')
+def search_backfill(batch_size):
+    batch_size = batch_size or app.config['SEARCH_BACKFILL_BATCH']
+    started = time.perf_counter()
+
+    indexed, after = 0, 0
+    while True:
+        ids = db.session.execute(db.select(ChatHistory.id).where(ChatHistory.id > after).order_by(ChatHistory.id).limit(batch_size)).scalars().all()
+        if not ids:
+            break
+        result = db.session.execute(db.text(
+            "INSERT INTO chat_history_fts (rowid, scope, user_message, bot_reply) "
+            "SELECT h.id, 'u' || h.user_id, h.user_message, h.bot_reply FROM chat_history h "
+            "WHERE h.id BETWEEN :first AND :last AND NOT EXISTS (SELECT 1 FROM chat_history_fts f WHERE f.rowid = h.id)"
+        ), {'first': ids[0], 'last': ids[-1]})
+        db.session.commit()
+        indexed += result.rowcount
+        after = ids[-1]
+    print(f"chat history: indexed {indexed} turns")
+
+    indexed, after = 0, 0
+    while True:
+        batch = Message.query.filter(Message.id > after).order_by(Message.id).limit(batch_size).all()
+        if not batch:
+            break
+        after = batch[-1].id
+        done = set(db.session.execute(db.text(
+            "SELECT rowid FROM message_fts WHERE rowid BETWEEN :first AND :last"
+        ), {'first': batch[0].id, 'last': after}).scalars())
+        pending = [message for message in batch if message.content and message.content_type == 'text' and message.id not in done]
+        plaintexts = decrypt_messages(pending)
+        index_message_rows(db.session.connection(), [
+            {'id': message.id, 'conversation_key': message.conversation_key, SEARCH_TEXT_KEY: plaintexts[message.id]}
+            for message in pending
+        ])
+        db.session.commit()
+        db.session.expunge_all()
+        indexed += len(pending)
+    print(f"messages: indexed {indexed} messages")
+    print(f"done in {time.perf_counter() - started:.1f} s")
+
+# Benchmark for search: `flask bench-search --rows 1000000` fills a scratch database with --rows
+# AI chat turns spread over 1,000 users, then times ranked, snippeted queries for one user.
+@app.cli.command('bench-search')
+@click.option('--rows', default=200000)
+@click.option('--queries', default=50)
+def bench_search(rows, queries):
+    vocabulary = [''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(random.randint(3, 9))) for _ in range(20000)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))  # Zipf-like, as in real text
+
+    with tempfile.TemporaryDirectory() as scratch:
+        engine = create_engine(f"sqlite:///{os.path.join(scratch, 'bench.db')}")
+        with engine.begin() as conn:
+            for statement in SEARCH_SCHEMA:
+                conn.execute(db.text(statement))
+        started = time.perf_counter()
+        with engine.begin() as conn:
+            for first in range(0, rows, 10000):
+                conn.execute(db.text("INSERT INTO chat_history_fts (rowid, scope, user_message, bot_reply) VALUES (:id, :scope, :q, :a)"), [
+                    {'id': i + 1, 'scope': f"u{i % 1000}", 'q': ' '.join(random.choices(vocabulary, cum_weights=cum_weights, k=12)),
+                     'a': ' '.join(random.choices(vocabulary, cum_weights=cum_weights, k=60))}
+                    for i in range(first, min(first + 10000, rows))
+                ])
+        print(f"indexed {rows} turns in {time.perf_counter() - started:.1f} s")
+
+        with engine.connect() as conn:
+            for label, pick in (('common word', lambda: random.choice(vocabulary[:20])),
+                                ('rare word', lambda: random.choice(vocabulary[5000:])),
+                                ('two-word prefix', lambda: f"{random.choice(vocabulary[:200])} {random.choice(vocabulary[:2000])[:3]}")):
+                times = []
+                for _ in range(queries):
+                    query, _ = search_terms(pick())
+                    started = time.perf_counter()
+                    conn.execute(db.text(
+                        "SELECT rowid, snippet(chat_history_fts, 2, '[', ']', '…', 16) FROM chat_history_fts "
+                        "WHERE chat_history_fts MATCH :match ORDER BY rank LIMIT 21"
+                    ), {'match': f"scope : u{random.randint(0, 999)} AND {{user_message bot_reply}} : ({query})"}).all()
+                    times.append(time.perf_counter() - started)
+                times.sort()
+                print(f"{label:<16} p50 {times[len(times) // 2] * 1000:7.1f} ms   p95 {times[int(len(times) * 0.95)] * 1000:7.1f} ms")
+        engine.dispose()
+
+# Compares sending inline with a new connection per email (what the request handlers used to do)
+# with the queued sender, against a local sink that takes --connect-ms to greet each connection
+@app.cli.command('bench-mail')
+@click.option('--count', default=500, help='Emails sent through the queued sender.')
+@click.option('--connect-ms', default=250.0, help='Sink delay per new connection (TLS handshake and login).')
+def bench_mail(count, connect_ms):
+    received = []
+    sink = SmtpSink(('127.0.0.1', 0), lambda mail_from, recipients, data: received.append(recipients),
+                    connect_delay=connect_ms / 1000)
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+    host, port = sink.server_address
+
+    def connect():
+        server = smtplib.SMTP(host, port, timeout=10)
+        server.login('bench', 'bench')
+        return server
+
+    def mail(number):
+        return {'to': f'user{number}@example.com', 'subject': 'Bench', 'body': f'Your code is {number:06d}'}
+
+    inline = min(count, 20)
+    started = time.perf_counter()
+    for number in range(inline):
+        server = connect()
+        server.sendmail(app.config['MAIL_FROM'], mail(number)['to'], MailSender._render(mail(number)))
+        server.quit()
+    inline_ms = (time.perf_counter() - started) / inline * 1000
+    print(f"inline: {inline_ms:.1f} ms per email in the request, {1000 / inline_ms:.1f} emails/s")
+
+    sender = MailSender(app.config['MAIL_WORKERS'], count, 1, 1, app.config['MAIL_IDLE_TIMEOUT'],
+                        app.config['MAIL_MAX_PER_CONNECTION'], 0, connect=connect)
+    received.clear()
+    submit_times = []
+    started = time.perf_counter()
+    for number in range(count):
+        submitted = time.perf_counter()
+        email = mail(number)
+        sender.submit(email['to'], email['subject'], email['body'])
+        submit_times.append(time.perf_counter() - submitted)
+    sender.close(timeout=None)
+    elapsed = time.perf_counter() - started
+    submit_times.sort()
+    print(f"queued: {submit_times[len(submit_times) // 2] * 1e6:.0f} us p50 / {submit_times[int(len(submit_times) * 0.99)] * 1e6:.0f} us p99 "
+          f"in the request, {len(received)}/{count} delivered in {elapsed:.2f}s ({len(received) / elapsed:.0f} emails/s, "
+          f"{app.config['MAIL_WORKERS']} connections reused up to {app.config['MAIL_MAX_PER_CONNECTION']} times)")
+    sink.shutdown()
+    sink.server_close()
+
+# Times the messaging page's user list the old way (every account) against the directory (recent
+# correspondents, one search page) in a scratch database with --users accounts, the first of which
+# has --contacts 1:1 chats in its inbox
+@app.cli.command('bench-directory')
+@click.option('--users', default=100000, help='Accounts in the scratch database.')
+@click.option('--contacts', default=200, help='Chats in the viewer\'s inbox.')
+@click.option('--runs', default=20)
+def bench_directory(users, contacts, runs):
+    viewer_id = 1
+    contacts = min(contacts, users - 1)
+    syllables = ['ka', 'ri', 'an', 'su', 'mo', 'ne', 'ta', 'vi', 'ra', 'jo', 'li', 'pa']
+    with tempfile.TemporaryDirectory() as scratch:
+        engine = create_engine(f"sqlite:///{os.path.join(scratch, 'bench.db')}")
+        db.metadata.create_all(engine)
+        started = time.perf_counter()
+        with engine.begin() as conn:
+            for offset in range(0, users, 10000):
+                conn.execute(db.insert(User), [{
+                    'id': viewer_id + number,
+                    'username': ''.join(random.choices(syllables, k=3)) + str(number),
+                    'public_username': f"{''.join(random.choices(syllables, k=2))}_{number}" if number % 3 == 0 else None,
+                    'password_hash': 'bench'
+                } for number in range(offset, min(users, offset + 10000))])
+            now = datetime.datetime.utcnow()
+            conn.execute(db.insert(InboxEntry), [{
+                'user_id': viewer_id,
+                'conversation_key': conversation_key(viewer_id, peer_id),
+                'peer_id': peer_id,
+                'last_message_id': peer_id,
+                'last_sender_id': peer_id,
+                'last_message_type': 'text',
+                'last_message_at': now - datetime.timedelta(seconds=peer_id),
+                'unread_count': 0
+            } for peer_id in range(viewer_id + 1, viewer_id + 1 + contacts)])
+        print(f"Added {users} users and {contacts} inbox entries in {time.perf_counter() - started:.1f}s")
+
+        def timed(runs, function):
+            times = []
+            for _ in range(runs):
+                started = time.perf_counter()
+                result = function()
+                times.append(time.perf_counter() - started)
+            times.sort()
+            return times[len(times) // 2] * 1000, result
+
+        with Session(engine) as bench_session:
+            def load_everyone():
+                return [{'id': user.id, 'username': user.username, 'profile_pic': user.profile_pic}
+                        for user in bench_session.query(User).filter(User.id != viewer_id).all()]
+
+            old_ms, everyone = timed(min(runs, 3), load_everyone)
+            recent_ms, recent = timed(runs, lambda: directory._load_recent(viewer_id, session=bench_session))
+            search_ms, page = timed(runs, lambda: directory._search('kari', None, app.config['DIRECTORY_PAGE_SIZE'], session=bench_session))
+            deep_ms, _ = timed(runs, lambda: directory._search('kari', Directory.decode_cursor(page['next_cursor']),
+                                                               app.config['DIRECTORY_PAGE_SIZE'], session=bench_session) if page['next_cursor'] else None)
+        engine.dispose()
+    print(f"all users:      {old_ms:8.1f} ms, {len(json.dumps(everyone)) / 1e6:.1f} MB in the page")
+    print(f"recent ({len(recent)}):    {recent_ms:8.1f} ms, {len(json.dumps(recent)) / 1e3:.1f} kB in the page")
+    print(f"search 'kari':  {search_ms:8.1f} ms for {len(page['users'])} users, next page {deep_ms:.1f} ms")
+
+# Compares working out the sidebar (last message and unread count of each chat) by querying the
+# messages of every contact with one inbox page, in a scratch database filled through the
+# message writer with --contacts chats and --messages messages
+@app.cli.command('bench-inbox')
+@click.option('--contacts', default=500)
+@click.option('--messages', default=200000)
+@click.option('--runs', default=20)
+def bench_inbox(contacts, messages, runs):
+    with tempfile.TemporaryDirectory() as scratch:
+        engine = create_engine(f"sqlite:///{os.path.join(scratch, 'bench.db')}")
+        db.metadata.create_all(engine)
+        with engine.begin() as conn:
+            for statement in SEARCH_SCHEMA:
+                conn.execute(db.text(statement))
+            conn.execute(db.insert(User), [{'id': user_id, 'username': f'bench{user_id}', 'password_hash': 'bench'}
+                                           for user_id in range(1, contacts + 2)])
+        ids = IdAllocator('message', Message, app.config['MESSAGE_ID_BLOCK'], engine=engine)
+        writer = MessageWriter(app.config['MESSAGE_QUEUE_SIZE'], app.config['MESSAGE_BATCH_SIZE'],
+                               app.config['MESSAGE_QUEUE_TIMEOUT'], engine=engine)
+        started = time.perf_counter()
+        for number in range(messages):
+            peer = 2 + random.randrange(contacts)
+            sender, receiver = (1, peer) if random.random() < 0.5 else (peer, 1)
+            writer.submit({
+                'id': ids.next(), 'sender_id': sender, 'receiver_id': receiver, 'group_id': None,
+                'content': encrypt_message(f'bench message {number}'), 'content_type': 'text', 'file_path': None,
+                'timestamp': datetime.datetime.utcnow(), 'is_read': False, 'conversation_key': conversation_key(sender, receiver),
+                SEARCH_TEXT_KEY: f'bench message {number}'
+            })
+        writer.flush()
+        writer.close()
+        print(f"Stored {messages} messages with inbox updates: {messages / (time.perf_counter() - started):.0f} msg/s")
+
+        with engine.begin() as conn:
+            conn.execute(db.insert(ReadState), [{'user_id': 1, 'conversation_key': conversation_key(1, peer),
+                                                 'last_read_message_id': messages // 2, 'updated_at': datetime.datetime.utcnow()}
+                                                for peer in range(2, contacts + 2)])
+
+        def per_contact_scan(conn):
+            chats = []
+            for peer in range(2, contacts + 2):
+                key = conversation_key(1, peer)
+                last = conn.execute(db.select(Message.id, Message.content, Message.timestamp).where(
+                    Message.conversation_key == key).order_by(Message.timestamp.desc(), Message.id.desc()).limit(1)).first()
+                watermark = conn.execute(db.select(ReadState.last_read_message_id).where(
+                    ReadState.user_id == 1, ReadState.conversation_key == key)).scalar() or 0
+                unread = conn.execute(db.select(db.func.count()).select_from(Message).where(
+                    Message.conversation_key == key, Message.id > watermark, Message.sender_id != 1)).scalar()
+                if last:
+                    chats.append((last.timestamp, key, decrypt_message(last.content)[:app.config['INBOX_PREVIEW_CHARS']], unread))
+            return sorted(chats, reverse=True)[:app.config['INBOX_PAGE_SIZE']]
+
+        def inbox_page(conn):
+            rows = conn.execute(inbox.query().where(InboxEntry.user_id == 1).order_by(
+                InboxEntry.last_message_at.desc(), InboxEntry.id.desc()).limit(app.config['INBOX_PAGE_SIZE'])).all()
+            return [inbox.entry_json(row) for row in rows]
+
+        with engine.connect() as conn:
+            for name, build in (('scan per contact', per_contact_scan), ('inbox page', inbox_page)):
+                times = []
+                for _ in range(runs):
+                    started = time.perf_counter()
+                    build(conn)
+                    times.append(time.perf_counter() - started)
+                times.sort()
+                print(f"{name:17} p50 {times[len(times) // 2] * 1000:8.2f} ms  p95 {times[int(len(times) * 0.95)] * 1000:8.2f} ms")
+        engine.dispose()
+
+# Benchmark for image uploads: `flask bench-media` times the old inline profile() path (full
+# decode, resize, save) against what a request now does (save and read the header) and against
+# the media worker's job, on a synthetic --width x --height JPEG.
+@app.cli.command('bench-media')
+@click.option('--width', default=4032)
+@click.option('--height', default=3024)
+@click.option('--runs', default=5)
+def bench_media(width, height, runs):
+    from werkzeug.datastructures import FileStorage
+    gradient = Image.linear_gradient('L').resize((width, height))
+    photo = Image.merge('RGB', (gradient, gradient.rotate(90), gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+    upload = io.BytesIO()
+    photo.save(upload, 'JPEG', quality=92)
+    data = upload.getvalue()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        def average_ms(fn):
+            started = time.perf_counter()
+            for _ in range(runs):
+                fn()
+            return (time.perf_counter() - started) * 1000 / runs
+
+        def inline():
+            img = Image.open(io.BytesIO(data))
+            img.resize((150, 150), Image.LANCZOS).save(os.path.join(scratch, 'inline.jpg'))
+
+        def accept():
+            token, source_path = accept_image_upload(FileStorage(io.BytesIO(data), 'photo.jpg'))
+            os.remove(source_path)
+
+        source_path = os.path.join(scratch, 'source.jpg')
+        with open(source_path, 'wb') as f:
+            f.write(data)
+
+        print(f"upload: {width}x{height} JPEG, {len(data) / 1e6:.1f} MB")
+        print(f"old inline resize (request):   {average_ms(inline):8.1f} ms")
+        print(f"accept upload (request):       {average_ms(accept):8.1f} ms")
+        print(f"variants, media worker:        {average_ms(lambda: render_image_variants(source_path, scratch, 'bench')):8.1f} ms")
+
+# Benchmark for media serving: `flask bench-media-serving` writes a --size-mb file into
+# UPLOAD_FOLDER and times full downloads, 1 MB Range reads (video seeking), If-None-Match
+# revalidations and X-Accel-Redirect responses through the app, then removes the file.
+@app.cli.command('bench-media-serving')
+@click.option('--size-mb', default=50)
+@click.option('--requests', 'count', default=200, help='Requests per measurement.')
+def bench_media_serving(size_mb, count):
+    filename = f"messages/bench_{uuid.uuid4().hex}.mp4"
+    path = os.path.join(media_root(), filename)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size_mb * 1024 * 1024))
+    client = app.test_client()
+    url = media_url(filename)
+    offload = app.config['MEDIA_OFFLOAD']
+
+    def run(label, headers=None, runs=count, megabytes=None):
+        started = time.perf_counter()
+        for i in range(runs):
+            response = client.get(url, headers=headers(i) if callable(headers) else headers)
+            response.get_data()
+            response.close()
+        elapsed = time.perf_counter() - started
+        rate = f", {megabytes * runs / elapsed:.0f} MB/s" if megabytes else ''
+        print(f"{label:<28} {response.status_code}  {runs / elapsed:8.0f} req/s{rate}")
+
+    try:
+        first = client.get(url)
+        etag = first.headers.get('ETag')
+        first.close()
+        print(f"{url}: {size_mb} MB, Cache-Control: {first.headers.get('Cache-Control')}")
+        run('full download', runs=max(count // 20, 5), megabytes=size_mb)
+        chunk = 1024 * 1024
+        run('1 MB Range (seek)', lambda i: {'Range': f"bytes={(i * 7919 % size_mb) * chunk}-{(i * 7919 % size_mb + 1) * chunk - 1}"}, megabytes=1)
+        run('If-None-Match revalidation', {'If-None-Match': etag})
+        app.config['MEDIA_OFFLOAD'] = 'nginx'
+        run('X-Accel-Redirect', runs=count * 5)
+    finally:
+        app.config['MEDIA_OFFLOAD'] = offload
+        os.remove(path)
+
+# Benchmark for one Socket.IO node: `flask bench-sockets --url http://127.0.0.1:5000` logs in,
+# opens --clients sockets that all join the user's own 1:1 room, then sends --messages chat
+# messages to that room and times how long each takes to reach every socket. The messages are
+# stored like any other, so point it at a scratch deployment.
+@app.cli.command('bench-sockets')
+@click.option('--url', default='http://127.0.0.1:5000', help='Server to test.')
+@click.option('--clients', default=200, help='Sockets to open.')
+@click.option('--messages', default=20, help='Messages to fan out.')
+@click.option('--transport', default='polling', type=click.Choice(['polling', 'websocket']))
+@click.option('--username', default='testuser')
+@click.option('--password', default='testpassword')
+def bench_sockets(url, clients, messages, transport, username, password):
+    login = requests.Session()
+    login.post(f"{url}/login", data={'step': 'login', 'username': username, 'password': password})
+    cookie = '; '.join(f"{name}={value}" for name, value in login.cookies.items())
+    user = User.query.filter_by(username=username).first()
+    room = conversation_key(user.id, user.id)
+    run_id = random.randint(1000, 9999)
+
+    lock = threading.Lock()
+    deliveries = {}
+    delivered_all = [threading.Event() for _ in range(messages)]
+    connect_times = []
+    sockets = []
+
+    def on_receive(data):
+        content = data.get('content') or ''
+        if not content.startswith(f"bench {run_id} "):
+            return
+        index = int(content.rsplit(' ', 1)[1])
+        with lock:
+            deliveries[index] = deliveries.get(index, 0) + 1
+            if deliveries[index] >= len(sockets):
+                delivered_all[index].set()
+
+    def open_socket(_):
+        client = socketio_module.Client(reconnection=False)
+        client.on('receive_message', on_receive)
+        started = time.perf_counter()
+        try:
+            client.connect(url, headers={'Cookie': cookie}, transports=[transport], wait_timeout=30)
+        except Exception as e:
+            logger.warning(f"Bench socket failed to connect: {str(e)}")
+            return
+        client.emit('join', {'room': room})
+        with lock:
+            connect_times.append(time.perf_counter() - started)
+            sockets.append(client)
+
+    with ThreadPoolExecutor(max_workers=min(clients, 64)) as pool:
+        list(pool.map(open_socket, range(clients)))
+    time.sleep(1)  # let the joins land
+    connect_times.sort()
+    print(f"connected: {len(sockets)}/{clients} sockets ({transport})")
+    if not sockets:
+        return
+    print(f"connect time p50 {connect_times[len(connect_times) // 2] * 1000:.0f} ms, "
+          f"p95 {connect_times[int(len(connect_times) * 0.95)] * 1000:.0f} ms")
+
+    fanout_times = []
+    for index in range(messages):
+        started = time.perf_counter()
+        sockets[0].emit('send_message', {'receiver_id': user.id, 'content': f"bench {run_id} {index}"})
+        if delivered_all[index].wait(30):
+            fanout_times.append(time.perf_counter() - started)
+    fanout_times.sort()
+    if fanout_times:
+        total = sum(fanout_times)
+        print(f"fan-out to {len(sockets)} sockets: p50 {fanout_times[len(fanout_times) // 2] * 1000:.0f} ms, "
+              f"p95 {fanout_times[int(len(fanout_times) * 0.95)] * 1000:.0f} ms, "
+              f"{len(fanout_times) * len(sockets) / total:.0f} deliveries/s")
+    print(f"messages delivered to every socket: {len(fanout_times)}/{messages}")
+
+    for client in sockets:
+        client.disconnect()
 
 # SocketIO events for messaging
 @socketio.on('connect')
 def handle_connect():
     if current_user.is_authenticated:
-        current_user.is_online = True
-        current_user.last_seen = datetime.datetime.utcnow()
-        db.session.commit()
-        emit('user_status', {'user_id': current_user.id, 'status': 'online'}, broadcast=True)
+        join_room(f"user_{current_user.id}")
+        presence.connect(current_user.id)
         logger.info(f"User {current_user.id} connected with Socket.IO")
-    print("Client connected!")
 
 @socketio.on('disconnect')
 def handle_disconnect():
     if current_user.is_authenticated:
-        current_user.is_online = False
-        current_user.last_seen = datetime.datetime.utcnow()
-        db.session.commit()
-        emit('user_status', {'user_id': current_user.id, 'status': 'offline', 'last_seen': current_user.last_seen.strftime('%Y-%m-%d %H:%M:%S')}, broadcast=True)
+        presence.disconnect(current_user.id)
+        typing_indicators.leave_all(current_user.id)
         logger.info(f"User {current_user.id} disconnected from Socket.IO")
-    print("Client disconnected!")
 
 @socketio.on('connect_error')
 def handle_connect_error(error):
     logger.error(f"Socket.IO connect error: {str(error)}")
-    print(f"Socket.IO connect error: {str(error)}")
 
 @socketio.on('join')
 def on_join(data):
-    room = data['room']
+    room = data.get('room') if isinstance(data, dict) else None
+    # user_<id> rooms are joined on connect only; conversation rooms need membership
+    if not isinstance(room, str) or room.startswith('user_') or not user_in_conversation(current_user.id, room):
+        logger.warning(f"User {current_user.id} was refused room {room}")
+        emit('join_error', {'room': room, 'error': 'Yeh room tumhara nahi hai, bhai! 😅'})
+        return
     join_room(room)
     logger.info(f"User {current_user.id} joined room {room}")
 
@@ -880,15 +4649,24 @@ def on_leave(data):
     leave_room(room)
     logger.info(f"User {current_user.id} left room {room}")
 
+# Typing events only count in conversations the user belongs to; others are ignored
+def typing_room(data):
+    room = data.get('room') if isinstance(data, dict) else None
+    if isinstance(room, str) and user_in_conversation(current_user.id, room):
+        return room
+    return None
+
 @socketio.on('typing')
 def handle_typing(data):
-    room = data['room']
-    emit('typing', {'user_id': current_user.id, 'username': current_user.username}, room=room, broadcast=True)
+    room = typing_room(data)
+    if room:
+        typing_indicators.typing(room, current_user.id, current_user.username)
 
 @socketio.on('stop_typing')
 def handle_stop_typing(data):
-    room = data['room']
-    emit('stop_typing', {'user_id': current_user.id}, room=room, broadcast=True)
+    room = typing_room(data)
+    if room:
+        typing_indicators.stop(room, current_user.id)
 
 @socketio.on('send_message')
 def handle_send_message(data):
@@ -898,61 +4676,87 @@ def handle_send_message(data):
     content_type = data.get('content_type', 'text')
     file_path = data.get('file_path')
     is_secret = data.get('is_secret', False)
-    disappear_timer = data.get('disappear_timer', None)
+    try:
+        disappear_timer = parse_disappear_timer(data.get('disappear_timer'))
+    except (TypeError, ValueError):
+        emit('message_error', {'error': "Disappear timer galat hai, bhai! Seconds mein number bhejo."})
+        return
+
+    # Attachments must come from the upload API, never an arbitrary path
+    if file_path and not Blob.query.filter_by(file_path=file_path).first():
+        emit('message_error', {'error': "Attachment nahi mila, file dobara upload karo!"})
+        return
 
     encrypted_content = encrypt_message(content) if content_type == 'text' and content else None
+    room = conversation_key(current_user.id, receiver_id, group_id)
+    timestamp = datetime.datetime.utcnow()
+    expires_at = timestamp + datetime.timedelta(seconds=disappear_timer) if disappear_timer else None
 
-    message = Message(
-        sender_id=current_user.id,
-        receiver_id=receiver_id if receiver_id else None,
-        group_id=group_id if group_id else None,
-        content=encrypted_content,
-        content_type=content_type,
-        file_path=file_path,
-        is_secret=is_secret,
-        disappear_timer=disappear_timer
-    )
-    db.session.add(message)
-    db.session.commit()
+    # The row is written by message_writer; the room sees the message without waiting for the commit
+    row = {
+        'id': message_ids.next(),
+        'sender_id': current_user.id,
+        'receiver_id': receiver_id if receiver_id else None,
+        'group_id': group_id if group_id else None,
+        'content': encrypted_content,
+        'content_type': content_type,
+        'file_path': file_path,
+        'timestamp': timestamp,
+        'is_read': False,
+        'is_secret': is_secret,
+        'disappear_timer': disappear_timer,
+        'edited': False,
+        'edit_version': 0,
+        'conversation_key': room,
+        'expires_at': expires_at,
+        SEARCH_TEXT_KEY: content if encrypted_content else None
+    }
+    try:
+        message_writer.submit(row, request.sid)
+        if encrypted_content:
+            cache_plaintext(row['id'], 0, content)
+        if expires_at:
+            message_expiry.schedule(expires_at)
+    except queue.Full:
+        logger.warning(f"Message queue full, rejecting message from user {current_user.id}")
+        emit('message_error', {'error': "Bhai, server thoda busy hai! Message dobara bhej. 😅"})
+        return
 
-    decrypted_content = decrypt_message(encrypted_content) if encrypted_content else content
+    if receiver_id:
+        presence.add_contact(current_user.id, int(receiver_id))
 
-    if group_id:
-        room = f"group_{group_id}"
-        emit('receive_message', {
-            'sender_id': current_user.id,
-            'sender_username': current_user.username,
-            'content': decrypted_content,
-            'content_type': content_type,
-            'file_path': file_path,
-            'timestamp': message.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-            'message_id': message.id,
-            'is_secret': is_secret,
-            'disappear_timer': disappear_timer
-        }, room=room, broadcast=True)
-    else:
-        room = f"chat_{min(current_user.id, receiver_id)}_{max(current_user.id, receiver_id)}"
-        emit('receive_message', {
-            'sender_id': current_user.id,
-            'sender_username': current_user.username,
-            'content': decrypted_content,
-            'content_type': content_type,
-            'file_path': file_path,
-            'timestamp': message.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-            'message_id': message.id,
-            'is_secret': is_secret,
-            'disappear_timer': disappear_timer
-        }, room=room, broadcast=True)
+    emit('receive_message', {
+        'sender_id': current_user.id,
+        'sender_username': current_user.username,
+        'content': content,
+        'content_type': content_type,
+        'file_path': file_path,
+        'file_url': media_url(file_path) if file_path else None,
+        'timestamp': row['timestamp'].strftime('%Y-%m-%d %H:%M:%S'),
+        'message_id': row['id'],
+        'is_secret': is_secret,
+        'disappear_timer': disappear_timer,
+        'expires_at': expires_at.strftime('%Y-%m-%d %H:%M:%S') if expires_at else None
+    }, room=room, broadcast=True)
 
+# The acked id has to be a stored message of the room, so a made-up id can never move the
+# watermark past the room's newest message
 @socketio.on('message_read')
 def handle_message_read(data):
-    message_id = data['message_id']
-    message = Message.query.get(message_id)
-    if message and message.sender_id != current_user.id and not message.is_read:
-        message.is_read = True
-        db.session.commit()
-        room = f"chat_{min(current_user.id, message.sender_id)}_{max(current_user.id, message.sender_id)}"
-        emit('message_read', {'message_id': message_id}, room=room, broadcast=True)
+    try:
+        message_id = int(data['message_id'])
+    except (KeyError, TypeError, ValueError):
+        return
+    message = find_message(message_id)
+    if message is None:
+        return
+    room = data.get('room') or message.conversation_key
+    if room != message.conversation_key or not user_in_conversation(current_user.id, room):
+        logger.warning(f"User {current_user.id} acked message {message_id} outside its conversation")
+        return
+    read_receipts.ack(current_user.id, room, message_id)
 
+# Development server only; run production with gunicorn (see gunicorn.conf.py and the README)
 if __name__ == '__main__':
-    socketio.run(app, host='0.0.0.0', port=5000, debug=True, allow_unsafe_werkzeug=True)
+    socketio.run(app, host='0.0.0.0', port=int(os.getenv("PORT", 5000)), debug=os.getenv("FLASK_DEBUG", "1") == "1",
+                 allow_unsafe_werkzeug=True)
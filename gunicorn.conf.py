@@ -0,0 +1,25 @@
+# Gunicorn settings for the chat server: `gunicorn -c gunicorn.conf.py app:app`
+# See "Running several workers" in the README for the sticky-session setup.
+import os
+import subprocess
+import sys
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "eventlet")
+workers = int(os.getenv("GUNICORN_WORKERS", 1))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", 1000))  # Sockets per worker
+timeout = 120
+graceful_timeout = 30
+
+# Flask-SocketIO has to run in the same cooperative mode as the worker
+os.environ.setdefault("SOCKETIO_ASYNC_MODE", "gevent" if "gevent" in worker_class else "eventlet")
+
+if workers > 1 and not os.getenv("SOCKETIO_MESSAGE_QUEUE"):
+    sys.exit("GUNICORN_WORKERS > 1 needs SOCKETIO_MESSAGE_QUEUE, otherwise room emits never reach other workers' sockets")
+
+
+# Migrate once in the master instead of racing in every worker
+def on_starting(server):
+    subprocess.run([sys.executable, "-m", "flask", "--app", "app", "db", "upgrade"],
+                   env={**os.environ, "AUTO_MIGRATE": "1"}, check=True)
+    os.environ["AUTO_MIGRATE"] = "0"
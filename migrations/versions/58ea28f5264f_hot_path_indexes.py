@@ -0,0 +1,60 @@
+"""hot path indexes
+
+Revision ID: 58ea28f5264f
+Revises: 9c3d5b1e7a42
+Create Date: 2026-10-18 09:32:29.825639
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '58ea28f5264f'
+down_revision = '9c3d5b1e7a42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('chat_history', schema=None) as batch_op:
+        batch_op.create_index('ix_chat_history_user_id_chat_name_timestamp', ['user_id', 'chat_name', 'timestamp'], unique=False)
+
+    with op.batch_alter_table('chat_summary', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_chat_summary_user_id_chat_name', ['user_id', 'chat_name'])
+
+    with op.batch_alter_table('group_member', schema=None) as batch_op:
+        batch_op.create_index('ix_group_member_group_id_user_id', ['group_id', 'user_id'], unique=False)
+        batch_op.create_index('ix_group_member_user_id_group_id', ['user_id', 'group_id'], unique=False)
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('conversation_key', sa.String(length=40), nullable=True))
+
+    # Backfill the conversation key with the same format as conversation_key() in app.py
+    op.execute(
+        "UPDATE message SET conversation_key = CASE "
+        "WHEN group_id IS NOT NULL THEN 'group_' || group_id "
+        "WHEN sender_id < receiver_id THEN 'chat_' || sender_id || '_' || receiver_id "
+        "ELSE 'chat_' || receiver_id || '_' || sender_id END"
+    )
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.create_index('ix_message_conversation_key_timestamp', ['conversation_key', 'timestamp', 'id'], unique=False)
+        batch_op.create_index('ix_message_group_id_timestamp', ['group_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_index('ix_message_group_id_timestamp')
+        batch_op.drop_index('ix_message_conversation_key_timestamp')
+        batch_op.drop_column('conversation_key')
+
+    with op.batch_alter_table('group_member', schema=None) as batch_op:
+        batch_op.drop_index('ix_group_member_user_id_group_id')
+        batch_op.drop_index('ix_group_member_group_id_user_id')
+
+    with op.batch_alter_table('chat_summary', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_chat_summary_user_id_chat_name', type_='unique')
+
+    with op.batch_alter_table('chat_history', schema=None) as batch_op:
+        batch_op.drop_index('ix_chat_history_user_id_chat_name_timestamp')
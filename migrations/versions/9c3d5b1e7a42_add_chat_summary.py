@@ -0,0 +1,36 @@
+"""add chat summary
+
+Revision ID: 9c3d5b1e7a42
+Revises: 4111a7d113ae
+Create Date: 2026-10-18 09:31:04.112358
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c3d5b1e7a42'
+down_revision = '4111a7d113ae'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases built with db.create_all() after ChatSummary was added already have the table
+    if sa.inspect(op.get_bind()).has_table('chat_summary'):
+        return
+    op.create_table('chat_summary',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('chat_name', sa.String(length=100), nullable=False),
+    sa.Column('summary', sa.Text(), nullable=False),
+    sa.Column('summarized_up_to_id', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('chat_summary')
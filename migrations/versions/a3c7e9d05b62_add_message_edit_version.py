@@ -0,0 +1,26 @@
+"""add message edit version
+
+Revision ID: a3c7e9d05b62
+Revises: f5b0d6e1c8a3
+Create Date: 2026-10-18 14:41:09.305517
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c7e9d05b62'
+down_revision = 'f5b0d6e1c8a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('edit_version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_column('edit_version')
@@ -0,0 +1,55 @@
+"""add search index
+
+Revision ID: a8e4c6d2f105
+Revises: f7b3d1a6c920
+Create Date: 2026-10-18 18:03:14.572290
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a8e4c6d2f105'
+down_revision = 'f7b3d1a6c920'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(
+        "CREATE VIRTUAL TABLE chat_history_fts USING fts5("
+        "scope, user_message, bot_reply, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+    )
+    # Contentless: only the index of each message's plaintext is stored, never the text
+    op.execute(
+        "CREATE VIRTUAL TABLE message_fts USING fts5("
+        "scope, body, content='', tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+    )
+
+    # Keep chat_history_fts in step with chat_history. A batch_alter_table on chat_history
+    # rebuilds the table without these triggers, so such a migration has to recreate them.
+    op.execute(
+        "CREATE TRIGGER chat_history_fts_insert AFTER INSERT ON chat_history BEGIN "
+        "INSERT INTO chat_history_fts (rowid, scope, user_message, bot_reply) "
+        "VALUES (new.id, 'u' || new.user_id, new.user_message, new.bot_reply); END"
+    )
+    op.execute(
+        "CREATE TRIGGER chat_history_fts_delete AFTER DELETE ON chat_history BEGIN "
+        "DELETE FROM chat_history_fts WHERE rowid = old.id; END"
+    )
+    op.execute(
+        "CREATE TRIGGER chat_history_fts_update AFTER UPDATE OF user_id, user_message, bot_reply ON chat_history BEGIN "
+        "DELETE FROM chat_history_fts WHERE rowid = old.id; "
+        "INSERT INTO chat_history_fts (rowid, scope, user_message, bot_reply) "
+        "VALUES (new.id, 'u' || new.user_id, new.user_message, new.bot_reply); END"
+    )
+    # Existing rows are indexed by `flask search-backfill`, in batches, outside the migration
+
+
+def downgrade():
+    op.execute("DROP TRIGGER chat_history_fts_update")
+    op.execute("DROP TRIGGER chat_history_fts_delete")
+    op.execute("DROP TRIGGER chat_history_fts_insert")
+    op.execute("DROP TABLE message_fts")
+    op.execute("DROP TABLE chat_history_fts")
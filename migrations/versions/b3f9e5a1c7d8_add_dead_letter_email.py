@@ -0,0 +1,34 @@
+"""add dead letter email
+
+Revision ID: b3f9e5a1c7d8
+Revises: a8e4c6d2f105
+Create Date: 2026-10-18 18:41:27.318406
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3f9e5a1c7d8'
+down_revision = 'a8e4c6d2f105'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('dead_letter_email',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('to_email', sa.String(length=120), nullable=False),
+    sa.Column('subject', sa.String(length=200), nullable=False),
+    sa.Column('body', sa.Text(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('failed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('dead_letter_email')
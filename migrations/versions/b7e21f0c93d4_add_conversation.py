@@ -0,0 +1,91 @@
+"""add conversation
+
+Revision ID: b7e21f0c93d4
+Revises: 58ea28f5264f
+Create Date: 2026-10-18 11:02:47.530914
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e21f0c93d4'
+down_revision = '58ea28f5264f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('conversation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=False),
+    sa.Column('model', sa.String(length=50), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('last_activity_at', sa.DateTime(), nullable=False),
+    sa.Column('turn_count', sa.Integer(), nullable=False),
+    sa.Column('summary', sa.Text(), nullable=False),
+    sa.Column('summarized_up_to_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'name', name='uq_conversation_user_id_name')
+    )
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.create_index('ix_conversation_user_id_last_activity_at', ['user_id', 'last_activity_at', 'id'], unique=False)
+
+    with op.batch_alter_table('chat_history', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('conversation_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_chat_history_conversation_id_conversation', 'conversation', ['conversation_id'], ['id'])
+
+    # One conversation per existing (user_id, chat_name), carrying over the rolling summary
+    op.execute(
+        "INSERT INTO conversation (user_id, name, created_at, last_activity_at, turn_count, summary, summarized_up_to_id) "
+        "SELECT user_id, chat_name, MIN(timestamp), MAX(timestamp), COUNT(*), '', 0 "
+        "FROM chat_history GROUP BY user_id, chat_name"
+    )
+    op.execute(
+        "UPDATE conversation SET "
+        "summary = COALESCE((SELECT s.summary FROM chat_summary s "
+        "WHERE s.user_id = conversation.user_id AND s.chat_name = conversation.name), ''), "
+        "summarized_up_to_id = COALESCE((SELECT s.summarized_up_to_id FROM chat_summary s "
+        "WHERE s.user_id = conversation.user_id AND s.chat_name = conversation.name), 0)"
+    )
+    op.execute(
+        "UPDATE chat_history SET conversation_id = (SELECT c.id FROM conversation c "
+        "WHERE c.user_id = chat_history.user_id AND c.name = chat_history.chat_name)"
+    )
+
+    with op.batch_alter_table('chat_history', schema=None) as batch_op:
+        batch_op.create_index('ix_chat_history_conversation_id_id', ['conversation_id', 'id'], unique=False)
+
+    op.drop_table('chat_summary')
+
+
+def downgrade():
+    op.create_table('chat_summary',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('chat_name', sa.String(length=100), nullable=False),
+    sa.Column('summary', sa.Text(), nullable=False),
+    sa.Column('summarized_up_to_id', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'chat_name', name='uq_chat_summary_user_id_chat_name')
+    )
+    op.execute(
+        "INSERT INTO chat_summary (user_id, chat_name, summary, summarized_up_to_id, updated_at) "
+        "SELECT user_id, name, summary, summarized_up_to_id, last_activity_at FROM conversation "
+        "WHERE summarized_up_to_id > 0"
+    )
+
+    with op.batch_alter_table('chat_history', schema=None) as batch_op:
+        batch_op.drop_index('ix_chat_history_conversation_id_id')
+        batch_op.drop_constraint('fk_chat_history_conversation_id_conversation', type_='foreignkey')
+        batch_op.drop_column('conversation_id')
+
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.drop_index('ix_conversation_user_id_last_activity_at')
+
+    op.drop_table('conversation')
@@ -0,0 +1,28 @@
+"""add user directory indexes
+
+Revision ID: c5a2e8f14d93
+Revises: b3f9e5a1c7d8
+Create Date: 2026-10-18 19:12:05.640182
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5a2e8f14d93'
+down_revision = 'b3f9e5a1c7d8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.create_index('ix_user_username_lower', [sa.text('lower(username)')], unique=False)
+        batch_op.create_index('ix_user_public_username_lower', [sa.text('lower(public_username)')], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index('ix_user_public_username_lower')
+        batch_op.drop_index('ix_user_username_lower')
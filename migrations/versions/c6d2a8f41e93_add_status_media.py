@@ -0,0 +1,28 @@
+"""add status media
+
+Revision ID: c6d2a8f41e93
+Revises: a3c7e9d05b62
+Create Date: 2026-10-18 15:27:40.118264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c6d2a8f41e93'
+down_revision = 'a3c7e9d05b62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('status', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('file_path', sa.String(length=200), nullable=True))
+        batch_op.add_column(sa.Column('media_state', sa.String(length=20), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('status', schema=None) as batch_op:
+        batch_op.drop_column('media_state')
+        batch_op.drop_column('file_path')
@@ -0,0 +1,53 @@
+"""add read state
+
+Revision ID: d41c8a6e2f57
+Revises: b7e21f0c93d4
+Create Date: 2026-10-18 11:48:12.006731
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41c8a6e2f57'
+down_revision = 'b7e21f0c93d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('read_state',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('conversation_key', sa.String(length=40), nullable=False),
+    sa.Column('last_read_message_id', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'conversation_key', name='uq_read_state_user_id_conversation_key')
+    )
+    with op.batch_alter_table('read_state', schema=None) as batch_op:
+        batch_op.create_index('ix_read_state_conversation_key_last_read_message_id', ['conversation_key', 'last_read_message_id'], unique=False)
+
+    # 1:1 chats: the receiver has read up to the newest message flagged is_read. Group flags
+    # never said who read a message, so group watermarks start from the next ack.
+    op.execute(
+        "INSERT INTO read_state (user_id, conversation_key, last_read_message_id, updated_at) "
+        "SELECT receiver_id, conversation_key, MAX(id), CURRENT_TIMESTAMP FROM message "
+        "WHERE group_id IS NULL AND receiver_id IS NOT NULL AND is_read = 1 "
+        "GROUP BY receiver_id, conversation_key"
+    )
+
+
+def downgrade():
+    # Bring the per-row flags back in line with the 1:1 watermarks before dropping them
+    op.execute(
+        "UPDATE message SET is_read = 1 WHERE group_id IS NULL AND id <= (SELECT r.last_read_message_id "
+        "FROM read_state r WHERE r.user_id = message.receiver_id AND r.conversation_key = message.conversation_key)"
+    )
+
+    with op.batch_alter_table('read_state', schema=None) as batch_op:
+        batch_op.drop_index('ix_read_state_conversation_key_last_read_message_id')
+
+    op.drop_table('read_state')
@@ -0,0 +1,84 @@
+"""add inbox entry
+
+Revision ID: d8b4f2c6a9e1
+Revises: c5a2e8f14d93
+Create Date: 2026-10-18 19:47:33.205817
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8b4f2c6a9e1'
+down_revision = 'c5a2e8f14d93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('inbox_entry',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('conversation_key', sa.String(length=40), nullable=False),
+    sa.Column('peer_id', sa.Integer(), nullable=True),
+    sa.Column('group_id', sa.Integer(), nullable=True),
+    sa.Column('last_message_id', sa.Integer(), nullable=False),
+    sa.Column('last_sender_id', sa.Integer(), nullable=True),
+    sa.Column('last_message_type', sa.String(length=20), nullable=True),
+    sa.Column('preview', sa.Text(), nullable=True),
+    sa.Column('last_message_at', sa.DateTime(), nullable=False),
+    sa.Column('unread_count', sa.Integer(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['group_id'], ['group.id'], ),
+    sa.ForeignKeyConstraint(['peer_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'conversation_key', name='uq_inbox_entry_user_id_conversation_key')
+    )
+    with op.batch_alter_table('inbox_entry', schema=None) as batch_op:
+        batch_op.create_index('ix_inbox_entry_conversation_key_last_message_id', ['conversation_key', 'last_message_id'], unique=False)
+        batch_op.create_index('ix_inbox_entry_user_id_last_message_at', ['user_id', 'last_message_at', 'id'], unique=False)
+
+    # One entry per 1:1 participant and per group member, pointing at the newest message.
+    # Previews are encrypted and cannot be built in SQL; `flask inbox-rebuild` fills them in.
+    op.execute(
+        "INSERT INTO inbox_entry (user_id, conversation_key, peer_id, last_message_id, last_message_at) "
+        "SELECT user_id, conversation_key, peer_id, MAX(last_id), CURRENT_TIMESTAMP FROM ("
+        "SELECT sender_id AS user_id, receiver_id AS peer_id, conversation_key, MAX(id) AS last_id FROM message "
+        "WHERE group_id IS NULL AND receiver_id IS NOT NULL AND conversation_key IS NOT NULL GROUP BY sender_id, receiver_id "
+        "UNION ALL "
+        "SELECT receiver_id, sender_id, conversation_key, MAX(id) FROM message "
+        "WHERE group_id IS NULL AND receiver_id IS NOT NULL AND conversation_key IS NOT NULL GROUP BY receiver_id, sender_id"
+        ") GROUP BY user_id, conversation_key"
+    )
+    op.execute(
+        "INSERT INTO inbox_entry (user_id, conversation_key, group_id, last_message_id, last_message_at) "
+        "SELECT gm.user_id, latest.conversation_key, latest.group_id, latest.last_id, CURRENT_TIMESTAMP FROM ("
+        "SELECT group_id, conversation_key, MAX(id) AS last_id FROM message "
+        "WHERE group_id IS NOT NULL AND conversation_key IS NOT NULL GROUP BY group_id"
+        ") AS latest JOIN group_member gm ON gm.group_id = latest.group_id"
+    )
+    op.execute(
+        "UPDATE inbox_entry SET "
+        "last_sender_id = (SELECT m.sender_id FROM message m WHERE m.id = inbox_entry.last_message_id), "
+        "last_message_type = (SELECT m.content_type FROM message m WHERE m.id = inbox_entry.last_message_id), "
+        "last_message_at = (SELECT m.timestamp FROM message m WHERE m.id = inbox_entry.last_message_id)"
+    )
+    # Unread = messages from others after the read watermark. Group members who never acked have
+    # no watermark, so they start at 0 rather than with the whole history unread.
+    op.execute(
+        "UPDATE inbox_entry SET unread_count = ("
+        "SELECT COUNT(*) FROM message m WHERE m.conversation_key = inbox_entry.conversation_key "
+        "AND m.sender_id != inbox_entry.user_id AND m.id > COALESCE((SELECT r.last_read_message_id FROM read_state r "
+        "WHERE r.user_id = inbox_entry.user_id AND r.conversation_key = inbox_entry.conversation_key), 0)"
+        ") WHERE group_id IS NULL OR EXISTS (SELECT 1 FROM read_state r "
+        "WHERE r.user_id = inbox_entry.user_id AND r.conversation_key = inbox_entry.conversation_key)"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('inbox_entry', schema=None) as batch_op:
+        batch_op.drop_index('ix_inbox_entry_user_id_last_message_at')
+        batch_op.drop_index('ix_inbox_entry_conversation_key_last_message_id')
+
+    op.drop_table('inbox_entry')
@@ -0,0 +1,28 @@
+"""status feed indexes
+
+Revision ID: e2a7c5f93b14
+Revises: d9f4b7c2e816
+Create Date: 2026-10-18 16:48:21.907352
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a7c5f93b14'
+down_revision = 'd9f4b7c2e816'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('status', schema=None) as batch_op:
+        batch_op.create_index('ix_status_user_id_timestamp', ['user_id', 'timestamp'], unique=False)
+        batch_op.create_index('ix_status_timestamp', ['timestamp'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('status', schema=None) as batch_op:
+        batch_op.drop_index('ix_status_timestamp')
+        batch_op.drop_index('ix_status_user_id_timestamp')
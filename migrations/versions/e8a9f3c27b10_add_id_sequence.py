@@ -0,0 +1,31 @@
+"""add id sequence
+
+Revision ID: e8a9f3c27b10
+Revises: d41c8a6e2f57
+Create Date: 2026-10-18 12:36:55.418203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8a9f3c27b10'
+down_revision = 'd41c8a6e2f57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('id_sequence',
+    sa.Column('name', sa.String(length=40), nullable=False),
+    sa.Column('next_value', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+    # Message ids are handed out by the app from here on, starting after the last stored one
+    op.execute("INSERT INTO id_sequence (name, next_value) SELECT 'message', COALESCE(MAX(id), 0) + 1 FROM message")
+
+
+def downgrade():
+    op.drop_table('id_sequence')
@@ -0,0 +1,28 @@
+"""message participant indexes
+
+Revision ID: f5b0d6e1c8a3
+Revises: e8a9f3c27b10
+Create Date: 2026-10-18 13:20:41.772160
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f5b0d6e1c8a3'
+down_revision = 'e8a9f3c27b10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.create_index('ix_message_sender_id_receiver_id', ['sender_id', 'receiver_id'], unique=False)
+        batch_op.create_index('ix_message_receiver_id_sender_id', ['receiver_id', 'sender_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_index('ix_message_receiver_id_sender_id')
+        batch_op.drop_index('ix_message_sender_id_receiver_id')
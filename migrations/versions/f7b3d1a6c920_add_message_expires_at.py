@@ -0,0 +1,34 @@
+"""add message expires at
+
+Revision ID: f7b3d1a6c920
+Revises: e2a7c5f93b14
+Create Date: 2026-10-18 17:22:36.481905
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f7b3d1a6c920'
+down_revision = 'e2a7c5f93b14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('expires_at', sa.DateTime(), nullable=True))
+        batch_op.create_index('ix_message_expires_at', ['expires_at'], unique=False)
+
+    # Timers set before this revision count from when the message was sent
+    op.execute(
+        "UPDATE message SET expires_at = datetime(timestamp, '+' || disappear_timer || ' seconds') "
+        "WHERE disappear_timer > 0"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_index('ix_message_expires_at')
+        batch_op.drop_column('expires_at')
@@ -0,0 +1,193 @@
+import base64
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+# The app configures itself from the environment on import, so point everything it writes at a
+# scratch directory before the first `import app`
+SCRATCH = tempfile.mkdtemp(prefix='x07-tests-')
+os.environ.update({
+    'DATABASE_URL': f"sqlite:///{os.path.join(SCRATCH, 'app.db')}",
+    'UPLOAD_FOLDER': os.path.join(SCRATCH, 'uploads'),
+    'MEDIA_ORIGINALS_FOLDER': os.path.join(SCRATCH, 'media_originals'),
+    'UPLOAD_PARTIAL_FOLDER': os.path.join(SCRATCH, 'partial_uploads'),
+    'AES_KEYS': 'k1:' + base64.b64encode(b'k' * 32).decode(),
+    'AI_CACHE_PATH': os.path.join(SCRATCH, 'ai_cache.db'),
+    'OPENROUTER_BASE_URL': 'http://127.0.0.1:9',
+    'OPENROUTER_API_KEY': 'test-key',
+    'LOG_LEVEL': 'WARNING',
+    'READ_RECEIPT_WINDOW': '60',  # Tests flush read receipts themselves
+    'PRESENCE_DEBOUNCE': '0.1',
+    'MAIL_RATE_LIMIT': '0',
+    'MAIL_RETRY_BASE': '0.01',
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as chat_app  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def clean_database():
+    yield
+    chat_app.message_writer.flush(5)
+    chat_app.read_receipts.flush()
+    # Pending offline timers would mark users deleted below; drop them before saving presence
+    with chat_app.presence.lock:
+        timers, chat_app.presence.offline_timers = chat_app.presence.offline_timers, {}
+    for timer in timers.values():
+        timer.cancel()
+    chat_app.presence.flush()
+    with chat_app.app.app_context():
+        db = chat_app.db
+        db.session.remove()
+        with db.engine.begin() as conn:
+            for table in reversed(db.metadata.sorted_tables):
+                if table.name == 'user':
+                    conn.execute(table.delete().where(table.c.username != 'testuser'))
+                elif table.name != 'id_sequence':
+                    conn.execute(table.delete())
+            conn.execute(db.text("DELETE FROM chat_history_fts"))
+            conn.execute(db.text("INSERT INTO message_fts (message_fts) VALUES ('delete-all')"))
+    chat_app.presence.contacts_cache.clear()
+    for cache in (chat_app.directory.recent_cache, chat_app.directory.search_cache, chat_app.status_feed.cache):
+        cache.entries.clear()
+
+
+@pytest.fixture
+def testuser():
+    with chat_app.app.app_context():
+        return chat_app.User.query.filter_by(username='testuser').one().id
+
+
+@pytest.fixture
+def make_user():
+    def make(username, password='secret'):
+        with chat_app.app.app_context():
+            user = chat_app.User(username=username, email=f"{username}@example.com")
+            user.set_password(password)
+            chat_app.db.session.add(user)
+            chat_app.db.session.commit()
+            return user.id
+    return make
+
+
+def login(username='testuser', password='testpassword'):
+    client = chat_app.app.test_client()
+    response = client.post('/login', data={'username': username, 'password': password})
+    assert response.status_code in (200, 302)
+    return client
+
+
+@pytest.fixture
+def client():
+    return login()
+
+
+@pytest.fixture
+def socket_for():
+    sockets = []
+
+    def connect(client):
+        sock = chat_app.socketio.test_client(chat_app.app, flask_test_client=client)
+        sockets.append(sock)
+        return sock
+    yield connect
+    for sock in sockets:
+        if sock.is_connected():
+            sock.disconnect()
+
+
+# Sends text messages over the socket and waits for the message writer to store them
+def send_messages(sock, contents, receiver_id=None, group_id=None, **extra):
+    for content in contents:
+        sock.emit('send_message', dict(extra, receiver_id=receiver_id, group_id=group_id, content=content))
+    chat_app.message_writer.flush(5)
+
+
+def received(sock, name):
+    return [packet['args'][0] for packet in sock.get_received() if packet['name'] == name]
+
+
+# Stand-in for OpenRouter. The requested model name picks the behaviour:
+#   slow*     waits `delay` seconds before answering
+#   trickle*  streams a delta every 0.2 s and never finishes
+#   fail*     answers 500
+#   midfail*  streams two deltas, then drops the connection
+#   anything else answers "reply from <model>" (streamed as three deltas)
+class FakeOpenRouter(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        model = payload['model']
+        with self.server.lock:
+            self.server.calls.append(model)
+        if model.startswith('slow'):
+            time.sleep(self.server.delay)
+        if model.startswith('fail'):
+            self.send_json(500, {'error': 'boom'})
+            return
+        if not payload.get('stream'):
+            self.send_json(200, {'choices': [{'message': {'content': f"reply from {model}"}}]})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        words = ['reply ', 'from ', model]
+        try:
+            for number in range(10 ** 6):
+                word = words[number] if number < len(words) else 'x'
+                self.wfile.write(f"data: {json.dumps({'choices': [{'delta': {'content': word}}]})}\n\n".encode())
+                self.wfile.flush()
+                if model.startswith('midfail') and number == 1:
+                    self.connection.shutdown(2)
+                    return
+                if model.startswith('trickle'):
+                    time.sleep(0.2)
+                elif number == len(words) - 1:
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    return
+        except OSError:
+            return
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def openrouter_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeOpenRouter)
+    server.daemon_threads = True
+    server.calls = []
+    server.delay = 2.0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def openrouter(openrouter_server, monkeypatch):
+    client = chat_app.OpenRouterClient('test-key', openrouter_server.url, 1, 5, 0, 0.2, 3, 30, 8)
+    client.fallback_model = 'fallback'
+    monkeypatch.setattr(chat_app, 'openrouter', client)
+    monkeypatch.setattr(chat_app, 'completion_cache', chat_app.CompletionCache(chat_app.MemoryCacheBackend(100, 60)))
+    return client
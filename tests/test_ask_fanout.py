@@ -0,0 +1,60 @@
+import time
+
+import pytest
+import requests
+
+from conftest import chat_app
+
+
+def slow_completion(delays):
+    def complete(mapped_model, mode, system_prompt, user_message, deadline, stop):
+        time.sleep(delays.get(mapped_model, 0))
+        if stop.is_set():
+            raise chat_app.OpenRouterStopped("stopped")
+        return f"reply from {mapped_model}"
+    return complete
+
+
+def test_models_are_asked_concurrently_and_keep_their_order(client, monkeypatch):
+    delays = {'openai/gpt-4.1-nano': 0.4, 'x-ai/grok-3-mini-beta': 0.4, 'anthropic/claude-3.5-haiku': 0.4}
+    monkeypatch.setattr(chat_app, 'cached_completion', slow_completion(delays))
+
+    started = time.monotonic()
+    response = client.post('/ask', json={'message': 'hello there', 'models': ['ChatGPT', 'Grok', 'Claude']})
+    elapsed = time.monotonic() - started
+
+    assert response.status_code == 200
+    assert response.json['reply'].splitlines() == [
+        'reply from openai/gpt-4.1-nano', 'reply from x-ai/grok-3-mini-beta', 'reply from anthropic/claude-3.5-haiku'
+    ]
+    assert elapsed < 1.0
+
+
+def test_a_model_past_the_deadline_gives_a_partial_reply(client, monkeypatch):
+    monkeypatch.setitem(chat_app.app.config, 'AI_MODEL_DEADLINE', 0.3)
+    monkeypatch.setattr(chat_app, 'cached_completion', slow_completion({'anthropic/claude-3.5-haiku': 1.0}))
+
+    started = time.monotonic()
+    response = client.post('/ask', json={'message': 'hello there', 'models': ['Grok', 'Claude']})
+
+    assert time.monotonic() - started < 0.9
+    assert response.status_code == 200
+    lines = response.json['reply'].splitlines()
+    assert lines[0] == 'reply from x-ai/grok-3-mini-beta'
+    assert 'Claude is taking too long' in lines[1]
+
+
+def test_every_model_late_is_a_gateway_timeout(client, monkeypatch):
+    monkeypatch.setitem(chat_app.app.config, 'AI_MODEL_DEADLINE', 0.2)
+    monkeypatch.setattr(chat_app, 'cached_completion', slow_completion({'x-ai/grok-3-mini-beta': 1.0}))
+
+    response = client.post('/ask', json={'message': 'hello there', 'models': ['Grok']})
+
+    assert response.status_code == 504
+
+
+def test_deadline_is_enforced_inside_the_client(openrouter, openrouter_server):
+    started = time.monotonic()
+    with pytest.raises(requests.exceptions.RequestException):
+        openrouter.complete('slow-model', 'system', 'hi', time.monotonic() + 0.5)
+    assert time.monotonic() - started < 1.5
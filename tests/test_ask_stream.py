@@ -0,0 +1,95 @@
+import json
+import time
+
+import pytest
+
+from conftest import chat_app
+
+
+def sse_events(body):
+    events = []
+    for block in body.decode().split('\n\n'):
+        if not block.strip():
+            continue
+        lines = dict(line.split(': ', 1) for line in block.splitlines())
+        events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+
+@pytest.fixture
+def fake_models(monkeypatch):
+    # The fake server decides what to do from the model name, so let models map to themselves
+    monkeypatch.setattr(chat_app, 'map_model_to_openrouter', lambda name: name)
+
+
+def test_stream_relays_deltas_then_done_and_records_the_turn(client, openrouter, fake_models):
+    response = client.post('/ask', json={'message': 'stream please', 'models': ['alpha'], 'stream': True})
+
+    assert response.mimetype == 'text/event-stream'
+    events = sse_events(response.data)
+    assert [kind for kind, _ in events[:-1]] == ['delta'] * (len(events) - 1)
+    assert ''.join(payload['text'] for _, payload in events[:-1]) == 'reply from alpha'
+    assert events[-1] == ('done', {'reply': 'reply from alpha'})
+    with chat_app.app.app_context():
+        turn = chat_app.ChatHistory.query.one()
+        assert (turn.user_message, turn.bot_reply) == ('stream please', 'reply from alpha')
+
+
+def test_stream_fans_out_to_every_model(client, openrouter, fake_models):
+    response = client.post('/ask', json={'message': 'both', 'models': ['alpha', 'beta'], 'stream': True})
+
+    events = sse_events(response.data)
+    by_index = {}
+    for kind, payload in events:
+        if kind == 'delta':
+            by_index[payload['index']] = by_index.get(payload['index'], '') + payload['text']
+    assert by_index == {0: 'reply from alpha', 1: 'reply from beta'}
+    assert events[-1][1]['reply'] == 'reply from alpha\nreply from beta'
+
+
+def test_stream_past_the_deadline_ends_with_a_partial_reply(client, openrouter, fake_models, monkeypatch):
+    monkeypatch.setitem(chat_app.app.config, 'AI_MODEL_DEADLINE', 0.7)
+
+    started = time.monotonic()
+    response = client.post('/ask', json={'message': 'slowly', 'models': ['alpha', 'trickle'], 'stream': True})
+    events = sse_events(response.data)
+
+    assert time.monotonic() - started < 2
+    assert events[-1][0] == 'done'
+    assert events[-1][1]['reply'].startswith('reply from alpha\nreply ')
+    assert 'taking too long' in events[-1][1]['reply']
+    with chat_app.app.app_context():
+        assert chat_app.Conversation.query.one().model == 'alpha'
+
+
+def test_a_stream_where_no_model_finishes_is_an_error_and_not_stored(client, openrouter, fake_models, monkeypatch):
+    monkeypatch.setitem(chat_app.app.config, 'AI_MODEL_DEADLINE', 0.7)
+
+    response = client.post('/ask', json={'message': 'slowly', 'models': ['trickle'], 'stream': True})
+    events = sse_events(response.data)
+
+    assert events[0][0] == 'delta'
+    assert events[-1][0] == 'error'
+    assert 'taking too long' in events[-1][1]['reply']
+    with chat_app.app.app_context():
+        assert chat_app.ChatHistory.query.count() == 0
+
+
+def test_a_stream_cut_off_midway_is_an_error_and_counts_against_the_model(client, openrouter, fake_models):
+    response = client.post('/ask', json={'message': 'fragile', 'models': ['midfail'], 'stream': True})
+
+    events = sse_events(response.data)
+    assert events[-1][0] == 'error'
+    assert openrouter.breaker('midfail').failures == 1
+    with chat_app.app.app_context():
+        assert chat_app.ChatHistory.query.count() == 0
+
+
+def test_closing_a_stream_early_does_not_trip_the_breaker(openrouter):
+    stream = openrouter.stream('trickle', 'system', 'hi', time.monotonic() + 10)
+    assert next(stream) == 'reply '
+    stream.close()
+
+    breaker = openrouter.breaker('trickle')
+    assert breaker.failures == 0
+    assert not breaker.trial_running
@@ -0,0 +1,163 @@
+import datetime
+import hashlib
+import os
+
+import pytest
+
+from conftest import chat_app, login, send_messages
+
+DATA = os.urandom(200 * 1024)
+DIGEST = hashlib.sha256(DATA).hexdigest()
+
+
+def start(client, filename='clip.mp4', data=DATA, **extra):
+    return client.post('/api/uploads', json=dict(extra, filename=filename, size=len(data)))
+
+
+def put(client, upload_id, offset, chunk):
+    return client.put(f"/api/uploads/{upload_id}", data=chunk, headers={'Upload-Offset': str(offset)})
+
+
+def upload(client, filename='clip.mp4', data=DATA):
+    upload_id = start(client, filename, data).json['upload_id']
+    return put(client, upload_id, 0, data).json
+
+
+def stored_path(file_path):
+    return os.path.join(chat_app.app.config['UPLOAD_FOLDER'], file_path)
+
+
+def test_chunks_append_at_their_offset_and_the_file_lands_under_its_hash(client):
+    created = start(client)
+    assert created.status_code == 201
+    upload_id = created.json['upload_id']
+
+    assert put(client, upload_id, 0, DATA[:70000]).json['offset'] == 70000
+    assert client.get(f"/api/uploads/{upload_id}").json['offset'] == 70000
+    done = put(client, upload_id, 70000, DATA[70000:]).json
+
+    assert done == {'complete': True, 'sha256': DIGEST, 'size': len(DATA), 'file_path': f"messages/{DIGEST[:2]}/{DIGEST}.mp4"}
+    with open(stored_path(done['file_path']), 'rb') as f:
+        assert f.read() == DATA
+    assert not os.path.exists(chat_app.partial_upload_path(upload_id))
+
+
+def test_a_wrong_offset_gets_the_offset_to_resume_from(client):
+    upload_id = start(client).json['upload_id']
+    put(client, upload_id, 0, DATA[:1000])
+
+    conflict = put(client, upload_id, 5000, DATA[5000:6000])
+
+    assert conflict.status_code == 409
+    assert conflict.json['offset'] == 1000
+    assert put(client, upload_id, 1000, DATA[1000:]).json['sha256'] == DIGEST
+
+
+def test_the_hash_is_rebuilt_from_disk_after_a_restart(client):
+    upload_id = start(client).json['upload_id']
+    put(client, upload_id, 0, DATA[:100000])
+    chat_app.upload_hashes.discard(upload_id)  # As if the next chunk reached a fresh worker
+
+    assert put(client, upload_id, 100000, DATA[100000:]).json['sha256'] == DIGEST
+
+
+def test_bytes_past_the_declared_size_are_refused(client):
+    upload_id = start(client).json['upload_id']
+
+    response = put(client, upload_id, 0, DATA + b'extra')
+
+    assert response.status_code == 400
+    assert response.json['offset'] == len(DATA)
+
+
+def test_bad_sessions_are_refused(client, make_user):
+    assert start(client, filename='run.exe').status_code == 400
+    assert client.post('/api/uploads', json={'filename': 'clip.mp4', 'size': 0}).status_code == 400
+
+    upload_id = start(client).json['upload_id']
+    make_user('mallory')
+    assert put(login('mallory', 'secret'), upload_id, 0, DATA).status_code == 404
+
+
+def test_the_same_content_is_stored_once(client):
+    first = upload(client)
+    second = upload(client, filename='copy.mp4')
+
+    assert second['file_path'] == first['file_path']
+    with chat_app.app.app_context():
+        assert chat_app.Blob.query.count() == 1
+        assert chat_app.UploadSession.query.count() == 0
+
+
+def test_only_a_sender_of_the_content_may_skip_the_upload(client, socket_for, make_user):
+    stored = upload(client)
+    assert start(client, sha256=DIGEST).status_code == 201  # Uploaded, but never sent
+
+    send_messages(socket_for(client), [None], receiver_id=make_user('alice'), content_type='video', file_path=stored['file_path'])
+    known = start(client, sha256=DIGEST.upper())
+    make_user('mallory')
+    guessed = start(login('mallory', 'secret'), sha256=DIGEST)
+
+    assert known.status_code == 200 and known.json['file_path'] == stored['file_path']
+    assert guessed.status_code == 201 and 'file_path' not in guessed.json
+
+
+def test_losing_a_store_race_keeps_the_winners_file(client, monkeypatch):
+    # Another worker stores the same content as .mov between the lookup and the commit
+    winner = f"messages/{DIGEST[:2]}/{DIGEST}.mov"
+    real_replace = os.replace
+
+    def replace_then_race(source, destination):
+        real_replace(source, destination)
+        with chat_app.db.engine.begin() as conn:
+            conn.execute(chat_app.Blob.__table__.insert().values(
+                sha256=DIGEST, size=len(DATA), file_path=winner, ref_count=0,
+                created_at=datetime.datetime.utcnow(), last_used_at=datetime.datetime.utcnow()))
+    monkeypatch.setattr(chat_app.os, 'replace', replace_then_race)
+
+    done = upload(client)
+
+    assert done['file_path'] == winner
+    assert not os.path.exists(stored_path(f"messages/{DIGEST[:2]}/{DIGEST}.mp4"))
+    with chat_app.app.app_context():
+        assert chat_app.UploadSession.query.count() == 0
+
+
+def test_cancel_removes_the_partial_file(client):
+    upload_id = start(client).json['upload_id']
+    put(client, upload_id, 0, DATA[:1000])
+
+    assert client.delete(f"/api/uploads/{upload_id}").status_code == 200
+    assert not os.path.exists(chat_app.partial_upload_path(upload_id))
+    assert client.get(f"/api/uploads/{upload_id}").status_code == 404
+
+
+@pytest.fixture
+def aged(client, testuser, make_user):
+    kept = upload(client, data=b'kept')
+    orphan = upload(client, data=b'orphan')
+    stale_id = start(client).json['upload_id']
+    alice = make_user('alice')
+    long_ago = datetime.datetime.utcnow() - datetime.timedelta(days=30)
+    with chat_app.app.app_context():
+        chat_app.Blob.query.update({'last_used_at': long_ago})
+        chat_app.UploadSession.query.update({'updated_at': long_ago})
+        chat_app.db.session.add(chat_app.Message(sender_id=testuser, receiver_id=alice, content_type='video',
+                                                 file_path=kept['file_path'], conversation_key=chat_app.conversation_key(testuser, alice)))
+        chat_app.db.session.commit()
+    return {'kept': kept['file_path'], 'orphan': orphan['file_path'], 'stale': stale_id}
+
+
+def test_gc_blobs_removes_unreferenced_blobs_and_stale_uploads(aged):
+    runner = chat_app.app.test_cli_runner()
+    assert 'Would remove 1 blobs' in runner.invoke(args=['gc-blobs', '--dry-run']).output
+    assert os.path.exists(stored_path(aged['orphan']))
+
+    result = runner.invoke(args=['gc-blobs'])
+
+    assert 'Removed 1 blobs' in result.output and '1 stale uploads' in result.output
+    assert not os.path.exists(stored_path(aged['orphan']))
+    assert not os.path.exists(chat_app.partial_upload_path(aged['stale']))
+    with chat_app.app.app_context():
+        [blob] = chat_app.Blob.query.all()
+        assert (blob.file_path, blob.ref_count) == (aged['kept'], 1)
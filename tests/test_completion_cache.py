@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conftest import chat_app, login
+
+
+@pytest.fixture(params=['memory', 'disk'])
+def backend(request, tmp_path):
+    if request.param == 'memory':
+        return chat_app.MemoryCacheBackend(2, 60)
+    return chat_app.DiskCacheBackend(str(tmp_path / 'cache.db'), 2, 60)
+
+
+def test_backends_evict_least_recently_used(backend):
+    backend.set('a', '1')
+    backend.set('b', '2')
+    time.sleep(0.01)
+    assert backend.get('a') == '1'
+    time.sleep(0.01)
+    backend.set('c', '3')
+
+    assert backend.get('b') is None
+    assert backend.get('a') == '1'
+    assert backend.get('c') == '3'
+
+
+def test_backends_expire_entries(backend):
+    backend.ttl = 0.05
+    backend.set('a', '1')
+    time.sleep(0.06)
+    assert backend.get('a') is None
+
+
+def test_disk_backend_closes_its_connections(tmp_path):
+    backend = chat_app.DiskCacheBackend(str(tmp_path / 'cache.db'), 10, 60)
+    open_files = len(os.listdir('/proc/self/fd'))
+    for number in range(50):
+        backend.set(str(number), 'value')
+        backend.get(str(number))
+    assert len(os.listdir('/proc/self/fd')) <= open_files + 1
+
+
+def test_concurrent_misses_share_one_computation():
+    cache = chat_app.CompletionCache(chat_app.MemoryCacheBackend(10, 60))
+    calls = []
+    started = threading.Event()
+
+    def compute():
+        calls.append(1)
+        started.set()
+        time.sleep(0.2)
+        return 'value'
+
+    with ThreadPoolExecutor(5) as pool:
+        first = pool.submit(cache.get_or_compute, 'key', compute)
+        started.wait(1)
+        rest = [pool.submit(cache.get_or_compute, 'key', compute) for _ in range(4)]
+        results = [first.result()] + [future.result() for future in rest]
+
+    assert results == ['value'] * 5
+    assert len(calls) == 1
+    assert cache.stats()['coalesced'] == 4
+    assert cache.get_or_compute('key', compute) == 'value'
+    assert cache.stats()['hits'] == 1
+
+
+def test_an_error_reaches_every_waiter_and_is_not_cached():
+    cache = chat_app.CompletionCache(chat_app.MemoryCacheBackend(10, 60))
+
+    def fail():
+        raise ValueError('upstream down')
+
+    with pytest.raises(ValueError):
+        cache.get_or_compute('key', fail)
+    assert cache.get_or_compute('key', lambda: 'second try') == 'second try'
+
+
+def test_a_leader_that_dies_releases_the_key():
+    cache = chat_app.CompletionCache(chat_app.MemoryCacheBackend(10, 60))
+
+    def interrupted():
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        cache.get_or_compute('key', interrupted)
+    assert cache.inflight == {}
+    assert cache.get_or_compute('key', lambda: 'second try', timeout=1) == 'second try'
+
+
+def test_followers_give_up_at_their_deadline():
+    cache = chat_app.CompletionCache(chat_app.MemoryCacheBackend(10, 60))
+    release = threading.Event()
+
+    with ThreadPoolExecutor(1) as pool:
+        leader = pool.submit(cache.get_or_compute, 'key', lambda: release.wait(5) and 'value')
+        while 'key' not in cache.inflight:
+            time.sleep(0.01)
+        started = time.monotonic()
+        with pytest.raises(TimeoutError):
+            cache.get_or_compute('key', lambda: 'unused', timeout=0.2)
+        assert time.monotonic() - started < 1
+        release.set()
+        assert leader.result() == 'value'
+
+
+def test_identical_streams_make_one_upstream_call(openrouter, openrouter_server, make_user, monkeypatch):
+    monkeypatch.setattr(chat_app, 'map_model_to_openrouter', lambda name: name)
+    clients = []
+    for name in ('asha', 'bilal', 'chen'):
+        make_user(name)
+        clients.append(login(name, 'secret'))
+
+    def ask(test_client):
+        response = test_client.post('/ask', json={'message': 'same question', 'models': ['alpha'], 'stream': True})
+        return response.data
+
+    with ThreadPoolExecutor(3) as pool:
+        bodies = list(pool.map(ask, clients))
+
+    assert all(body.endswith(b'event: done\ndata: {"reply": "reply from alpha"}\n\n') for body in bodies)
+    assert openrouter_server.calls == ['alpha']
+
+
+def test_cache_stats_endpoint(client):
+    stats = client.get('/ai_cache_stats').json
+    assert {'backend', 'hits', 'misses', 'coalesced', 'inflight'} <= set(stats)
@@ -0,0 +1,58 @@
+import pytest
+
+from conftest import chat_app, login, send_messages
+
+
+@pytest.fixture
+def chat(client, socket_for, make_user):
+    alice = make_user('alice')
+    send_messages(socket_for(client), [f"message {number}" for number in range(7)], receiver_id=alice)
+    return alice
+
+
+def contents(page):
+    return [message['content'] for message in page['messages']]
+
+
+def test_latest_page_comes_oldest_first_with_a_cursor_for_older_messages(client, chat, testuser):
+    page = client.get(f'/api/messages/user/{chat}?limit=3').json
+
+    assert contents(page) == ['message 4', 'message 5', 'message 6']
+    assert page['has_more'] is True
+    assert page['conversation_key'] == chat_app.conversation_key(testuser, chat)
+
+
+def test_before_cursor_walks_back_without_gaps_or_repeats(client, chat):
+    seen = []
+    page = client.get(f'/api/messages/user/{chat}?limit=3').json
+    seen = contents(page) + seen
+    while page['has_more']:
+        page = client.get(f"/api/messages/user/{chat}?limit=3&before={page['oldest_cursor']}").json
+        seen = contents(page) + seen
+
+    assert seen == [f"message {number}" for number in range(7)]
+
+
+def test_after_cursor_returns_only_newer_messages(client, chat, socket_for, testuser):
+    newest = client.get(f'/api/messages/user/{chat}').json['newest_cursor']
+    send_messages(socket_for(login('alice', 'secret')), ['reply'], receiver_id=testuser)
+
+    page = client.get(f'/api/messages/user/{chat}?after={newest}').json
+
+    assert contents(page) == ['reply']
+    assert page['has_more'] is False
+
+
+def test_other_people_cannot_read_the_conversation(chat, make_user):
+    make_user('mallory')
+    outsider = login('mallory', 'secret')
+
+    # mallory's own chat with alice is empty; a group she is not in is refused
+    assert outsider.get(f'/api/messages/user/{chat}').json['messages'] == []
+    assert outsider.get('/api/messages/group/1').status_code == 403
+
+
+def test_bad_input_is_rejected(client, chat):
+    assert client.get(f'/api/messages/user/{chat}?before=not-a-cursor').status_code == 400
+    assert client.get('/api/messages/user/99999').status_code == 404
+    assert client.get(f'/api/messages/channel/{chat}').status_code == 400
@@ -0,0 +1,64 @@
+import datetime
+
+import pytest
+
+from conftest import chat_app
+
+
+@pytest.fixture
+def conversations(testuser):
+    with chat_app.app.app_context():
+        ids = []
+        for number in range(5):
+            conversation = chat_app.create_conversation(testuser, f"Chat {number}", 'Grok')
+            chat_app.record_chat_turn(conversation.id, 'Grok', f"question {number}", f"answer {number}")
+            conversation.last_activity_at = datetime.datetime(2026, 1, 1) + datetime.timedelta(minutes=number)
+            ids.append(conversation.id)
+        chat_app.create_conversation(testuser, 'Never used')  # No turns, so not listed
+        chat_app.db.session.commit()
+        return ids
+
+
+def test_chat_list_is_most_recent_first_and_paginated(client, conversations):
+    first = client.get('/get_chat_history?limit=3').json
+    second = client.get(f"/get_chat_history?limit=3&before={first['next_cursor']}").json
+
+    assert first['chat_names'] == ['Chat 4', 'Chat 3', 'Chat 2']
+    assert first['has_more'] is True
+    assert second['chat_names'] == ['Chat 1', 'Chat 0']
+    assert second['has_more'] is False
+    assert first['conversations'][0]['turn_count'] == 1
+
+
+def test_recording_a_turn_moves_the_conversation_to_the_top(client, conversations):
+    with chat_app.app.app_context():
+        chat_app.record_chat_turn(conversations[0], 'Claude', 'again', 'sure')
+
+    listing = client.get('/get_chat_history').json
+
+    assert listing['chat_names'][0] == 'Chat 0'
+    assert listing['conversations'][0]['model'] == 'Claude'
+    assert listing['conversations'][0]['turn_count'] == 2
+
+
+def test_load_chat_returns_its_turns_in_order(client, conversations):
+    with chat_app.app.app_context():
+        chat_app.record_chat_turn(conversations[2], 'Grok', 'follow up', 'more')
+
+    history = client.get('/load_chat/Chat 2').json['history']
+
+    assert history == [{'user': 'question 2', 'bot': 'answer 2'}, {'user': 'follow up', 'bot': 'more'}]
+
+
+def test_a_clashing_name_gets_a_suffix(testuser, conversations):
+    with chat_app.app.app_context():
+        clash = chat_app.create_conversation(testuser, 'Chat 1')
+        assert clash.name.startswith('Chat 1_')
+
+
+def test_delete_history_removes_conversations_and_turns(client, conversations):
+    assert client.post('/delete_history').json == {'status': 'success'}
+
+    assert client.get('/get_chat_history').json['chat_names'] == []
+    with chat_app.app.app_context():
+        assert chat_app.ChatHistory.query.count() == 0
@@ -0,0 +1,76 @@
+import pytest
+
+from conftest import chat_app, send_messages
+
+
+@pytest.fixture
+def people(make_user):
+    ids = {}
+    for username, public_username in [('Ravi', None), ('rahul', 'rockstar'), ('raj', None), ('suresh', 'rapper'),
+                                      ('rachel', 'radio'), ('mohan', None)]:
+        ids[username] = make_user(username)
+        if public_username:
+            with chat_app.app.app_context():
+                chat_app.db.session.get(chat_app.User, ids[username]).public_username = public_username
+                chat_app.db.session.commit()
+    return ids
+
+
+def search(client, query, **params):
+    return client.get('/api/directory', query_string=dict(params, q=query)).json
+
+
+def names(page):
+    return [user['username'] for user in page['users']]
+
+
+def test_prefix_search_matches_either_name_once_in_order(client, people):
+    assert names(search(client, 'RA')) == ['rachel', 'rahul', 'raj', 'suresh', 'Ravi']
+    assert names(search(client, '@ro')) == ['rahul']
+    assert names(search(client, 'testu')) == []  # The caller is left out
+
+
+def test_pages_follow_the_cursor_without_gaps(client, people):
+    seen, cursor = [], None
+    while True:
+        page = search(client, 'ra', limit=2, **({'cursor': cursor} if cursor else {}))
+        seen.extend(names(page))
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+
+    assert seen == names(search(client, 'ra'))
+
+
+def test_a_bad_cursor_is_refused(client, people):
+    assert client.get('/api/directory?q=ra&cursor=not-a-cursor').status_code == 400
+
+
+def test_recent_correspondents_newest_first(client, socket_for, people):
+    sock = socket_for(client)
+    send_messages(sock, ['hi'], receiver_id=people['raj'])
+    send_messages(sock, ['hi'], receiver_id=people['mohan'])
+    assert names(search(client, '')) == ['mohan', 'raj']
+
+    send_messages(sock, ['again'], receiver_id=people['raj'])  # Clears the cached list
+
+    assert names(search(client, '')) == ['raj', 'mohan']
+
+
+def test_search_pages_are_cached(client, people):
+    assert names(search(client, 'moh')) == ['mohan']
+    with chat_app.app.app_context():
+        chat_app.db.session.get(chat_app.User, people['mohan']).username = 'gone'
+        chat_app.db.session.commit()
+
+    assert names(search(client, 'moh')) == ['mohan']
+    chat_app.directory.search_cache.entries.clear()
+    assert names(search(client, 'moh')) == []
+
+
+def test_bench_directory_runs_on_a_scratch_database(testuser):
+    result = chat_app.app.test_cli_runner().invoke(args=['bench-directory', '--users', '300', '--contacts', '20', '--runs', '2'])
+
+    assert result.exit_code == 0, result.output
+    with chat_app.app.app_context():
+        assert chat_app.User.query.count() == 1  # Nothing was written to the app's database
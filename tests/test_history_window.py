@@ -0,0 +1,60 @@
+import pytest
+
+from conftest import chat_app
+
+
+@pytest.fixture
+def conversation(testuser):
+    with chat_app.app.app_context():
+        conversation = chat_app.create_conversation(testuser, 'History test', 'Grok')
+        for number in range(10):
+            chat_app.record_chat_turn(conversation.id, 'Grok', f"question {number} " + 'q' * 180,
+                                      f"Answer {number}. " + 'a' * 180)
+        return conversation.id
+
+
+def context_for(conversation_id):
+    with chat_app.app.app_context():
+        conversation = chat_app.db.session.get(chat_app.Conversation, conversation_id)
+        return chat_app.build_history_context(conversation), conversation.summary, conversation.summarized_up_to_id
+
+
+def test_recent_turns_fit_the_token_budget(conversation, monkeypatch):
+    monkeypatch.setitem(chat_app.app.config, 'AI_HISTORY_TOKEN_BUDGET', 250)
+
+    context, summary, _ = context_for(conversation)
+
+    recent = context.split("Recent messages:\n", 1)[1]
+    assert recent.count('User: question') == 2
+    assert 'question 9' in recent and 'question 8' in recent
+    assert chat_app.estimate_tokens(recent) <= 250
+
+
+def test_older_turns_are_folded_into_the_summary_once(conversation, monkeypatch):
+    monkeypatch.setitem(chat_app.app.config, 'AI_HISTORY_TOKEN_BUDGET', 250)
+
+    context, summary, summarized_up_to = context_for(conversation)
+
+    assert context.startswith("Summary of the earlier conversation:\n")
+    assert summary.splitlines()[-1].startswith("- User asked: question 7")
+    assert "Bot said: Answer 7." in summary
+    # A second request reuses the stored summary instead of summarizing the same turns again
+    assert context_for(conversation)[1:] == (summary, summarized_up_to)
+
+
+def test_summary_keeps_to_its_budget(conversation, monkeypatch):
+    monkeypatch.setitem(chat_app.app.config, 'AI_HISTORY_TOKEN_BUDGET', 100)
+    monkeypatch.setitem(chat_app.app.config, 'AI_SUMMARY_TOKEN_BUDGET', 120)
+
+    _, summary, _ = context_for(conversation)
+
+    assert chat_app.estimate_tokens(summary) <= 120
+    assert 'question 8' in summary  # The newest summarized turn survives, the oldest go first
+
+
+def test_a_short_chat_is_sent_whole(testuser):
+    with chat_app.app.app_context():
+        conversation = chat_app.create_conversation(testuser, 'Short chat', 'Grok')
+        chat_app.record_chat_turn(conversation.id, 'Grok', 'hi', 'hello bhai')
+        context = chat_app.build_history_context(conversation)
+    assert context == "User: hi\nBot: hello bhai\n"
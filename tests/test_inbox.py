@@ -0,0 +1,115 @@
+import datetime
+
+import pytest
+
+from conftest import chat_app, login, received, send_messages
+
+
+@pytest.fixture
+def chat(client, socket_for, make_user, testuser):
+    alice = make_user('alice')
+    me = socket_for(client)
+    other = socket_for(login('alice', 'secret'))
+    send_messages(me, ['one', 'two', 'x' * 200], receiver_id=alice)
+    return {'me': me, 'other': other, 'alice': alice, 'key': chat_app.conversation_key(testuser, alice)}
+
+
+def entries(client, **params):
+    return client.get('/api/inbox', query_string=params).json
+
+
+def entry_of(user_id, key):
+    with chat_app.app.app_context():
+        [entry], _ = chat_app.inbox.page(user_id)
+        assert entry['conversation_key'] == key
+        return entry
+
+
+def test_both_sides_get_an_entry_with_preview_and_unread_count(chat, testuser):
+    mine, theirs = entry_of(testuser, chat['key']), entry_of(chat['alice'], chat['key'])
+    preview_chars = chat_app.app.config['INBOX_PREVIEW_CHARS']
+
+    assert (mine['id'], mine['unread_count']) == (chat['alice'], 0)
+    assert (theirs['id'], theirs['unread_count']) == (testuser, 3)
+    assert theirs['preview'] == mine['preview'] == 'x' * preview_chars
+    assert received(chat['other'], 'inbox_updated')[-1]['unread_count'] == 3
+
+
+def test_a_reply_resets_the_repliers_count(chat, testuser):
+    send_messages(chat['other'], ['back'], receiver_id=testuser)
+
+    assert entry_of(chat['alice'], chat['key'])['unread_count'] == 0
+    assert entry_of(testuser, chat['key'])['unread_count'] == 1
+    assert entry_of(testuser, chat['key'])['preview'] == 'back'
+
+
+def test_reading_clears_the_count_and_tells_the_reader(chat):
+    with chat_app.app.app_context():
+        ids = [message.id for message in chat_app.Message.query.filter_by(conversation_key=chat['key']).order_by(chat_app.Message.id)]
+    chat['other'].emit('message_read', {'message_id': ids[1], 'room': chat['key']})
+    chat['other'].get_received()
+    chat_app.read_receipts.flush()
+
+    assert entry_of(chat['alice'], chat['key'])['unread_count'] == 1
+    assert received(chat['other'], 'inbox_updated')[-1]['unread_count'] == 1
+
+
+def test_an_older_message_stored_late_does_not_replace_the_preview(chat, testuser):
+    latest = entry_of(testuser, chat['key'])
+    with chat_app.app.app_context(), chat_app.db.engine.begin() as conn:
+        chat_app.inbox.record_messages(conn, [{
+            'id': latest['last_message_id'] - 1, 'sender_id': chat['alice'], 'receiver_id': testuser, 'group_id': None,
+            'content': chat_app.encrypt_message('stale'), 'content_type': 'text', 'timestamp': datetime.datetime.utcnow(),
+            'conversation_key': chat['key'], chat_app.SEARCH_TEXT_KEY: 'stale'
+        }])
+
+    entry = entry_of(testuser, chat['key'])
+    assert entry['last_message_id'] == latest['last_message_id']
+    assert entry['preview'] == latest['preview']
+
+
+def test_editing_the_last_message_updates_the_preview(client, chat, testuser):
+    client.post(f"/edit_message/{entry_of(testuser, chat['key'])['last_message_id']}", data={'content': 'fixed'})
+
+    assert entry_of(chat['alice'], chat['key'])['preview'] == 'fixed'
+
+
+def test_group_members_get_entries(client, socket_for, make_user, testuser):
+    bob = make_user('bob')
+    with chat_app.app.app_context():
+        group = chat_app.Group(name='trip', creator_id=testuser)
+        chat_app.db.session.add(group)
+        chat_app.db.session.flush()
+        chat_app.db.session.add_all([chat_app.GroupMember(group_id=group.id, user_id=user_id) for user_id in (testuser, bob)])
+        chat_app.db.session.commit()
+        group_id = group.id
+    send_messages(socket_for(client), ['plan?'], group_id=group_id)
+
+    entry = entry_of(bob, f"group_{group_id}")
+    assert (entry['type'], entry['name'], entry['unread_count'], entry['preview']) == ('group', 'trip', 1, 'plan?')
+
+
+def test_sidebar_pages_are_newest_first(client, socket_for, make_user):
+    me = socket_for(client)
+    for name in ('p1', 'p2', 'p3'):
+        send_messages(me, [f"hi {name}"], receiver_id=make_user(name))
+
+    with chat_app.app.app_context():
+        first, cursor = chat_app.inbox.page(chat_app.User.query.filter_by(username='testuser').one().id, limit=2)
+    rest = entries(client, before=cursor)
+
+    assert [entry['name'] for entry in first] == ['p3', 'p2']
+    assert [entry['name'] for entry in rest['entries']] == ['p1']
+    assert client.get('/api/inbox?before=garbage').status_code == 400
+
+
+def test_inbox_rebuild_recomputes_entries(chat, testuser):
+    with chat_app.app.app_context():
+        chat_app.InboxEntry.query.update({'unread_count': 99, 'preview': None})
+        chat_app.db.session.commit()
+
+    result = chat_app.app.test_cli_runner().invoke(args=['inbox-rebuild'])
+
+    assert 'Rebuilt the inbox entries of 1 conversations' in result.output
+    assert entry_of(chat['alice'], chat['key'])['unread_count'] == 3
+    assert entry_of(testuser, chat['key'])['preview'] == 'x' * chat_app.app.config['INBOX_PREVIEW_CHARS']
@@ -0,0 +1,130 @@
+import base64
+import json
+import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+
+from conftest import chat_app, send_messages
+
+OLD_KEY, NEW_KEY = b'k' * 32, b'n' * 32
+
+
+@pytest.fixture
+def rotated(monkeypatch):
+    ring = chat_app.Keyring({'k1': OLD_KEY, 'k2': NEW_KEY}, 'k2')
+    monkeypatch.setattr(chat_app, 'keyring', ring)
+    return ring
+
+
+def test_tokens_name_their_key_and_use_a_fresh_nonce():
+    ring = chat_app.Keyring({'k1': OLD_KEY}, 'k1')
+    first, second = ring.encrypt('hello'), ring.encrypt('hello')
+
+    assert first.startswith('v2:k1:')
+    assert first != second
+    assert ring.decrypt(first) == ring.decrypt(second) == 'hello'
+
+
+def test_tampered_tokens_and_swapped_key_ids_are_rejected():
+    ring = chat_app.Keyring({'k1': OLD_KEY, 'k2': OLD_KEY}, 'k1')
+    token = ring.encrypt('hello')
+    raw = bytearray(base64.b64decode(token.split(':', 2)[2]))
+    raw[15] ^= 1
+
+    with pytest.raises(ValueError):
+        ring.decrypt(f"v2:k1:{base64.b64encode(bytes(raw)).decode()}")
+    with pytest.raises(ValueError):
+        ring.decrypt(token.replace('v2:k1:', 'v2:k2:'))  # The key id is authenticated data
+
+
+def test_a_rotated_keyring_still_reads_old_and_legacy_messages(rotated):
+    old = chat_app.Keyring({'k1': OLD_KEY}, 'k1').encrypt('before rotation')
+    iv = b'i' * 16
+    legacy = base64.b64encode(iv + AES.new(OLD_KEY, AES.MODE_CBC, iv).encrypt(pad(b'from the old days', 16))).decode()
+    legacy_ring = chat_app.Keyring({'legacy': OLD_KEY, 'k1': OLD_KEY}, 'k1')
+
+    assert rotated.decrypt(old) == 'before rotation'
+    assert rotated.is_current(rotated.encrypt('new')) and not rotated.is_current(old)
+    assert legacy_ring.decrypt(legacy) == 'from the old days'
+
+
+def test_an_unknown_active_key_is_refused():
+    with pytest.raises(ValueError):
+        chat_app.Keyring({'k1': OLD_KEY}, 'k9')
+
+
+def test_the_first_worker_creates_a_private_keyring_file_the_rest_reuse(tmp_path, monkeypatch):
+    path = str(tmp_path / 'instance' / 'keyring.json')
+    monkeypatch.setitem(chat_app.app.config, 'AES_KEYS', None)
+    monkeypatch.setitem(chat_app.app.config, 'AES_KEYRING_PATH', path)
+
+    first, second = chat_app.load_keyring(), chat_app.load_keyring()
+
+    assert first.keys == second.keys
+    assert first.active_key_id == 'k1'
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+
+def test_workers_starting_together_all_read_one_whole_keyring(tmp_path, monkeypatch):
+    path = str(tmp_path / 'keyring.json')
+    monkeypatch.setitem(chat_app.app.config, 'AES_KEYS', None)
+    monkeypatch.setitem(chat_app.app.config, 'AES_KEYRING_PATH', path)
+
+    with ThreadPoolExecutor(8) as pool:
+        rings = list(pool.map(lambda _: chat_app.load_keyring(), range(8)))
+
+    assert all(ring.keys == rings[0].keys for ring in rings)
+    assert os.listdir(tmp_path) == ['keyring.json']
+
+
+def test_rewriting_the_keyring_swaps_in_a_new_file(tmp_path):
+    path = str(tmp_path / 'keyring.json')
+    chat_app.write_keyring_file(path, {'k1': OLD_KEY}, 'k1', exclusive=True)
+    with open(path) as reader:
+        chat_app.write_keyring_file(path, {'k1': OLD_KEY, 'k2': NEW_KEY}, 'k2')
+        assert json.load(reader)['active'] == 'k1'  # An open reader keeps the whole old file
+
+    with pytest.raises(FileExistsError):
+        chat_app.write_keyring_file(path, {'k3': OLD_KEY}, 'k3', exclusive=True)
+    with open(path) as f:
+        assert json.load(f)['active'] == 'k2'
+    assert os.listdir(tmp_path) == ['keyring.json']
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+
+def test_rotate_key_adds_an_active_key_to_the_file(tmp_path, monkeypatch):
+    path = str(tmp_path / 'keyring.json')
+    runner = chat_app.app.test_cli_runner()
+    assert runner.invoke(args=['rotate-key']).exit_code != 0  # AES_KEYS is set for the tests
+
+    monkeypatch.setitem(chat_app.app.config, 'AES_KEYS', None)
+    monkeypatch.setitem(chat_app.app.config, 'AES_KEYRING_PATH', path)
+    result = runner.invoke(args=['rotate-key'])
+
+    assert result.exit_code == 0, result.output
+    with open(path) as f:
+        data = json.load(f)
+    assert data['active'] == 'k2'
+    assert set(data['keys']) == {'k1', 'k2'}
+
+
+def test_reencrypt_moves_old_messages_to_the_active_key(client, socket_for, make_user, rotated):
+    alice = make_user('alice')
+    with pytest.MonkeyPatch.context() as old_key:
+        old_key.setattr(chat_app, 'keyring', chat_app.Keyring({'k1': OLD_KEY}, 'k1'))
+        send_messages(socket_for(client), ['one', 'two', 'three'], receiver_id=alice)
+    with chat_app.app.app_context():
+        broken = chat_app.Message.query.order_by(chat_app.Message.id).first()
+        broken.content = 'v2:k9:AAAA'  # Its key is gone; left as it is
+        chat_app.db.session.commit()
+
+        assert chat_app.reencrypt_messages(batch_size=2) == 2
+        contents = [message.content for message in chat_app.Message.query.order_by(chat_app.Message.id)]
+
+    assert contents[0] == 'v2:k9:AAAA'
+    assert all(rotated.is_current(content) for content in contents[1:])
+    assert [rotated.decrypt(content) for content in contents[1:]] == ['two', 'three']
@@ -0,0 +1,81 @@
+import json
+import logging
+import queue
+
+from conftest import chat_app
+
+
+def record(message, level=logging.INFO, **extra):
+    entry = logging.LogRecord('app', level, __file__, 1, message, None, None)
+    entry.__dict__.update(extra)
+    return entry
+
+
+def test_secrets_are_redacted():
+    text = chat_app.redact('Authorization: Bearer abc.def sk-or-v1-12345678 password=hunter2 {"api_key": "xyz"}')
+
+    assert text == 'Authorization: Bearer [REDACTED] [REDACTED] password=[REDACTED] {"api_key": "[REDACTED]"}'
+
+
+def test_long_messages_are_truncated():
+    text = chat_app.redact('x' * (chat_app.LOG_MAX_MESSAGE + 10))
+
+    assert text.endswith('... [10 chars truncated]')
+    assert text.startswith('x' * chat_app.LOG_MAX_MESSAGE)
+
+
+def test_json_lines_carry_the_request_id_and_redacted_message():
+    line = json.loads(chat_app.JsonFormatter().format(record('token=abc123', request_id='req-1')))
+
+    assert line['message'] == 'token=[REDACTED]'
+    assert line['request_id'] == 'req-1'
+    assert line['level'] == 'INFO'
+    assert 'socket_id' not in line
+
+
+def test_debug_records_are_sampled_and_the_rest_kept(monkeypatch):
+    sampler = chat_app.DebugSampler(0.5)
+    monkeypatch.setattr(chat_app.random, 'random', lambda: 0.7)
+
+    assert not sampler.filter(record('noise', logging.DEBUG))
+    assert sampler.filter(record('kept', logging.INFO))
+    assert chat_app.DebugSampler(1).filter(record('noise', logging.DEBUG))
+
+
+def test_a_full_log_queue_drops_records_instead_of_blocking(monkeypatch):
+    monkeypatch.setattr(chat_app.DeferredQueueHandler, 'dropped', 0)
+    handler = chat_app.DeferredQueueHandler(queue.Queue(maxsize=1))
+
+    handler.handle(record('first'))
+    handler.handle(record('second'))
+
+    assert handler.queue.qsize() == 1
+    assert chat_app.DeferredQueueHandler.dropped == 1
+
+
+def test_responses_echo_or_assign_a_request_id(client):
+    assert client.get('/login', headers={'X-Request-ID': 'from-proxy'}).headers['X-Request-ID'] == 'from-proxy'
+    first, second = client.get('/login').headers['X-Request-ID'], client.get('/login').headers['X-Request-ID']
+    assert first and first != second
+
+
+def test_records_in_a_request_get_its_id():
+    with chat_app.app.test_request_context('/', headers={'X-Request-ID': 'req-2'}):
+        chat_app.assign_request_id()
+        entry = record('inside')
+        chat_app.RequestContextFilter().filter(entry)
+
+    assert entry.request_id == 'req-2'
+
+
+def test_queued_records_keep_the_values_they_were_logged_with():
+    handler = chat_app.DeferredQueueHandler(queue.Queue())
+    state = {'status': 'sending'}
+    entry = logging.LogRecord('app', logging.INFO, __file__, 1, 'mail %s', (state,), None)
+
+    handler.handle(entry)
+    state['status'] = 'sent'
+
+    queued = handler.queue.get_nowait()
+    assert queued.getMessage() == "mail {'status': 'sending'}"
+    assert queued.args is None
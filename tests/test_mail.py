@@ -0,0 +1,155 @@
+import smtplib
+import threading
+import time
+from email import message_from_bytes
+
+import pytest
+
+from conftest import chat_app
+
+
+@pytest.fixture
+def sink():
+    received = []
+
+    def on_message(mail_from, recipients, data):
+        received.append((recipients, message_from_bytes(data)['Subject']))
+    server = chat_app.SmtpSink(('127.0.0.1', 0), on_message)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.received = received
+    server.connections = 0
+
+    def connect():
+        server.connections += 1
+        return smtplib.SMTP('127.0.0.1', server.server_address[1], timeout=5)
+    server.connect = connect
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_sender(connect, workers=1, max_queue=10, max_attempts=3, max_per_connection=100):
+    return chat_app.MailSender(workers, max_queue, max_attempts, 0.01, 30, max_per_connection, 0, connect=connect)
+
+
+def dead_letters():
+    with chat_app.app.app_context():
+        return [(letter.to_email, letter.attempts) for letter in chat_app.DeadLetterEmail.query.order_by(chat_app.DeadLetterEmail.id)]
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return condition()
+
+
+def test_emails_are_sent_over_one_reused_connection(sink):
+    sender = make_sender(sink.connect)
+    for number in range(3):
+        sender.submit(f"user{number}@example.com", f"Code {number}", 'body')
+    sender.close()
+
+    assert sink.received == [([f"<user{number}@example.com>"], f"Code {number}") for number in range(3)]
+    assert sink.connections == 1
+
+
+def test_a_connection_is_replaced_after_its_quota(sink):
+    sender = make_sender(sink.connect, max_per_connection=2)
+    for number in range(5):
+        sender.submit('user@example.com', f"Code {number}", 'body')
+    sender.close()
+
+    assert len(sink.received) == 5
+    assert sink.connections == 3
+
+
+def test_temporary_failures_are_retried(sink):
+    failures = [ConnectionRefusedError('down'), smtplib.SMTPServerDisconnected('gone')]
+
+    def flaky():
+        if failures:
+            raise failures.pop(0)
+        return sink.connect()
+    sender = make_sender(flaky)
+    sender.submit('user@example.com', 'Code', 'body')
+
+    assert wait_until(lambda: sink.received)
+    sender.close()
+    assert dead_letters() == []
+
+
+def test_permanent_failures_and_exhausted_retries_are_dead_lettered():
+    def refuse():
+        raise smtplib.SMTPRecipientsRefused({'bad@example.com': (550, b'no such user')})
+    sender = make_sender(refuse)
+    sender.submit('bad@example.com', 'Code', 'body')
+    assert wait_until(lambda: dead_letters() == [('bad@example.com', 1)])
+    sender.close()
+
+    def unreachable():
+        raise ConnectionRefusedError('down')
+    sender = make_sender(unreachable, max_attempts=2)
+    sender.submit('later@example.com', 'Code', 'body')
+    assert wait_until(lambda: ('later@example.com', 2) in dead_letters())
+    sender.close()
+
+
+def test_unsent_emails_are_dead_lettered_at_shutdown():
+    release = threading.Event()
+
+    def hung():
+        release.wait(5)
+        raise ConnectionRefusedError('down')
+    sender = make_sender(hung)
+    sender.submit('first@example.com', 'Code', 'body')
+    sender.submit('second@example.com', 'Code', 'body')
+    sender.close(timeout=0.2)
+    release.set()
+
+    assert wait_until(lambda: ('second@example.com', 0) in dead_letters())
+    # The hung worker still owns the first email; it runs out of attempts on its own
+    assert wait_until(lambda: ('first@example.com', 3) in dead_letters())
+
+
+def test_a_full_queue_fails_fast():
+    sender = make_sender(lambda: None, max_queue=1)
+    sender._ensure_started = lambda: None  # Nothing drains the queue
+    sender.submit('one@example.com', 'Code', 'body')
+
+    with pytest.raises(RuntimeError):
+        sender.submit('two@example.com', 'Code', 'body')
+
+
+@pytest.mark.parametrize('error, permanent', [
+    (smtplib.SMTPRecipientsRefused({'a': (550, b'no')}), True),
+    (smtplib.SMTPRecipientsRefused({'a': (550, b'no'), 'b': (451, b'later')}), False),
+    (smtplib.SMTPDataError(554, b'rejected'), True),
+    (smtplib.SMTPDataError(421, b'busy'), False),
+    (smtplib.SMTPAuthenticationError(535, b'bad login'), False),
+    (smtplib.SMTPServerDisconnected('gone'), False),
+])
+def test_permanent_errors(error, permanent):
+    assert chat_app.MailSender.is_permanent(error) is permanent
+
+
+def test_the_token_bucket_limits_the_rate():
+    bucket = chat_app.TokenBucket(20)
+    started = time.monotonic()
+    for _ in range(25):
+        bucket.take()
+
+    assert time.monotonic() - started >= 0.2
+
+
+def test_mail_requeue_sends_dead_letters_again(sink, monkeypatch):
+    chat_app.mail_sender._dead_letter([
+        {'to': f"user{number}@example.com", 'subject': f"Code {number}", 'body': 'body', 'attempts': 5,
+         'last_error': 'timed out', 'created_at': chat_app.datetime.datetime.utcnow()} for number in range(2)
+    ])
+    monkeypatch.setattr(chat_app, 'mail_sender', make_sender(sink.connect))
+
+    result = chat_app.app.test_cli_runner().invoke(args=['mail-requeue'])
+
+    assert 'Requeued 2 emails, 0 dead letters left' in result.output
+    assert sorted(subject for _, subject in sink.received) == ['Code 0', 'Code 1']
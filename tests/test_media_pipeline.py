@@ -0,0 +1,117 @@
+import io
+import os
+import time
+
+import pytest
+from PIL import Image
+
+from conftest import chat_app, received
+
+
+@pytest.fixture(autouse=True)
+def restore_profile_pic(testuser):
+    yield
+    with chat_app.app.app_context():
+        chat_app.db.session.get(chat_app.User, testuser).profile_pic = None
+        chat_app.db.session.commit()
+
+
+def jpeg(size=(400, 200), orientation=None):
+    img = Image.new('RGB', size, 'red')
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    data = io.BytesIO()
+    img.save(data, 'JPEG', exif=exif)
+    data.seek(0)
+    return data
+
+
+def wait_for(sock, name, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        events = received(sock, name)
+        if events:
+            return events
+        time.sleep(0.02)
+    raise AssertionError(f"no {name} event")
+
+
+def variant_sizes(dest_dir, token):
+    sizes = {}
+    for name in sorted(os.listdir(dest_dir)):
+        if name.startswith(token):
+            with Image.open(os.path.join(dest_dir, name)) as img:
+                sizes[name[len(token) + 1:]] = img.size
+    return sizes
+
+
+def test_variants_are_cropped_resized_and_upright(tmp_path):
+    source = tmp_path / 'source'
+    source.write_bytes(jpeg((2400, 1200), orientation=6).read())  # Stored sideways
+
+    chat_app.render_image_variants(str(source), str(tmp_path), 'tok')
+
+    assert variant_sizes(str(tmp_path), 'tok') == {
+        'medium.jpg': (540, 1080), 'medium.webp': (540, 1080),
+        'thumb.jpg': (150, 150), 'thumb.webp': (150, 150),
+    }
+
+
+def test_a_status_image_is_processed_off_the_request(client, socket_for, testuser):
+    sock = socket_for(client)
+    response = client.post('/status', data={'content': 'hi', 'file': (jpeg(), 'photo.jpg')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 302
+
+    [event] = wait_for(sock, 'media_ready')
+    with chat_app.app.app_context():
+        status = chat_app.Status.query.filter_by(user_id=testuser).one()
+        assert status.media_state == 'ready'
+    token = os.path.basename(status.file_path)[:-len('_medium.jpg')]
+    assert event['kind'] == 'status' and event['id'] == status.id and event['state'] == 'ready'
+    assert event['webp_url'].endswith('_medium.webp')
+    assert set(variant_sizes(chat_app.app.config['STATUS_FOLDER'], token)) == {
+        'medium.jpg', 'medium.webp', 'thumb.jpg', 'thumb.webp'
+    }
+    assert os.listdir(chat_app.app.config['MEDIA_ORIGINALS_FOLDER']) == []
+
+
+def test_a_failed_render_marks_the_status_and_cleans_up(client, socket_for, testuser, monkeypatch):
+    def broken(source_path, dest_dir, token):
+        raise OSError('truncated')
+    monkeypatch.setattr(chat_app, 'render_image_variants', broken)
+    sock = socket_for(client)
+    client.post('/status', data={'file': (jpeg(), 'photo.jpg')}, content_type='multipart/form-data')
+
+    [event] = wait_for(sock, 'media_ready')
+    assert event['state'] == 'failed' and 'url' not in event
+    with chat_app.app.app_context():
+        assert chat_app.Status.query.filter_by(user_id=testuser).one().media_state == 'failed'
+    assert os.listdir(chat_app.app.config['MEDIA_ORIGINALS_FOLDER']) == []
+
+
+def test_files_that_are_not_images_are_rejected_before_queueing(client, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(chat_app.media_executor, 'submit', lambda *args: submitted.append(args))
+
+    client.post('/profile', data={'profile_pic': (io.BytesIO(b'not a picture'), 'photo.jpg')},
+                content_type='multipart/form-data')
+
+    assert submitted == []
+    assert os.listdir(chat_app.app.config['MEDIA_ORIGINALS_FOLDER']) == []
+
+
+def test_a_new_profile_picture_replaces_the_old_variants(client, socket_for, testuser):
+    sock = socket_for(client)
+    tokens = []
+    for _ in range(2):
+        client.post('/profile', data={'profile_pic': (jpeg(), 'me.jpg')}, content_type='multipart/form-data')
+        wait_for(sock, 'media_ready')
+        with chat_app.app.app_context():
+            tokens.append(chat_app.db.session.get(chat_app.User, testuser).profile_pic[:-len('_thumb.jpg')])
+
+    folder = chat_app.app.config['PROFILE_PICS_FOLDER']
+    assert variant_sizes(folder, tokens[0]) == {}
+    assert len(variant_sizes(folder, tokens[1])) == 4
+
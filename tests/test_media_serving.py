@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+from conftest import chat_app
+
+BODY = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def media():
+    path = os.path.join(chat_app.app.config['UPLOAD_FOLDER'], 'status', 'clip.mp4')
+    with open(path, 'wb') as f:
+        f.write(BODY)
+    yield 'status/clip.mp4'
+    os.remove(path)
+
+
+@pytest.fixture
+def anonymous():
+    return chat_app.app.test_client()
+
+
+def test_fingerprinted_urls_are_cached_for_a_year(anonymous, media):
+    with chat_app.app.test_request_context():
+        url = chat_app.media_url(media)
+    response = anonymous.get(url)
+
+    assert url.startswith('/media/') and url.endswith('/status/clip.mp4')
+    assert response.data == BODY
+    assert response.headers['Cache-Control'] == chat_app.MEDIA_IMMUTABLE
+    assert response.headers['Accept-Ranges'] == 'bytes'
+
+
+def test_a_changed_file_gets_a_new_url_and_the_old_one_is_not_cached(anonymous, media):
+    with chat_app.app.test_request_context():
+        old = chat_app.media_url(media)
+        with open(os.path.join(chat_app.app.config['UPLOAD_FOLDER'], media), 'ab') as f:
+            f.write(b'more')
+        new = chat_app.media_url(media)
+
+    assert new != old
+    assert anonymous.get(old).headers['Cache-Control'] == 'no-cache'
+
+
+def test_conditional_and_range_requests(anonymous, media):
+    first = anonymous.get(f"/uploads/{media}")
+    assert first.headers['Cache-Control'] == 'no-cache'
+
+    assert anonymous.get(f"/uploads/{media}", headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+    part = anonymous.get(f"/uploads/{media}", headers={'Range': 'bytes=100-199'})
+    assert part.status_code == 206
+    assert part.data == BODY[100:200]
+    assert part.headers['Content-Range'] == f"bytes 100-199/{len(BODY)}"
+
+
+def test_nginx_offload_sends_only_headers(anonymous, media, monkeypatch):
+    monkeypatch.setitem(chat_app.app.config, 'MEDIA_OFFLOAD', 'nginx')
+
+    response = anonymous.get(f"/uploads/{media}")
+
+    assert response.data == b''
+    assert response.headers['X-Accel-Redirect'] == '/protected-uploads/status/clip.mp4'
+    assert response.mimetype == 'video/mp4'
+    assert anonymous.get('/uploads/status/missing.mp4').status_code == 404
+
+
+def test_paths_outside_the_upload_folder_are_refused(anonymous, media):
+    assert anonymous.get('/media/abc/../app.db').status_code == 404
+    assert anonymous.get('/media/abc/%2e%2e/app.db').status_code == 404
@@ -0,0 +1,86 @@
+import datetime
+import time
+
+import pytest
+
+from conftest import chat_app, login, received, send_messages
+
+
+@pytest.fixture
+def chat(client, socket_for, make_user, testuser):
+    alice = make_user('alice')
+    key = chat_app.conversation_key(testuser, alice)
+    me = socket_for(client)
+    me.emit('join', {'room': key})
+    return {'me': me, 'alice': alice, 'key': key}
+
+
+def stored(key):
+    with chat_app.app.app_context():
+        return {message.id: message for message in chat_app.Message.query.filter_by(conversation_key=key)}
+
+
+def search(client, text):
+    return [result['id'] for result in client.get(f"/api/search?type=messages&q={text}").json['results']]
+
+
+@pytest.mark.parametrize('value, timer', [(None, None), ('', None), (0, None), ('30', 30), (86400, 86400)])
+def test_valid_timers(value, timer):
+    assert chat_app.parse_disappear_timer(value) == timer
+
+
+@pytest.mark.parametrize('value', [True, 1.5, -1, 'soon', chat_app.app.config['MAX_DISAPPEAR_TIMER'] + 1])
+def test_invalid_timers_are_refused(value):
+    with pytest.raises(ValueError):
+        chat_app.parse_disappear_timer(value)
+
+
+def test_a_bad_timer_is_reported_and_nothing_is_sent(chat):
+    send_messages(chat['me'], ['hi'], receiver_id=chat['alice'], disappear_timer=-5)
+
+    assert len(received(chat['me'], 'message_error')) == 1
+    assert stored(chat['key']) == {}
+
+
+def test_a_disappearing_message_is_deleted_when_due(client, chat):
+    send_messages(chat['me'], ['vanishing words'], receiver_id=chat['alice'], disappear_timer=1)
+    send_messages(chat['me'], ['lasting words'], receiver_id=chat['alice'])
+    [vanishing] = [message.id for message in stored(chat['key']).values() if message.expires_at]
+    chat['me'].get_received()
+
+    deadline = time.monotonic() + 5
+    while vanishing in stored(chat['key']) and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    assert vanishing not in stored(chat['key'])
+    assert received(chat['me'], 'messages_expired') == [{'conversation_key': chat['key'], 'message_ids': [vanishing]}]
+    assert search(client, 'vanishing') == []
+    assert len(search(client, 'lasting')) == 1
+
+
+def test_expire_due_removes_due_messages_in_batches(client, chat, monkeypatch):
+    send_messages(chat['me'], [f"message {number}" for number in range(5)], receiver_id=chat['alice'])
+    with chat_app.app.app_context():
+        chat_app.Message.query.filter_by(conversation_key=chat['key']).update(
+            {'expires_at': datetime.datetime.utcnow() - datetime.timedelta(seconds=1)})
+        chat_app.db.session.commit()
+        monkeypatch.setattr(chat_app.message_expiry, 'batch_size', 2)
+        chat_app.message_expiry.expire_due()
+
+    assert stored(chat['key']) == {}
+    assert search(client, 'message') == []
+    batches = [len(event['message_ids']) for event in received(chat['me'], 'messages_expired')]
+    assert sum(batches) == 5 and max(batches) == 2
+
+
+def test_setting_a_timer_over_http(client, chat, make_user):
+    send_messages(chat['me'], ['hi'], receiver_id=chat['alice'])
+    [message_id] = stored(chat['key'])
+
+    assert client.post(f"/set_disappear_timer/{message_id}", data={'timer': 'abc'}).status_code == 400
+    assert login('alice', 'secret').post(f"/set_disappear_timer/{message_id}", data={'timer': '60'}).status_code == 403
+    assert client.post(f"/set_disappear_timer/{message_id}", data={'timer': '60'}).status_code == 200
+
+    message = stored(chat['key'])[message_id]
+    assert message.disappear_timer == 60
+    assert 59 <= (message.expires_at - datetime.datetime.utcnow()).total_seconds() <= 60
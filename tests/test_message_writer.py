@@ -0,0 +1,107 @@
+import datetime
+import queue
+import threading
+
+import pytest
+
+from conftest import chat_app, login, received
+
+
+@pytest.fixture
+def engine():
+    with chat_app.app.app_context():
+        return chat_app.db.engine
+
+
+def message_row(message_id, sender_id, receiver_id, content='hi'):
+    return {
+        'id': message_id, 'sender_id': sender_id, 'receiver_id': receiver_id, 'group_id': None,
+        'content': chat_app.encrypt_message(content), 'content_type': 'text', 'file_path': None,
+        'timestamp': datetime.datetime.utcnow(), 'is_read': False, 'is_secret': False, 'disappear_timer': None,
+        'edited': False, 'edit_version': 0, 'expires_at': None,
+        'conversation_key': chat_app.conversation_key(sender_id, receiver_id), chat_app.SEARCH_TEXT_KEY: content
+    }
+
+
+def test_room_sees_the_message_before_the_sender_hears_it_was_stored(client, socket_for, make_user, testuser):
+    alice = make_user('alice')
+    key = chat_app.conversation_key(testuser, alice)
+    other = socket_for(login('alice', 'secret'))
+    other.emit('join', {'room': key})
+    me = socket_for(client)
+
+    me.emit('send_message', {'receiver_id': alice, 'content': 'hello'})
+    [delivered] = received(other, 'receive_message')
+    chat_app.message_writer.flush(5)
+
+    assert delivered['content'] == 'hello'
+    assert received(me, 'message_stored') == [{'message_id': delivered['message_id'], 'conversation_key': key}]
+    with chat_app.app.app_context():
+        stored = chat_app.db.session.get(chat_app.Message, delivered['message_id'])
+        assert chat_app.decrypt_message(stored.content) == 'hello'
+
+
+def test_a_bad_row_fails_alone_and_the_rest_of_the_batch_lands(testuser, make_user, engine):
+    alice = make_user('alice')
+    stored, failed = [], []
+    writer = chat_app.MessageWriter(10, 10, 1, on_stored=lambda row, sid: stored.append(row['id']),
+                                    on_failed=lambda row, sid, error: failed.append(row['id']))
+    ids = chat_app.IdAllocator('test-writer', chat_app.Message, 10, engine=engine)
+    first, second = ids.next(), ids.next()
+    try:
+        writer.submit(message_row(first, testuser, alice))
+        writer.submit(message_row(second, testuser, alice))
+        writer.submit(message_row(first, testuser, alice))  # Duplicate primary key
+        assert writer.flush(5)
+    finally:
+        writer.close()
+
+    assert stored == [first, second]
+    assert failed == [first]
+
+
+def test_a_full_queue_pushes_back_on_the_sender(monkeypatch):
+    writer = chat_app.MessageWriter(1, 10, 0.05)
+    monkeypatch.setattr(writer, '_ensure_started', lambda: None)  # Nothing drains the queue
+
+    writer.submit({'id': 1})
+    with pytest.raises(queue.Full):
+        writer.submit({'id': 2})
+
+
+def test_allocators_in_separate_processes_never_share_ids(engine):
+    one = chat_app.IdAllocator('test-ids', chat_app.Message, 5, engine=engine)
+    two = chat_app.IdAllocator('test-ids', chat_app.Message, 5, engine=engine)
+    taken = []
+
+    def take(allocator):
+        for _ in range(40):
+            taken.append(allocator.next())
+
+    threads = [threading.Thread(target=take, args=(allocator,)) for allocator in (one, two)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(taken)) == 80
+
+
+def test_allocator_starts_above_existing_messages(testuser, make_user, engine):
+    alice = make_user('alice')
+    with chat_app.app.app_context():
+        chat_app.db.session.execute(chat_app.db.insert(chat_app.Message), [
+            chat_app.message_columns(message_row(10 ** 6, testuser, alice))
+        ])
+        chat_app.db.session.commit()
+
+    assert chat_app.IdAllocator('test-floor', chat_app.Message, 5, engine=engine).next() > 10 ** 6
+
+
+def test_several_workers_reserve_ids_one_at_a_time(monkeypatch):
+    monkeypatch.setitem(chat_app.app.config, 'SOCKETIO_MESSAGE_QUEUE', 'redis://localhost:6379/1')
+    monkeypatch.setitem(chat_app.app.config, 'MESSAGE_ID_REDIS_URL', None)
+    assert chat_app.make_message_ids().block_size == 1
+
+    monkeypatch.setitem(chat_app.app.config, 'SOCKETIO_MESSAGE_QUEUE', 'local://')
+    assert chat_app.make_message_ids().block_size == chat_app.app.config['MESSAGE_ID_BLOCK']
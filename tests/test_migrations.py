@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+
+from conftest import chat_app
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_migrated_schema_has_every_model_index():
+    # sqlite_master, since SQLAlchemy does not reflect expression indexes such as lower(username)
+    with chat_app.app.app_context():
+        existing = set(chat_app.db.session.execute(chat_app.db.text(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")).scalars())
+    expected = {index.name for table in chat_app.db.metadata.sorted_tables for index in table.indexes}
+    assert expected <= existing
+
+
+def test_migrations_match_the_models(tmp_path):
+    # A fresh database migrated from nothing has no differences from the models; the FTS tables,
+    # which have no models, are left out of the comparison
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{tmp_path / 'fresh.db'}", AUTO_MIGRATE='1')
+    result = subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'db', 'check'],
+                            cwd=ROOT, env=env, capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr[-2000:]
+    assert 'No new upgrade operations detected' in result.stdout + result.stderr
+
+
+def test_conversation_queries_use_the_composite_index():
+    with chat_app.app.app_context():
+        query = chat_app.db.session.query(chat_app.Message.id).filter(
+            chat_app.Message.conversation_key == 'chat_1_2'
+        ).order_by(chat_app.Message.timestamp.desc(), chat_app.Message.id.desc()).limit(50)
+        sql = str(query.statement.compile(chat_app.db.engine, compile_kwargs={'literal_binds': True}))
+        plan = ' '.join(row[-1] for row in chat_app.db.session.execute(chat_app.db.text(f"EXPLAIN QUERY PLAN {sql}")))
+    assert 'ix_message_conversation_key_timestamp' in plan
+    assert 'TEMP B-TREE' not in plan
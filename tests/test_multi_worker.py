@@ -0,0 +1,70 @@
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from conftest import chat_app
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def listen(manager, inbox):
+    for message in manager._listen():
+        inbox.put(json.loads(message))
+
+
+def test_a_publish_reaches_every_worker_on_the_channel():
+    # The Flask-SocketIO test client refuses pub/sub managers, so the workers are the managers themselves
+    channel = f"test-{uuid.uuid4().hex}"
+    workers = [chat_app.LocalQueueManager(channel=channel) for _ in range(2)]
+    elsewhere = chat_app.LocalQueueManager(channel=f"other-{channel}")
+    inboxes = [queue.Queue() for _ in range(3)]
+    for manager, inbox in zip(workers + [elsewhere], inboxes):
+        threading.Thread(target=listen, args=(manager, inbox), daemon=True).start()
+    deadline = time.monotonic() + 2
+    while len(chat_app.LocalQueueManager.channels.get(channel, [])) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    workers[0]._publish({'method': 'emit', 'event': 'receive_message', 'room': 'chat_1_2'})
+
+    for inbox in inboxes[:2]:
+        assert inbox.get(timeout=2)['room'] == 'chat_1_2'
+    assert inboxes[2].empty()
+
+
+def test_socketio_options_follow_the_message_queue(monkeypatch):
+    monkeypatch.setitem(chat_app.app.config, 'SOCKETIO_MESSAGE_QUEUE', None)
+    assert set(chat_app.make_socketio_options()) == {'async_mode', 'channel'}
+
+    monkeypatch.setitem(chat_app.app.config, 'SOCKETIO_MESSAGE_QUEUE', 'redis://localhost:6379/1')
+    assert chat_app.make_socketio_options()['message_queue'] == 'redis://localhost:6379/1'
+
+    monkeypatch.setitem(chat_app.app.config, 'SOCKETIO_MESSAGE_QUEUE', 'local://')
+    assert isinstance(chat_app.make_socketio_options()['client_manager'], chat_app.LocalQueueManager)
+
+
+def gunicorn_config(**env):
+    code = "exec(open('gunicorn.conf.py').read()); print(worker_class, workers, os.environ['SOCKETIO_ASYNC_MODE'])"
+    environ = {key: value for key, value in os.environ.items() if not key.startswith(('GUNICORN_', 'SOCKETIO_'))}
+    return subprocess.run([sys.executable, '-c', f"import os; {code}"], cwd=ROOT, env=dict(environ, **env),
+                          capture_output=True, text=True, timeout=30)
+
+
+def test_gunicorn_config_runs_the_app_in_the_workers_mode():
+    result = gunicorn_config()
+    assert result.stdout.split() == ['eventlet', '1', 'eventlet']
+
+    result = gunicorn_config(GUNICORN_WORKER_CLASS='gevent')
+    assert result.stdout.split() == ['gevent', '1', 'gevent']
+
+
+def test_gunicorn_config_refuses_several_workers_without_a_queue():
+    result = gunicorn_config(GUNICORN_WORKERS='2')
+    assert result.returncode != 0
+    assert 'SOCKETIO_MESSAGE_QUEUE' in result.stderr
+
+    assert gunicorn_config(GUNICORN_WORKERS='2', SOCKETIO_MESSAGE_QUEUE='redis://localhost:6379/1').returncode == 0
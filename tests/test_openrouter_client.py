@@ -0,0 +1,81 @@
+import time
+
+import pytest
+
+from conftest import chat_app
+
+
+def make_client(server, max_retries=0, threshold=3, reset_after=30):
+    client = chat_app.OpenRouterClient('test-key', server.url, 1, 5, max_retries, 0.2, threshold, reset_after, 4)
+    client.fallback_model = 'fallback'
+    return client
+
+
+def test_complete_returns_the_reply_over_one_pooled_session(openrouter_server):
+    client = make_client(openrouter_server)
+
+    assert client.complete('alpha', 'system', 'hi') == 'reply from alpha'
+    assert client.complete('alpha', 'system', 'hi again') == 'reply from alpha'
+    assert openrouter_server.calls == ['alpha', 'alpha']
+
+
+def test_a_failing_model_falls_back_once(openrouter_server):
+    client = make_client(openrouter_server)
+
+    assert client.complete('fail-model', 'system', 'hi') == 'reply from fallback'
+    assert openrouter_server.calls == ['fail-model', 'fallback']
+    assert client.breaker('fail-model').failures == 1
+
+
+def test_retries_are_limited_by_the_budget(openrouter_server):
+    client = make_client(openrouter_server, max_retries=2)
+    client.fallback_model = 'fail-fallback'
+    client.budget.tokens = 1
+
+    with pytest.raises(chat_app.OpenRouterError):
+        client.complete('fail-model', 'system', 'hi')
+
+    # One retry from the budget for the first model, none left for the fallback
+    assert openrouter_server.calls == ['fail-model', 'fail-model', 'fail-fallback']
+
+
+def test_breaker_opens_after_the_threshold_and_skips_the_model(openrouter_server):
+    client = make_client(openrouter_server, threshold=2)
+    client.fallback_model = 'fail-fallback'
+    for _ in range(2):
+        with pytest.raises(chat_app.OpenRouterError):
+            client.complete('fail-model', 'system', 'hi')
+    openrouter_server.calls.clear()
+
+    with pytest.raises(chat_app.OpenRouterError, match='Circuit open'):
+        client.complete('fail-model', 'system', 'hi')
+    assert openrouter_server.calls == []
+
+
+def test_breaker_lets_one_trial_through_after_the_reset():
+    breaker = chat_app.CircuitBreaker(threshold=1, reset_after=0.05)
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()  # Only one trial at a time
+    breaker.record_success()
+    assert breaker.allow()
+
+
+def test_a_stopped_trial_releases_the_breaker_without_a_failure(openrouter_server):
+    client = make_client(openrouter_server, threshold=1, reset_after=0)
+    breaker = client.breaker('trickle')
+    breaker.record_failure()
+    stop = chat_app.threading.Event()
+
+    stream = client.stream('trickle', 'system', 'hi', time.monotonic() + 5, stop)
+    assert next(stream) == 'reply '
+    assert breaker.trial_running
+    stop.set()
+    with pytest.raises(chat_app.OpenRouterStopped):
+        list(stream)
+
+    assert breaker.failures == 1
+    assert not breaker.trial_running
@@ -0,0 +1,63 @@
+import pytest
+
+from conftest import chat_app, send_messages
+
+
+@pytest.fixture
+def chat(client, socket_for, make_user):
+    alice = make_user('alice')
+    send_messages(socket_for(client), ['one', 'two'], receiver_id=alice)
+    with chat_app.app.app_context():
+        ids = [message.id for message in chat_app.Message.query.order_by(chat_app.Message.id)]
+    return {'alice': alice, 'ids': ids}
+
+
+@pytest.fixture
+def decrypts(monkeypatch):
+    calls = []
+    real = chat_app.decrypt_message
+
+    def counting(token):
+        calls.append(token)
+        return real(token)
+    monkeypatch.setattr(chat_app, 'decrypt_message', counting)
+    return calls
+
+
+def page(client, chat):
+    return [message['content'] for message in client.get(f"/api/messages/user/{chat['alice']}").json['messages']]
+
+
+def test_sent_messages_are_served_without_decrypting(client, chat, decrypts):
+    assert page(client, chat) == ['one', 'two']
+    assert decrypts == []
+
+
+def test_a_cold_page_is_decrypted_once_then_cached(client, chat, decrypts):
+    for message_id in chat['ids']:
+        chat_app.plaintext_cache.delete((message_id, 0))
+
+    assert page(client, chat) == ['one', 'two']
+    assert page(client, chat) == ['one', 'two']
+    assert len(decrypts) == 2
+
+
+def test_failed_decrypts_are_not_cached(client, chat, decrypts):
+    with chat_app.app.app_context():
+        message = chat_app.db.session.get(chat_app.Message, chat['ids'][0])
+        message.content = 'v2:k9:AAAA'
+        chat_app.db.session.commit()
+    chat_app.plaintext_cache.delete((chat['ids'][0], 0))
+
+    assert page(client, chat)[0] == 'Error decrypting message'
+    assert chat_app.plaintext_cache.get((chat['ids'][0], 0)) is None
+
+
+def test_an_edit_is_cached_under_its_new_version(client, chat, decrypts):
+    response = client.post(f"/edit_message/{chat['ids'][0]}", data={'content': 'uno'})
+
+    assert response.status_code == 200
+    assert chat_app.plaintext_cache.get((chat['ids'][0], 0)) is None
+    assert chat_app.plaintext_cache.get((chat['ids'][0], 1)) == 'uno'
+    assert page(client, chat) == ['uno', 'two']
+    assert decrypts == []
@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+from conftest import chat_app, login, received, send_messages
+
+
+@pytest.fixture
+def contacts(client, socket_for, make_user, testuser):
+    alice = make_user('alice')
+    make_user('mallory')
+    send_messages(socket_for(client), ['hi'], receiver_id=alice)
+    return alice
+
+
+def statuses(sock, user_id):
+    return [event['status'] for event in received(sock, 'user_status') if event['user_id'] == user_id]
+
+
+def test_contacts_see_a_user_come_online_and_go_offline_after_the_debounce(contacts, socket_for, testuser):
+    watcher = socket_for(login('testuser', 'testpassword'))
+    outsider = socket_for(login('mallory', 'secret'))
+    watcher.get_received()
+
+    alice = socket_for(login('alice', 'secret'))
+    assert statuses(watcher, contacts) == ['online']
+    alice.disconnect()
+    assert statuses(watcher, contacts) == []
+    time.sleep(0.3)
+
+    assert statuses(watcher, contacts) == ['offline']
+    assert statuses(outsider, contacts) == []
+
+
+def test_a_quick_reconnect_sends_no_events(contacts, socket_for):
+    alice = login('alice', 'secret')
+    first = socket_for(alice)
+    watcher = socket_for(login('testuser', 'testpassword'))
+    watcher.get_received()
+
+    first.disconnect()
+    socket_for(alice)
+    time.sleep(0.3)
+
+    assert statuses(watcher, contacts) == []
+    assert chat_app.presence.is_online(contacts)
+
+
+def test_presence_is_saved_in_one_batch(contacts, socket_for):
+    socket_for(login('alice', 'secret')).disconnect()
+    time.sleep(0.3)
+    chat_app.presence.flush()
+
+    with chat_app.app.app_context():
+        alice = chat_app.db.session.get(chat_app.User, contacts)
+        assert alice.is_online is False
+        assert alice.last_seen is not None
+
+
+def test_contacts_come_from_the_inbox_and_groups(contacts, testuser):
+    assert chat_app.presence.contacts(testuser) == {contacts}
+    assert chat_app.presence.contacts(contacts) == {testuser}
+
+
+def test_contact_cache_is_bounded(contacts, testuser, monkeypatch):
+    monkeypatch.setattr(chat_app.presence, 'contacts_max', 1)
+    chat_app.presence.contacts(testuser)
+    chat_app.presence.contacts(contacts)
+
+    assert list(chat_app.presence.contacts_cache) == [contacts]
+
+
+def test_join_is_limited_to_the_users_own_conversations(contacts, socket_for, testuser):
+    mallory = socket_for(login('mallory', 'secret'))
+    mallory.get_received()
+    for room in (f"user_{testuser}", chat_app.conversation_key(testuser, contacts), 'group_1', None):
+        mallory.emit('join', {'room': room})
+        assert [event['room'] for event in received(mallory, 'join_error')] == [room]
+
+    me = socket_for(login('testuser', 'testpassword'))
+    me.get_received()
+    me.emit('join', {'room': chat_app.conversation_key(testuser, contacts)})
+    assert received(me, 'join_error') == []
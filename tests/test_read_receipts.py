@@ -0,0 +1,64 @@
+import pytest
+
+from conftest import chat_app, login, received, send_messages
+
+
+@pytest.fixture
+def chat(client, socket_for, make_user, testuser):
+    alice = make_user('alice')
+    me = socket_for(client)
+    send_messages(me, ['one', 'two', 'three'], receiver_id=alice)
+    other = socket_for(login('alice', 'secret'))
+    key = chat_app.conversation_key(testuser, alice)
+    other.emit('join', {'room': key})
+    me.emit('join', {'room': key})
+    with chat_app.app.app_context():
+        ids = [message.id for message in chat_app.Message.query.filter_by(conversation_key=key).order_by(chat_app.Message.id)]
+    return {'key': key, 'ids': ids, 'alice': alice, 'me': me, 'other': other}
+
+
+def watermarks(user_id, key):
+    with chat_app.app.app_context():
+        return chat_app.read_watermarks(user_id, key)
+
+
+def test_acks_in_one_window_become_one_watermark_and_one_event(chat):
+    for message_id in chat['ids']:
+        chat['other'].emit('message_read', {'message_id': message_id, 'room': chat['key']})
+    chat['me'].get_received()
+    chat_app.read_receipts.flush()
+
+    assert watermarks(chat['alice'], chat['key']) == (chat['ids'][-1], 0)
+    assert received(chat['me'], 'read_up_to') == [
+        {'conversation_key': chat['key'], 'user_id': chat['alice'], 'message_id': chat['ids'][-1]}
+    ]
+
+
+def test_a_late_ack_never_moves_the_watermark_back(chat):
+    chat['other'].emit('message_read', {'message_id': chat['ids'][-1]})
+    chat_app.read_receipts.flush()
+    chat['other'].emit('message_read', {'message_id': chat['ids'][0]})
+    chat_app.read_receipts.flush()
+
+    assert watermarks(chat['alice'], chat['key'])[0] == chat['ids'][-1]
+
+
+def test_acks_for_unknown_or_foreign_messages_are_ignored(chat, socket_for, make_user):
+    make_user('mallory')
+    mallory = socket_for(login('mallory', 'secret'))
+    mallory.emit('message_read', {'message_id': chat['ids'][-1], 'room': chat['key']})
+    chat['other'].emit('message_read', {'message_id': 10 ** 9, 'room': chat['key']})
+    chat['other'].emit('message_read', {'message_id': 'abc'})
+    chat_app.read_receipts.flush()
+
+    with chat_app.app.app_context():
+        assert chat_app.ReadState.query.count() == 0
+
+
+def test_conversation_page_reports_read_state_from_the_watermark(client, chat):
+    chat['other'].emit('message_read', {'message_id': chat['ids'][1]})
+    chat_app.read_receipts.flush()
+
+    page = client.get(f"/api/messages/user/{chat['alice']}").json
+
+    assert [message['is_read'] for message in page['messages']] == [True, True, False]
@@ -0,0 +1,104 @@
+import pytest
+
+from conftest import chat_app, login, send_messages
+
+
+@pytest.fixture
+def chats(client, socket_for, make_user, testuser):
+    alice, bob = make_user('alice'), make_user('bob')
+    make_user('mallory')
+    with chat_app.app.app_context():
+        group = chat_app.Group(name='trip', creator_id=testuser)
+        chat_app.db.session.add(group)
+        chat_app.db.session.flush()
+        chat_app.db.session.add_all([chat_app.GroupMember(group_id=group.id, user_id=user_id) for user_id in (testuser, bob)])
+        chat_app.db.session.commit()
+        group_id = group.id
+    sock = socket_for(client)
+    send_messages(sock, ['Café meeting at <noon>', 'bring the tickets'], receiver_id=alice)
+    send_messages(sock, ['tickets for the whole group'], group_id=group_id)
+    return {'alice': alice, 'bob': bob, 'group_id': group_id}
+
+
+def search(client, text, **params):
+    return client.get('/api/search', query_string=dict(params, type=params.pop('type', 'messages'), q=text)).json
+
+
+def contents(client, text):
+    with chat_app.app.app_context():
+        ids = [result['id'] for result in search(client, text)['results']]
+        return sorted(chat_app.decrypt_message(chat_app.db.session.get(chat_app.Message, message_id).content) for message_id in ids)
+
+
+def test_messages_match_by_prefix_and_without_accents(client, chats):
+    assert contents(client, 'cafe') == ['Café meeting at <noon>']
+    assert contents(client, 'tick') == ['bring the tickets', 'tickets for the whole group']
+    assert contents(client, 'meeting tick') == []
+
+
+def test_snippets_mark_matches_and_escape_html(client, chats):
+    [result] = search(client, 'noon')['results']
+
+    assert result['snippet'] == 'Café meeting at &lt;<mark>noon</mark>&gt;'
+
+
+def test_results_are_limited_to_the_callers_conversations(chats):
+    assert contents(login('alice', 'secret'), 'tickets') == ['bring the tickets']
+    assert contents(login('bob', 'secret'), 'tickets') == ['tickets for the whole group']
+    assert contents(login('mallory', 'secret'), 'tickets') == []
+
+
+def test_an_edit_replaces_the_indexed_text(client, chats):
+    [result] = search(client, 'noon')['results']
+    client.post(f"/edit_message/{result['id']}", data={'content': 'moved to evening'})
+
+    assert search(client, 'noon')['results'] == []
+    assert [hit['id'] for hit in search(client, 'evening')['results']] == [result['id']]
+
+
+def test_limit_is_clamped_and_pages_follow_the_cursor(client, chats):
+    first = search(client, 'tickets', limit=0)
+    second = search(client, 'tickets', limit=1, cursor=first['next_cursor'])
+
+    assert len(first['results']) == 1 and first['has_more'] is True
+    assert len(second['results']) == 1 and second['has_more'] is False
+    assert {hit['id'] for hit in first['results'] + second['results']} == {hit['id'] for hit in search(client, 'tickets', limit=10 ** 6)['results']}
+
+
+def test_bad_requests(client):
+    assert client.get('/api/search?type=files&q=x').status_code == 400
+    assert search(client, '  !!! ') == {'results': [], 'next_cursor': None, 'has_more': False}
+
+
+def test_ai_turns_are_searchable_by_their_owner_only(client, testuser, make_user):
+    with chat_app.app.app_context():
+        conversation = chat_app.create_conversation(testuser, 'Travel', 'Grok')
+        chat_app.record_chat_turn(conversation.id, 'Grok', 'best time for Kyoto?', 'Autumn, for the maples')
+        chat_app.db.session.commit()
+    make_user('mallory')
+
+    [result] = search(client, 'maple', type='ai')['results']
+
+    assert result['chat_name'] == 'Travel'
+    assert result['reply_snippet'] == 'Autumn, for the <mark>maples</mark>'
+    assert search(login('mallory', 'secret'), 'maple', type='ai')['results'] == []
+
+
+def test_backfill_indexes_rows_stored_before_search(client, socket_for, testuser, make_user):
+    alice = make_user('alice')
+    send_messages(socket_for(client), ['hello'], receiver_id=alice)  # Puts the chat in the inbox
+    with chat_app.app.app_context():
+        row = {
+            'id': 10 ** 6, 'sender_id': testuser, 'receiver_id': alice, 'group_id': None,
+            'content': chat_app.encrypt_message('an unindexed message'), 'content_type': 'text',
+            'conversation_key': chat_app.conversation_key(testuser, alice),
+        }
+        chat_app.db.session.execute(chat_app.db.insert(chat_app.Message), [row])
+        chat_app.db.session.commit()
+    assert search(client, 'unindexed')['results'] == []
+
+    runner = chat_app.app.test_cli_runner()
+    assert 'messages: indexed 1 messages' in runner.invoke(args=['search-backfill']).output
+    assert 'messages: indexed 0 messages' in runner.invoke(args=['search-backfill']).output
+
+    assert [hit['id'] for hit in search(client, 'unindexed')['results']] == [10 ** 6]
@@ -0,0 +1,92 @@
+import datetime
+import os
+
+import pytest
+
+from conftest import chat_app, send_messages
+
+
+@pytest.fixture(autouse=True)
+def no_sweeper_thread(monkeypatch):
+    # Tests sweep by hand; a real sweeper could run in the middle of one
+    monkeypatch.setattr(chat_app.status_feed, 'sweeper', object())
+
+
+@pytest.fixture
+def people(client, socket_for, make_user, testuser):
+    alice, bob, mallory = make_user('alice'), make_user('bob'), make_user('mallory')
+    sock = socket_for(client)
+    send_messages(sock, ['hi'], receiver_id=alice)
+    send_messages(sock, ['hey'], receiver_id=bob)
+    return {'me': testuser, 'alice': alice, 'bob': bob, 'mallory': mallory}
+
+
+def post(user_id, content, age=0, **columns):
+    with chat_app.app.app_context():
+        status = chat_app.Status(user_id=user_id, content=content,
+                                 timestamp=datetime.datetime.utcnow() - datetime.timedelta(seconds=age), **columns)
+        chat_app.db.session.add(status)
+        chat_app.db.session.commit()
+        chat_app.status_feed.invalidate(user_id)
+        return status.id
+
+
+def feed(user_id):
+    with chat_app.app.app_context():
+        return [(group['user_id'], [status['content'] for status in group['statuses']])
+                for group in chat_app.status_feed.for_viewer(user_id)]
+
+
+def test_feed_is_the_viewer_first_then_contacts_by_latest_post(people):
+    post(people['alice'], 'alice old', age=300)
+    post(people['bob'], 'bob new', age=60)
+    post(people['alice'], 'alice new', age=120)
+    post(people['me'], 'mine', age=600)
+    post(people['mallory'], 'stranger')
+
+    assert feed(people['me']) == [
+        (people['me'], ['mine']),
+        (people['bob'], ['bob new']),
+        (people['alice'], ['alice new', 'alice old']),
+    ]
+
+
+def test_a_post_clears_the_cached_feeds_of_contacts(people):
+    assert feed(people['alice']) == []
+
+    post(people['me'], 'news')
+
+    assert feed(people['alice']) == [(people['me'], ['news'])]
+
+
+def test_statuses_leave_a_cached_feed_once_they_expire(people, monkeypatch):
+    post(people['me'], 'soon gone', age=100)
+    assert feed(people['me']) == [(people['me'], ['soon gone'])]
+
+    monkeypatch.setattr(chat_app.status_feed, 'window', 50)
+
+    assert feed(people['me']) == []
+
+
+def test_sweep_deletes_expired_statuses_and_their_media(people):
+    folder = chat_app.app.config['STATUS_FOLDER']
+    for name in ('old_thumb.jpg', 'old_medium.jpg', 'old_medium.webp', 'old.mp4'):
+        open(os.path.join(folder, name), 'wb').close()
+    day = chat_app.status_feed.window
+    post(people['me'], None, age=day + 10, content_type='image', file_path='status/old_medium.jpg', media_state='ready')
+    post(people['alice'], None, age=day + 10, content_type='video', file_path='status/old.mp4', media_state='ready')
+    post(people['me'], 'fresh', age=10)
+
+    with chat_app.app.app_context():
+        assert chat_app.status_feed.sweep() == 2
+        assert [status.content for status in chat_app.Status.query] == ['fresh']
+    assert not any(name.startswith('old') for name in os.listdir(folder))
+
+
+def test_status_page_renders_the_feed(client, people):
+    post(people['alice'], 'visible on the page')
+
+    page = client.get('/status')
+
+    assert page.status_code == 200
+    assert b'visible on the page' in page.data
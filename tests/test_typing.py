@@ -0,0 +1,101 @@
+import pytest
+
+from conftest import chat_app, login, received
+
+
+@pytest.fixture
+def typing():
+    return chat_app.TypingAggregator(interval=60, ttl=6)
+
+
+@pytest.fixture
+def emitted(monkeypatch):
+    events = []
+    monkeypatch.setattr(chat_app.socketio, 'emit', lambda name, payload, room=None: events.append((name, payload, room)))
+    return events
+
+
+def test_many_typing_events_become_one_update_per_tick(typing, emitted):
+    for _ in range(20):
+        typing.typing('chat_1_2', 1, 'testuser')
+        typing.typing('chat_1_2', 2, 'alice')
+    typing.tick()
+    typing.tick()
+
+    assert emitted == [('typing_update', {
+        'room': 'chat_1_2',
+        'started': [{'user_id': 1, 'username': 'testuser'}, {'user_id': 2, 'username': 'alice'}],
+        'stopped': []
+    }, 'chat_1_2')]
+
+
+def test_stop_and_disconnect_send_stopped(typing, emitted):
+    typing.typing('chat_1_2', 1, 'testuser')
+    typing.typing('group_5', 1, 'testuser')
+    typing.tick()
+    emitted.clear()
+
+    typing.stop('chat_1_2', 1)
+    typing.leave_all(1)
+    typing.tick()
+
+    assert sorted((payload['room'], payload['stopped']) for _, payload, _ in emitted) == [('chat_1_2', [1]), ('group_5', [1])]
+
+
+def test_typists_that_vanish_expire(typing, emitted):
+    typing.ttl = 0
+    typing.typing('chat_1_2', 1, 'testuser')
+    typing.tick()
+
+    assert emitted[-1][1]['stopped'] == [1]
+    assert typing.rooms == {}
+
+
+def test_updates_only_carry_this_workers_changes(emitted):
+    # Two workers with one typist each: neither update lists the other's typist as stopped
+    worker_a, worker_b = chat_app.TypingAggregator(60, 6), chat_app.TypingAggregator(60, 6)
+    worker_a.typing('chat_1_2', 1, 'testuser')
+    worker_b.typing('chat_1_2', 2, 'alice')
+    worker_a.tick()
+    worker_b.tick()
+    worker_a.typing('chat_1_2', 1, 'testuser')
+    worker_a.tick()
+
+    assert [payload['started'] for _, payload, _ in emitted] == [
+        [{'user_id': 1, 'username': 'testuser'}], [{'user_id': 2, 'username': 'alice'}]
+    ]
+    assert all(payload['stopped'] == [] for _, payload, _ in emitted)
+
+
+def test_socket_typing_events_reach_the_room(client, socket_for, make_user, testuser):
+    alice = make_user('alice')
+    key = chat_app.conversation_key(testuser, alice)
+    other = socket_for(login('alice', 'secret'))
+    other.emit('join', {'room': key})
+    me = socket_for(client)
+
+    me.emit('typing', {'room': key})
+    chat_app.typing_indicators.tick()
+    me.emit('stop_typing', {'room': key})
+    chat_app.typing_indicators.tick()
+
+    updates = received(other, 'typing_update')
+    assert updates[0]['started'] == [{'user_id': testuser, 'username': 'testuser'}]
+    assert updates[1]['stopped'] == [testuser]
+
+
+def test_typing_outside_your_conversations_is_ignored(client, socket_for, make_user, testuser):
+    alice = make_user('alice')
+    make_user('mallory')
+    key = chat_app.conversation_key(testuser, alice)
+    me = socket_for(client)
+    me.emit('join', {'room': key})
+    me.get_received()
+    mallory = socket_for(login('mallory', 'secret'))
+
+    for room in (key, f"user_{testuser}", None):
+        mallory.emit('typing', {'room': room})
+    mallory.emit('typing', 'not a dict')
+    chat_app.typing_indicators.tick()
+
+    assert received(me, 'typing_update') == []